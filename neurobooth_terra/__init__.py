@@ -2,5 +2,7 @@
 
 __version__ = '0.1.dev0'
 
-from .postgres import (Table, create_table, drop_table, execute, list_tables,
-                       query, copy_table, list_views, drop_view)
+from .postgres import (Table, create_table, drop_table, execute,
+                       execute_values, list_tables, query, iter_query,
+                       copy_table, list_views, drop_view, transaction,
+                       build_where)
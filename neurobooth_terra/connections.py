@@ -0,0 +1,125 @@
+"""Connections to the databases shared across a process."""
+
+import atexit
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+from .fixes import OptionalSSHTunnelForwarder
+
+
+class ConnectionManager:
+    """Keep one SSH tunnel and a pool of connections open per database.
+
+    The tunnel and the pools are opened lazily on the first connection
+    and closed when the process exits. If the tunnel drops, it is
+    restarted and the pools are recreated.
+
+    Parameters
+    ----------
+    ssh_args : dict | None
+        The arguments to OptionalSSHTunnelForwarder. If None, no
+        tunnel is opened.
+    db_args : dict of dict
+        The arguments to psycopg2.connect for each database. The keys are
+        the names used to get a connection, e.g.,
+        dict(rc=rc_db_args, log=log_db_args).
+    minconn : int
+        The minimum number of connections kept open per database.
+    maxconn : int
+        The maximum number of connections open per database.
+
+    Examples
+    --------
+    >>> manager = ConnectionManager(ssh_args, dict(rc=rc_db_args))
+    >>> with manager.connect('rc') as conn:
+    ...     df = Table('rc_clinical', conn).query()
+    """
+    def __init__(self, ssh_args, db_args, minconn=1, maxconn=4):
+        self.ssh_args = ssh_args
+        self.db_args = db_args
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._tunnel = None
+        self._pools = dict()
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return f'ConnectionManager ({", ".join(self.db_args)})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_pool(self, database):
+        """Get the pool of a database, (re)opening the tunnel if needed."""
+        if database not in self.db_args:
+            raise ValueError(f'database must be one of {list(self.db_args)}. '
+                             f'Got {database}')
+
+        with self._lock:
+            if self.ssh_args is not None:
+                if self._tunnel is None:
+                    self._tunnel = OptionalSSHTunnelForwarder(**self.ssh_args)
+                    self._tunnel.start()
+                elif not self._tunnel.is_connected:
+                    # connections through a dropped tunnel are dead
+                    self._close_pools()
+                    self._tunnel.restart()
+
+            if database not in self._pools:
+                self._pools[database] = ThreadedConnectionPool(
+                    self.minconn, self.maxconn, **self.db_args[database])
+            return self._pools[database]
+
+    @contextmanager
+    def connect(self, database):
+        """Get a connection to a database from the pool.
+
+        Like ``with psycopg2.connect(...) as conn``, the transaction is
+        committed when the block exits, or rolled back on error. The
+        connection is then returned to the pool instead of being closed.
+
+        Parameters
+        ----------
+        database : str
+            The name of the database, one of the keys of db_args.
+
+        Yields
+        ------
+        conn : instance of psycopg2.Postgres
+            The connection object
+        """
+        pool = self._get_pool(database)
+        conn = pool.getconn()
+        is_broken = False
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            is_broken = True
+            raise
+        finally:
+            if pool.closed:  # pools were recreated after the tunnel dropped
+                conn.close()
+            else:
+                # broken connections are not returned to the pool
+                pool.putconn(conn, close=is_broken or bool(conn.closed))
+
+    def _close_pools(self):
+        for pool in self._pools.values():
+            pool.closeall()
+        self._pools = dict()
+
+    def close(self):
+        """Close all the connections and the tunnel."""
+        with self._lock:
+            self._close_pools()
+            if self._tunnel is not None:
+                self._tunnel.stop(force=True)
+                self._tunnel = None
@@ -10,8 +10,144 @@ import time
 import datetime
 import subprocess
 import warnings
+import hashlib
+import sqlite3
+import tempfile
+import multiprocessing
+from bisect import bisect_left
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                Future, wait, FIRST_COMPLETED)
 
 import pandas as pd
+import psycopg2
+
+from .postgres import Table, transaction, query, execute, execute_values
+
+GIGABYTE = 1024 ** 3
+
+def query_sensor_files(sensor_file_table, include_columns=None):
+    """Query the sensor files, keeping one row per list of files.
+
+    Sensors such as intel have duplicate sensor_file_paths but unique
+    sensor_file_ids for depth vs rgb - same holds true for mbients that
+    have one data file but two sensor_file_ids for accelerometer and
+    gyroscope. Thus we can have duplicate sensor files over two rows.
+    We want to write one line in the log_file table per device, so the
+    duplicates are removed in the database before the rows are fetched.
+
+    Parameters
+    ----------
+    sensor_file_table : instance of Table
+        The table containing information about the sensors used in a
+        session and the files.
+    include_columns : list of str | None
+        The columns to query. If None, query all columns.
+
+    Returns
+    -------
+    sensor_file_df : instance of pd.Dataframe
+        The deduplicated dataframe indexed by log_sensor_file_id. Of the
+        duplicates, the row with the smallest log_sensor_file_id is kept.
+    """
+    if include_columns is None:
+        include_columns = sensor_file_table.column_names
+    include_columns = list(include_columns)
+    for col in ['log_sensor_file_id', 'sensor_file_path']:
+        if col not in include_columns:
+            include_columns.append(col)
+
+    # The order of the file names in sensor_file_path is conserved between
+    # two sensors of the same device (eg: acc/gyr) by neurobooth_os, so
+    # arrays with the same files in the same order are duplicates.
+    cols = ', '.join([f'"{col}"' for col in include_columns])
+    cmd = (f'SELECT DISTINCT ON (sensor_file_path) {cols} '
+           f'FROM {sensor_file_table.table_id} '
+           f'ORDER BY sensor_file_path, log_sensor_file_id;')
+    df = query(sensor_file_table.conn, cmd, include_columns)
+    return df.set_index('log_sensor_file_id')
+
+
+def _scan_dir(dirname):
+    """Get the names of the files in a directory with a single listing.
+
+    Returns an empty set if the directory does not exist.
+    """
+    try:
+        with os.scandir(dirname) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def _get_sensor_fnames(sensor_file_df, sessions):
+    """Get the sensor file names of each session.
+
+    A file belongs to a session if its name starts with the session name.
+    Most files are in the session directory, but some files were written
+    without it, e.g., 100001_2024-01-01_task.json.
+
+    Returns
+    -------
+    sensor_fnames : dict of list
+        The (log_sensor_file_id, fname) of the files, keyed by session.
+    """
+    # this is a list of lists - since sensor_file_path is an array in log_sensor_file table
+    sensor_fnames_list = sensor_file_df.sensor_file_path.tolist()
+    sensor_file_ids = sensor_file_df.index.tolist()
+
+    # the files starting with a session are next to each other once sorted
+    all_fnames = sorted((this_sensor_fname, sensor_file_id)
+                        for sensor_fname_row, sensor_file_id
+                        in zip(sensor_fnames_list, sensor_file_ids)
+                        for this_sensor_fname in sensor_fname_row)
+    fnames = [fname for fname, _ in all_fnames]
+
+    sensor_fnames = dict()
+    for session_name in sessions:
+        sensor_fnames[session_name] = list()
+        for idx in range(bisect_left(fnames, session_name), len(fnames)):
+            this_sensor_fname, sensor_file_id = all_fnames[idx]
+            if not this_sensor_fname.startswith(session_name):
+                break
+            sensor_fnames[session_name].append(
+                (sensor_file_id, this_sensor_fname))
+    return sensor_fnames
+
+
+def _get_new_file_rows(sensor_fnames, log_fnames, dest_dir, dest_fnames,
+                       time_verified):
+    """Get the log_file rows of the files that are not in log_file yet.
+
+    Because we treat NAS as primary source of data, there is no source
+    directory, hence 'src_dirname' is set as null.
+    """
+    # TODO: Add code here to get notes.txt, outcomes.csv and results.csv files
+    #       from log_task table. Append to sensor_fnames. Replace sensor_file_id
+    #       with log_task_id (??)
+
+    # filter files that are new
+    missing_fnames = [(sensor_file_id, fname)
+                      for sensor_file_id, fname in sensor_fnames
+                      if fname not in log_fnames]
+
+    column_values = list()
+    for sensor_file_id, fname in missing_fnames:
+        # removing session prefix from sensor file name before building full path-to-file
+        if os.path.split(fname)[-1] in dest_fnames:
+            column_values.append((sensor_file_id, None, fname,
+                                  dest_dir, time_verified, None,
+                                  False))
+        else:
+            # files with these extensions are not tracked yet
+            if not any(ext in fname for ext in ['xdf', 'txt', 'csv', 'jittered']):
+                print(f'{fname} exists in log_sensor_file table, but does not exist in {dest_dir}')
+    return column_values
+
+
+# Column names of the rows returned by _get_new_file_rows
+_WRITE_COLUMN_NAMES = ['log_sensor_file_id', 'src_dirname', 'fname',
+                       'dest_dirname', 'time_verified', 'rsync_operation',
+                       'is_deleted']
 
 
 def write_files(sensor_file_df, db_table, dest_dir_session):
@@ -31,121 +167,647 @@ def write_files(sensor_file_df, db_table, dest_dir_session):
         about the sensors used in a session and the files.
     db_table : instance of Table
         The table containing information about the file transfers.
-    dest_dir : str
-        The destination directory.
+    dest_dir_session : str
+        The session directory in the destination, e.g., the NAS.
+
+    Returns
+    -------
+    column_values : list of tuple
+        The rows written to the log_file table.
+
+    See Also
+    --------
+    write_files_bulk : Write the files of all the sessions at once.
     """
     _, session_name = os.path.split(dest_dir_session)
     dest_dir = os.path.join(dest_dir_session, '')  # ensure trailing slash
 
-    # get log_file table where dest_dirname is NAS
-    log_file_df = db_table.query(where=f"dest_dirname='{dest_dir}'")
-    
+    # get fnames in log_file table where dest_dirname is NAS
+    log_fnames = set()
+    for log_file_df in db_table.iter_query(
+            include_columns='fname', where={'dest_dirname': dest_dir}):
+        log_fnames.update(log_file_df.fname)
+
     # get sensor file names and ids from deduplicated log_sensor_file_table
-    # this is a list of lists - since sensor_file_path is an array in log_sensor_file table
-    sensor_fnames_list = sensor_file_df.sensor_file_path.tolist()
-    sensor_file_ids = sensor_file_df.index.tolist()
+    sensor_fnames = _get_sensor_fnames(sensor_file_df,
+                                       [session_name])[session_name]
 
-    # get all sensor file names from sensor file name list
-    sensor_fnames = list()
-    for sensor_fname_row, sensor_file_id in zip(sensor_fnames_list, sensor_file_ids):
-        for this_sensor_fname in sensor_fname_row:
-            if this_sensor_fname.startswith(session_name):
-                sensor_fnames.append((sensor_file_id, this_sensor_fname))
+    # list the session directory once instead of checking each file, since
+    # every stat on the NAS is a round trip
+    dest_fnames = _scan_dir(dest_dir)
 
-    # TODO: Add code here to get notes.txt, outcomes.csv and results.csv files
-    #       from log_task table. Append to sensor_fnames. Replace sensor_file_id
-    #       with log_task_id (??)
+    time_verified = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    column_values = _get_new_file_rows(sensor_fnames, log_fnames, dest_dir,
+                                       dest_fnames, time_verified)
 
-    # filter files that are new
-    missing_fnames = [(sensor_file_id, fname)
-                      for sensor_file_id, fname in sensor_fnames
-                      if fname not in log_file_df.fname.tolist()]
-
-    # insert into database table
-    column_names = ['log_sensor_file_id', 'src_dirname', 'fname',
-                    'dest_dirname', 'time_verified', 'rsync_operation',
-                    'is_deleted']
-    # Above column names correspond to following column values
-    # column_values = [(sensor_file_id, None, fname, 
-    #                   dest_dir, time_verified, None,
-    #                   False)]
-    for sensor_file_id, fname in missing_fnames:
-        # removing session prefix from sensor file name before building full path-to-file
-        if os.path.exists(os.path.join(dest_dir, os.path.split(fname)[-1])):
-            time_verified = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            column_values = [(sensor_file_id, None, fname, 
-                            dest_dir, time_verified, None,
-                            False)]
-            db_table.insert_rows(column_values, cols=column_names)
+    # insert all the rows of the session at once
+    if len(column_values) > 0:
+        db_table.insert_rows(column_values, cols=_WRITE_COLUMN_NAMES)
+
+    return column_values
+
+
+def write_files_bulk(sensor_file_df, db_table, nas_root, sessions=None,
+                     n_workers=8):
+    """Write the files of all the sessions in NAS to log_file table.
+
+    Like calling write_files for each session, but the log_file table is
+    read with one query, the session directories are listed in parallel
+    and all the new files are inserted at once.
+
+    Parameters
+    ----------
+    sensor_file_df : pandas DataFrame
+        The deduplicated dataframe of the table containing information
+        about the sensors used in a session and the files.
+    db_table : instance of Table
+        The table containing information about the file transfers.
+    nas_root : str
+        The directory containing the sessions, e.g., the NAS.
+    sessions : list of str | None
+        The sessions to write. If None, all the directories in nas_root.
+    n_workers : int
+        The number of session directories listed in parallel.
+
+    Returns
+    -------
+    column_values : list of tuple
+        The rows written to the log_file table.
+    """
+    nas_root = os.path.join(nas_root, '')  # ensure trailing slash
+    if sessions is None:
+        with os.scandir(nas_root) as entries:
+            sessions = sorted(entry.name for entry in entries
+                              if entry.is_dir())
+    dest_dirs = {session: os.path.join(nas_root, session, '')
+                 for session in sessions}
+
+    # get fnames in log_file table for all the sessions in NAS at once
+    log_fnames = {dest_dir: set() for dest_dir in dest_dirs.values()}
+    # '_' matches any character in LIKE, other sessions are filtered below
+    for log_file_df in db_table.iter_query(
+            include_columns=['dest_dirname', 'fname'],
+            where={'dest_dirname': {'like': nas_root + '%'}}):
+        for dest_dir, fname in zip(log_file_df.dest_dirname,
+                                   log_file_df.fname):
+            if dest_dir in log_fnames:
+                log_fnames[dest_dir].add(fname)
+
+    sensor_fnames = _get_sensor_fnames(sensor_file_df, sessions)
+
+    # listing a directory on the NAS is mostly waiting on the network
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        dest_fnames = dict(zip(sessions,
+                               executor.map(_scan_dir, dest_dirs.values())))
+
+    time_verified = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    column_values = list()
+    for session in sessions:
+        dest_dir = dest_dirs[session]
+        column_values.extend(_get_new_file_rows(
+            sensor_fnames[session], log_fnames[dest_dir],
+            dest_dir, dest_fnames[session], time_verified))
+
+    if len(column_values) > 0:
+        db_table.insert_rows(column_values, cols=_WRITE_COLUMN_NAMES,
+                             method='copy')
+
+    return column_values
+
+
+def _hash_file(fname, chunk_size=8 * 1024 ** 2):
+    """Compute the SHA-1 hash of a file, same as shasum."""
+    sha = hashlib.sha1()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(fname, 'rb', buffering=0) as fid:
+        while True:
+            n_bytes = fid.readinto(buffer)
+            if not n_bytes:
+                break
+            sha.update(view[:n_bytes])
+    return sha.hexdigest()
+
+
+def _hash_file_or_none(fname, chunk_size):
+    """Hash a file, returning None if it cannot be read."""
+    try:
+        return _hash_file(fname, chunk_size)
+    except OSError:
+        return None
+
+
+class HashCache:
+    """Persistent cache of the hashes of files in a SQLite database.
+
+    A hash is reused as long as the path, size, modification time and inode
+    of the file are unchanged, so unchanged files are not hashed again.
+
+    Parameters
+    ----------
+    fname : str
+        The path to the SQLite database. It is created if it does not exist.
+    max_entries : int | None
+        The maximum number of hashes kept. The least recently used hashes
+        are evicted first. If None, the number of hashes is not bounded.
+    max_age : float | None
+        The hashes not used for more than max_age seconds are evicted.
+        If None, hashes are not evicted by age.
+
+    Examples
+    --------
+    >>> with HashCache('file_hash.db') as hash_cache:
+    ...     copy_files(src_dir, dest_dir, db_table, sensor_file_table,
+    ...                hash_cache=hash_cache)
+    """
+    def __init__(self, fname, max_entries=1_000_000, max_age=None):
+        self.fname = fname
+        self.max_entries = max_entries
+        self.max_age = max_age
+        # several processes can share the cache
+        self._conn = sqlite3.connect(fname, timeout=60)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS file_hash ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+            'inode INTEGER, digest TEXT, last_used REAL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS file_hash_last_used '
+                           'ON file_hash (last_used)')
+        self._conn.commit()
+
+    def __repr__(self):
+        return f'HashCache ({self.fname}, {len(self)} hashes)'
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM file_hash').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, fname, stat):
+        """Get the hash of a file if its stat is unchanged.
+
+        Parameters
+        ----------
+        fname : str
+            The path to the file.
+        stat : instance of os.stat_result
+            The current stat of the file.
+
+        Returns
+        -------
+        digest : str | None
+            The hash of the file, or None if it is not in the cache.
+        """
+        fname = os.path.abspath(fname)
+        row = self._conn.execute(
+            'SELECT digest FROM file_hash WHERE path=? AND size=? AND '
+            'mtime_ns=? AND inode=?',
+            (fname, stat.st_size, stat.st_mtime_ns, stat.st_ino)).fetchone()
+        if row is None:
+            return None
+        self._conn.execute('UPDATE file_hash SET last_used=? WHERE path=?',
+                           (time.time(), fname))
+        return row[0]
+
+    def set(self, fname, stat, digest):
+        """Store the hash of a file.
+
+        Parameters
+        ----------
+        fname : str
+            The path to the file.
+        stat : instance of os.stat_result
+            The stat of the file when it was hashed.
+        digest : str
+            The hash of the file.
+        """
+        self._conn.execute(
+            'INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?)',
+            (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns,
+             stat.st_ino, digest, time.time()))
+
+    def invalidate(self, path=None):
+        """Remove hashes from the cache.
+
+        Parameters
+        ----------
+        path : str | None
+            The file or directory whose hashes are removed. If None,
+            all the hashes are removed.
+        """
+        if path is None:
+            self._conn.execute('DELETE FROM file_hash')
         else:
-            # files with these extensions are not tracked yet
-            if not any(ext in fname for ext in ['xdf', 'txt', 'csv', 'jittered']):
-                print(f'{fname} exists in log_sensor_file table, but does not exist in {dest_dir}')
+            path = os.path.abspath(path)
+            prefix = os.path.join(path, '')
+            # hashes of the files in the directory have paths starting
+            # with the prefix
+            self._conn.execute(
+                'DELETE FROM file_hash WHERE path=? OR '
+                'substr(path, 1, ?)=?', (path, len(prefix), prefix))
+        self._conn.commit()
+
+    def evict(self):
+        """Evict the hashes that are too old or least recently used."""
+        if self.max_age is not None:
+            self._conn.execute('DELETE FROM file_hash WHERE last_used < ?',
+                               (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            self._conn.execute(
+                'DELETE FROM file_hash WHERE path IN (SELECT path FROM '
+                'file_hash ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+        self._conn.commit()
+
+    def close(self):
+        """Evict old hashes and close the database."""
+        self.evict()
+        self._conn.close()
+
+
+def _get_hash(fname, executor, chunk_size, hash_cache, new_hashes):
+    """Get the hash of a file from the cache or submit it to be hashed."""
+    if hash_cache is not None:
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            stat = None
+        if stat is not None:
+            digest = hash_cache.get(fname, stat)
+            if digest is not None:
+                future = Future()
+                future.set_result(digest)
+                return future
+
+    future = executor.submit(_hash_file_or_none, fname, chunk_size)
+    if hash_cache is not None and stat is not None:
+        new_hashes.append((fname, stat, future))
+    return future
+
+
+def verify_pairs(pairs, n_workers=4, chunk_size=8 * 1024 ** 2,
+                 hash_cache=None):
+    """Check that the source and destination of copied files match.
+
+    The files are hashed with SHA-1 in a thread pool. The source and
+    destination of a pair are read at the same time.
+
+    Parameters
+    ----------
+    pairs : list of tuple
+        The (source, destination) paths of the files to compare.
+    n_workers : int
+        The number of files hashed in parallel.
+    chunk_size : int
+        The number of bytes read from a file at a time.
+    hash_cache : instance of HashCache | None
+        The cache of hashes. Files whose size, modification time and inode
+        did not change since they were last hashed are not hashed again.
+        If None, all the files are hashed.
+
+    Returns
+    -------
+    match : dict
+        Maps each pair to True if the files match and False otherwise.
+    """
+    match = dict()
+    futures = dict()
+    new_hashes = list()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for pair in pairs:
+            src_fname, dest_fname = pair
+
+            # First confirm that file at destination dir exists.
+            # In case the file at destination dir does not exist - can happen due to
+            # interrupted file transfer or incorrect order of write/copy operation -
+            # then return false
+            if not os.path.exists(dest_fname):
+                match[pair] = False
+
+            # bag and avi files are large and uneditable, hence their hashes are not
+            # checked explicitly - instead if the file size and last modified date is
+            # the same, function returns true
+            elif dest_fname.endswith('.bag') or dest_fname.endswith('.avi'):
+                src_stat, dest_stat = os.stat(src_fname), os.stat(dest_fname)
+                match[pair] = (src_stat.st_size == dest_stat.st_size and
+                               src_stat.st_mtime == dest_stat.st_mtime)
+                if not match[pair]:
+                    print(f'file size/last modified time of file {src_fname} '
+                          f'did not match with {dest_fname}')
+
+            # For all other files generate hashes and compare
+            else:
+                futures[pair] = (
+                    _get_hash(src_fname, executor, chunk_size, hash_cache,
+                              new_hashes),
+                    _get_hash(dest_fname, executor, chunk_size, hash_cache,
+                              new_hashes))
+
+        for pair, (future_src, future_dest) in futures.items():
+            hash_src, hash_dest = future_src.result(), future_dest.result()
+            # files that cannot be read never match
+            match[pair] = hash_src is not None and hash_src == hash_dest
+            if not match[pair]:  # could be partially copied?
+                print(f'hash of file {pair[0]} does not match with {pair[1]}: '
+                      f'({hash_src}, {hash_dest})')
+
+    # the cache is only used from this thread
+    for fname, stat, future in new_hashes:
+        digest = future.result()
+        if digest is not None:
+            hash_cache.set(fname, stat, digest)
+    if hash_cache is not None:
+        hash_cache.evict()
+    return match
+
+
+def _get_pair(src_dirname, dest_dirname, fname):
+    """Get the source and destination paths of a file in log_file."""
+    # fname has the session prefix which is not in the directories
+    fname = os.path.split(fname)[-1]
+    return (os.path.join(src_dirname, fname),
+            os.path.join(dest_dirname, fname))
 
 
 def _do_files_match(src_dirname, dest_dirname, fname):
     """Compare two files using a hash."""
+    pair = _get_pair(src_dirname, dest_dirname, fname)
+    return verify_pairs([pair], n_workers=2)[pair]
 
-    # First confirm that file at destination dir exists.
-    # In case the file at destination dir does not exist - can happen due to
-    # interrupted file transfer or incorrect order of write/copy operation -
-    # then return false
-    if not os.path.exists(os.path.join(dest_dirname, os.path.split(fname)[-1])):
-        return False
 
-    # bag and avi files are large and uneditable, hence their hashes are not
-    # checked explicitly - instead if the file size and last modified date is
-    # the same, function returns true
-    if fname.endswith('.bag') or fname.endswith('.avi'):
+def _update_copystatus(db_table, show_unfinished=False, n_workers=4,
+                       hash_cache=None, dest_dir=None):
+    """Update copy status after checking if files match
 
-        src_mtime = os.path.getmtime(os.path.join(src_dirname, os.path.split(fname)[-1]))
-        src_fsize = os.path.getsize(os.path.join(src_dirname, os.path.split(fname)[-1]))
+    If dest_dir is not None, only the files copied to dest_dir are checked
+    so that copies of other sessions running at the same time are left
+    alone.
+    """
 
-        dest_mtime = os.path.getmtime(os.path.join(dest_dirname, os.path.split(fname)[-1]))
-        dest_fsize = os.path.getsize(os.path.join(dest_dirname, os.path.split(fname)[-1]))
+    # first verify all the unfinished files
+    include_columns = ['operation_id', 'src_dirname', 'dest_dirname', 'fname']
+    where = {'is_finished': False}
+    if dest_dir is not None:
+        where['dest_dirname'] = os.path.join(dest_dir, '')
+    finished_rows, unfinished_ids = list(), list()
+    for log_file_df in db_table.iter_query(include_columns=include_columns,
+                                           where=where):
+        pairs = [_get_pair(src_dirname, dest_dirname, fname)
+                 for src_dirname, dest_dirname, fname in
+                 zip(log_file_df.src_dirname, log_file_df.dest_dirname,
+                     log_file_df.fname)]
+        match = verify_pairs(pairs, n_workers=n_workers,
+                             hash_cache=hash_cache)
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") # strf: '2022-10-18 15:58:38'
+        for pair, (operation_id, log_file_row) in zip(pairs, log_file_df.iterrows()):
+            if match[pair]:
+                finished_rows.append((int(operation_id), current_time))
+            elif show_unfinished:
+                unfinished_ids.append(int(operation_id))
+                print(f"The file transfer from {log_file_row['src_dirname']} "
+                      f"to {log_file_row['dest_dirname']} did not finish for "
+                      f"file {log_file_row['fname']}")
+
+    # then update the status of all the files at once
+    table_id = db_table.table_id
+    with transaction(db_table.conn):
+        if len(finished_rows) > 0:
+            execute_values(
+                db_table.conn, db_table.cursor,
+                f'UPDATE {table_id} SET time_verified=v.time_verified::timestamp, '
+                f'is_finished=True FROM (VALUES %s) AS v(operation_id, time_verified) '
+                f'WHERE {table_id}.operation_id=v.operation_id', finished_rows)
+        if len(unfinished_ids) > 0:
+            execute(db_table.conn, db_table.cursor,
+                    f'DELETE FROM {table_id} WHERE operation_id = ANY(%s)',
+                    params=(unfinished_ids,))
+
+
+def _get_sensor_file_ids(sensor_file_table, fnames):
+    """Map file names to the log_sensor_file_id that contains them.
+
+    Rows of log_sensor_file whose parent log_task is incomplete (cancelled or
+    crashed before _perform_task completed) are excluded. neurobooth-os writes
+    log_sensor_file rows at device-start time, so orphans exist with
+    log_task.task_id IS NULL.
+    """
+    if len(fnames) == 0:
+        return dict()
+
+    cmd = (f"SELECT p.fname, s.log_sensor_file_id "
+           f"FROM {sensor_file_table.table_id} s, "
+           f"unnest(s.sensor_file_path) AS p(fname) "
+           f"WHERE s.sensor_file_path && %(fnames)s::text[] "
+           f"AND p.fname = ANY(%(fnames)s) "
+           f"AND s.log_task_id IN "
+           f"(SELECT log_task_id FROM log_task "
+           f"WHERE task_id IS NOT NULL)")
+    df = query(sensor_file_table.conn, cmd, ['fname', 'log_sensor_file_id'],
+               params={'fnames': list(fnames)})
+
+    sensor_file_ids = dict()
+    for fname, log_sensor_file_id in zip(df.fname, df.log_sensor_file_id):
+        sensor_file_ids.setdefault(fname, log_sensor_file_id)
+    return sensor_file_ids
+
+
+def _get_copied_operation_ids(db_table, fnames):
+    """Map file names to the operation_ids of their finished copies."""
+    if len(fnames) == 0:
+        return dict()
+
+    cmd = (f"SELECT fname, operation_id FROM {db_table.table_id} "
+           f"WHERE fname = ANY(%(fnames)s) AND is_finished is True")
+    df = query(db_table.conn, cmd, ['fname', 'operation_id'],
+               params={'fnames': list(fnames)})
+
+    operation_ids = dict()
+    for fname, operation_id in zip(df.fname, df.operation_id):
+        operation_ids.setdefault(fname, list()).append(operation_id)
+    return operation_ids
+
+
+def _parse_rsync_line(line):
+    """Parse a line of rsync --out-format="%i %n%L %t" output.
+
+    Returns
+    -------
+    transfer : tuple | None
+        The (operation, fname) of a file transfer or None if the line is
+        not about a file transfer.
+    """
+    if not line.startswith('>f'):
+        return None
+    if len(line.split(' ')) == 4:
+        operation, fname, date_copied, time_verified = line.split(' ')
+    else: ## Edge case for if a file name has spaces in it
+        operation = line.split(' ')[0]
+        fname = " ".join(line.split(' ')[1:-2])
+        date_copied = line.split(' ')[-2]
+        time_verified = line.split(' ')[-1]
+    return operation, fname
+
+
+def _get_log_file_rows(transfers, src_dir, dest_dir, db_table,
+                       sensor_file_table):
+    """Get the log_file rows of rsync transfers.
+
+    Returns
+    -------
+    db_rows : list of tuple
+        The rows of the files that were never copied.
+    copied : list of tuple
+        The (operation_id, (src_fname, dest_fname)) of the files that were
+        already copied.
+    """
+    # Resolve all the files with two queries, instead of two queries
+    # per file.
+    fnames = [fname for _, fname in transfers]
+    sensor_file_ids = _get_sensor_file_ids(sensor_file_table, fnames)
+    copied_operation_ids = _get_copied_operation_ids(db_table, fnames)
 
-        if (src_fsize==dest_fsize) and (src_mtime==dest_mtime):
-            return True
+    db_rows = list()
+    copied = list()
+    for operation, fname in transfers:
+        if fname in sensor_file_ids:
+            log_sensor_file_id = sensor_file_ids[fname]
         else:
-            print(f'file size/last modified time of file {fname} did not '
-                  f'match between {src_dirname} and {dest_dirname}')
-            return False
-
-    # For all other files generate hashes and compare
-    out_src = subprocess.run(["shasum", os.path.join(src_dirname, os.path.split(fname)[-1])],
-                             capture_output=True).stdout.decode('ascii')
-    out_dest = subprocess.run(["shasum", os.path.join(dest_dirname, os.path.split(fname)[-1])],
-                              capture_output=True).stdout.decode('ascii')
-
-    hash_src, hash_dest = out_src.split(' ')[0], out_dest.split(' ')[0]
-    if hash_src != hash_dest:  # could be partially copied?
-        print(f'hash of file {fname} does not match: '
-              f'({hash_src}, {hash_dest})')
-        return False
-    return True
-
-
-def _update_copystatus(db_table, show_unfinished=False):
-    """Update copy status after checking if files match"""
-
-    log_file_df = db_table.query(where='is_finished=False')
-    for operation_id, log_file_row in log_file_df.iterrows():
-        if _do_files_match(log_file_row['src_dirname'],
-                           log_file_row['dest_dirname'],
-                           log_file_row['fname']
-                           ):
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") # strf: '2022-10-18 15:58:38'
-            db_table.insert_rows([(operation_id, current_time, True)],
-                                 ['operation_id', 'time_verified', 'is_finished'],
+            # files with these extensions are not tracked yet
+            untracked_extensions = ['xdf', 'txt', 'csv', 'jittered', 'asc', 'log']
+            if not any(ext in fname for ext in untracked_extensions):
+                print(f'log_sensor_file_id not found for {fname}')
+            continue
+
+        # Block to check if file has been edited!
+        # If file has already been copied over, check if files match. If they do match - continue
+        # Else: the file has been edited - therefore, set is_finished to false and continue.
+        # We continue either way because we don't want to rewrite this file to table. The rsync for
+        # this session will proceed anyway outside this loop, and edited file will be copied over.
+        # Then update copy status will run, and update is_finished to true, and time_verified
+        # to when it checks hashes
+
+        # Check if file has already been copied over
+        operation_ids = copied_operation_ids.get(fname, list())
+        if len(operation_ids) == 1:
+            # if it has, then check if files match below and
+            # continue to prevent writing to db table
+            copied.append((operation_ids[0],
+                           _get_pair(src_dir, dest_dir, fname)))
+            continue
+
+        # time verified is null, since file hasn't been copied over yet, nor copy status verified yet
+        db_rows.append((log_sensor_file_id, src_dir, dest_dir,
+                        fname, None, operation,
+                        False, False))
+
+    return db_rows, copied
+
+
+def _insert_log_file_rows(db_table, db_rows, edited_rows):
+    """Insert new files and mark edited files as unfinished at once."""
+    column_names = ['log_sensor_file_id', 'src_dirname', 'dest_dirname', 'fname',
+                    'time_verified', 'rsync_operation', 'is_deleted', 'is_finished']
+    with transaction(db_table.conn):
+        if len(edited_rows) > 0:
+            db_table.insert_rows(edited_rows, ['operation_id', 'is_finished'],
                                  on_conflict='update')
-        elif show_unfinished:
-            db_table.delete_row(where=f"operation_id={operation_id}")
-            print(f"The file transfer from {log_file_row['src_dirname']} "
-                  f"to {log_file_row['dest_dirname']} did not finish for "
-                  f"file {log_file_row['fname']}")
+        if len(db_rows) > 0:
+            db_table.insert_rows(db_rows, column_names)
+
+
+def _copy_files_single_pass(src_dir, dest_dir, db_table, sensor_file_table,
+                            n_workers=4, hash_cache=None, batch_size=100,
+                            flush_interval=1.):
+    """Copy files with one rsync, logging the files as they are copied.
+
+    The files reported by rsync are written to the log_file table every
+    batch_size files or every flush_interval seconds, whichever comes first.
+    """
+    # rsync lists the files relative to src_dir when it ends with a slash,
+    # while the files are relative to the parent of src_dir in the dry run
+    # and in log_sensor_file.
+    prefix = os.path.basename(os.path.normpath(src_dir))
+    dest_dir = os.path.join(dest_dir, '')
+    src_dir = os.path.join(src_dir, '')
+
+    db_rows, transfers = list(), list()
+
+    def _read(line):
+        # file names are not necessarily ascii
+        line = line.decode('utf-8', errors='surrogateescape').rstrip('\n')
+        transfer = _parse_rsync_line(line)
+        if transfer is not None:
+            operation, fname = transfer
+            transfers.append((operation, f'{prefix}/{fname}'))
+
+    def _flush():
+        nonlocal t_flush
+        t_flush = time.monotonic()
+        rows, copied = _get_log_file_rows(transfers, src_dir, dest_dir,
+                                          db_table, sensor_file_table)
+        # rsync only copies a file already copied if it has been edited
+        edited_rows = [(operation_id, False) for operation_id, _ in copied]
+        _insert_log_file_rows(db_table, rows, edited_rows)
+        # the transfers are forgotten only once they are written
+        db_rows.extend(rows)
+        transfers.clear()
+
+    t1 = time.time()
+    t_flush = time.monotonic()
+    # Each file is written with is_finished=False shortly after rsync reports
+    # it. The files not written yet are written when the copy stops, also on
+    # errors, so that a file copied by rsync always has a row. If the process
+    # dies, the next run verifies or removes the rows, as with the dry run.
+    # See copy_files for the chmod flag.
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(["rsync", src_dir, dest_dir, '-a',
+                                 "--out-format=%i %n%L %t",
+                                 "--chmod=Du=rwx,Dg=rx,Do=,Fu=rw,Fg=r,Fo="],
+                                stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            for line in proc.stdout:
+                _read(line)
+                if len(transfers) >= batch_size or (
+                        len(transfers) > 0 and
+                        time.monotonic() - t_flush >= flush_interval):
+                    _flush()
+        except BaseException:
+            # stop copying files that could not be logged
+            proc.terminate()
+            raise
+        finally:
+            # log the files that rsync reported before it stopped
+            for line in proc.stdout:
+                _read(line)
+            proc.stdout.close()
+            if len(transfers) > 0:
+                _flush()
+            proc.wait()
+
+        stderr.seek(0)
+        err = stderr.read()
+        if len(err) > 0:
+            warnings.warn(err.decode('utf-8', errors='replace'))
+        if proc.returncode != 0:
+            warnings.warn(f'rsync exited with code {proc.returncode}')
+
+    t2 = time.time()
+    print(f'Time taken by rsync is {datetime.timedelta(seconds=(t2 - t1))} h:m:s')
 
+    t1 = time.time()
+    _update_copystatus(db_table, show_unfinished=False, n_workers=n_workers,
+                       hash_cache=hash_cache, dest_dir=dest_dir)
+    t2 = time.time()
+    print(f'Time taken for individual hash checks is {datetime.timedelta(seconds=(t2 - t1))} h:m:s')
+
+    return db_rows
 
-def copy_files(src_dir, dest_dir, db_table, sensor_file_table):
+
+def copy_files(src_dir, dest_dir, db_table, sensor_file_table, n_workers=4,
+               hash_cache=None, single_pass=False, recover_all=True):
     """Copy files per session using rsync.
 
     First, an rsync dry run is executed to get details of copy.
@@ -172,10 +834,38 @@ def copy_files(src_dir, dest_dir, db_table, sensor_file_table):
     sensor_file_table : instance of Table
         The table containing information about the sensors used in a session
         and the files.
+    n_workers : int
+        The number of files hashed in parallel to verify the copies.
+    hash_cache : instance of HashCache | None
+        The cache of hashes, so that unchanged files are not hashed again
+        when verifying the copies.
+    single_pass : bool
+        If True, run rsync only once without the dry run and write the files
+        to the log_file table as rsync reports them. Edited files are
+        detected by rsync instead of by comparing hashes before the copy.
+    recover_all : bool
+        If True, the unfinished copies left by previous runs are verified
+        for all the destinations before copying. If False, only the
+        unfinished copies to dest_dir are, so that the copies of other
+        sessions running at the same time are left alone. The copies to
+        other destinations must then be recovered separately, as
+        copy_sessions does.
+
+    Returns
+    -------
+    db_rows : list of tuple
+        The rows of the new files written to the log_file table.
     """
 
     # update copy status first, in case process failed on previous run
-    _update_copystatus(db_table, show_unfinished=True)
+    _update_copystatus(db_table, show_unfinished=True, n_workers=n_workers,
+                       hash_cache=hash_cache,
+                       dest_dir=None if recover_all else dest_dir)
+
+    if single_pass:
+        return _copy_files_single_pass(src_dir, dest_dir, db_table,
+                                       sensor_file_table, n_workers=n_workers,
+                                       hash_cache=hash_cache)
     
     # Trailing slash should NOT be present on SOURCE directory for dry run
     out = subprocess.run(["rsync", src_dir, dest_dir, '-a', '--dry-run',
@@ -190,86 +880,23 @@ def copy_files(src_dir, dest_dir, db_table, sensor_file_table):
     # if rsync did actually manage to finish the transfer. Therefore, we
     # will manually check the hashes of the files before writing to the
     # table.
-    column_names = ['log_sensor_file_id', 'src_dirname', 'dest_dirname', 'fname',
-                    'time_verified', 'rsync_operation', 'is_deleted', 'is_finished']
-    db_rows = list()
-    for this_out in out:
-        if this_out.startswith('>f'):
-            # parse rsync dry run output
-            if len(this_out.split(' ')) == 4:
-                operation, fname, date_copied, time_verified = this_out.split(' ')
-            else: ## Edge case for if a file name has spaces in it
-                operation = this_out.split(' ')[0]
-                fname = " ".join(this_out.split(' ')[1:-2])
-                date_copied = this_out.split(' ')[-2]
-                time_verified = this_out.split(' ')[-1]
-            
-            # Query log_sensor_file for this file, excluding rows whose
-            # parent log_task is incomplete (cancelled or crashed before
-            # _perform_task completed — neurobooth-os writes log_sensor_file
-            # rows at device-start time, so orphans exist with log_task.task_id
-            # IS NULL). The subquery piggybacks on Table.query()'s WHERE
-            # clause so we don't have to reach past the Table wrapper.
-            #
-            # NOTE: fname is interpolated into SQL via f-string here, matching
-            # the pre-existing pattern in this function. This is only safe
-            # because fname comes from rsync's controlled output over our own
-            # session directories. Do not adopt this pattern for user input.
-            df = sensor_file_table.query(
-                where=(f"sensor_file_path @> ARRAY['{fname}'] "
-                       f"AND log_task_id IN "
-                       f"(SELECT log_task_id FROM log_task "
-                       f"WHERE task_id IS NOT NULL)")
-            ).reset_index()
-
-            if len(df.log_sensor_file_id) > 0:
-                log_sensor_file_id = df.log_sensor_file_id[0]
-            else:
-                # files with these extensions are not tracked yet
-                untracked_extensions = ['xdf', 'txt', 'csv', 'jittered', 'asc', 'log']
-                if not any(ext in fname for ext in untracked_extensions):
-                    print(f'log_sensor_file_id not found for {fname}')
-                continue
-
-            # Block to check if file has been edited!
-            # If file has already been copied over, check if files match. If they do match - continue
-            # Else: the file has been edited - therefore, set is_finished to false and continue.
-            # We continue either way because we don't want to rewrite this file to table. The rsync for
-            # this session will proceed anyway outside this loop, and edited file will be copied over.
-            # Then update copy status will run, and update is_finished to true, and time_verified
-            # to when it checks hashes
-
-            # Check if file has already been copied over
-            qry = db_table.query(where=f"fname = '{fname}' and is_finished is True")
-            qry.reset_index(inplace=True)
-            if len(qry)==1:
-                # if it has, then check if files match
-                if _do_files_match(src_dir, dest_dir, fname):
-                    # if files match -> continue
-                    continue
-                else:
-                    # update is_finished to False for the copied but edited file
-                    db_table.insert_rows([(int(qry.operation_id[0]), False)],
-                                         ['operation_id', 'is_finished'],
-                                         on_conflict='update')
-                    # and then continue to prevent writing to db table
-                    continue
-
-            # Adding trailing slash before adding to database
-            dest_dir = os.path.join(dest_dir, '')
-            src_dir = os.path.join(src_dir, '')
-            # time verified is null, since file hasn't been copied over yet, nor copy status verified yet
-            db_rows.append((log_sensor_file_id, src_dir, dest_dir,
-                            fname, None, operation,
-                            False, False))
+    transfers = [_parse_rsync_line(this_out) for this_out in out]
+    transfers = [transfer for transfer in transfers if transfer is not None]
 
-    # insert files to table
-    db_table.insert_rows(db_rows, column_names)
-
-    # Ensuring trailing slash before rsyncing
+    # Adding trailing slash before adding to database and rsyncing
     dest_dir = os.path.join(dest_dir, '')
     src_dir = os.path.join(src_dir, '')
 
+    db_rows, copied = _get_log_file_rows(transfers, src_dir, dest_dir,
+                                         db_table, sensor_file_table)
+
+    # update is_finished to False for the copied but edited files
+    match = verify_pairs([pair for _, pair in copied], n_workers=n_workers,
+                         hash_cache=hash_cache)
+    edited_rows = [(operation_id, False) for operation_id, pair in copied
+                   if not match[pair]]
+    _insert_log_file_rows(db_table, db_rows, edited_rows)
+
     t1 = time.time()
     # XXX: If Python process dies or interrupts the rsync, then the rsync
     # transfer will be recorded in the db table with time_verified as null
@@ -291,16 +918,473 @@ def copy_files(src_dir, dest_dir, db_table, sensor_file_table):
     print(f'Time taken by rsync is {datetime.timedelta(seconds=(t2 - t1))} h:m:s')
 
     t1 = time.time()
-    _update_copystatus(db_table, show_unfinished=False)
+    _update_copystatus(db_table, show_unfinished=False, n_workers=n_workers,
+                       hash_cache=hash_cache, dest_dir=dest_dir)
     t2 = time.time()
     print(f'Time taken for individual hash checks is {datetime.timedelta(seconds=(t2 - t1))} h:m:s')
 
     return db_rows
 
 
+def get_volume_to_fill(volumes, threshold, free_volume_threshold=0,
+                       reserved=None):
+    """Get the most empty volume that has more than threshold bytes free.
+
+    Parameters
+    ----------
+    volumes : list of str
+        The paths to the volumes.
+    threshold : int
+        The number of bytes that must remain free on a volume.
+    free_volume_threshold : int
+        The copy is aborted if there are no more than free_volume_threshold
+        volumes with enough free space.
+    reserved : dict | None
+        The number of bytes already promised to sessions being copied to
+        each volume. They are counted as used.
+
+    Returns
+    -------
+    volume : str
+        The path to the volume to fill.
+    """
+    disk_usages = {vol: shutil.disk_usage(vol) for vol in volumes}
+    return _choose_volume(disk_usages, threshold, free_volume_threshold,
+                          reserved)
+
+
+def _choose_volume(disk_usages, threshold, free_volume_threshold=0,
+                   reserved=None):
+    """Get the most empty volume given the disk usage of the volumes."""
+    if reserved is None:
+        reserved = dict()
+
+    vol_disk_usage = {}
+    for vol, stats in disk_usages.items():
+        if stats.free - reserved.get(vol, 0) > threshold:
+            vol_disk_usage[vol] = stats.used + reserved.get(vol, 0)
+
+    if len(vol_disk_usage) <= free_volume_threshold:
+        raise ValueError(f'Only {len(vol_disk_usage)} available volume left, '
+                         'aborting copy till more volumes are added')
+
+    return min(vol_disk_usage, key=vol_disk_usage.get)
+
+
+def check_if_copied(session, volumes):
+    """Check if a session is already copied to one of the volumes.
+
+    Returns
+    -------
+    is_copied : bool
+        True if the session exists on one of the volumes.
+    session_path : str
+        The path to the session on the volume or '' if not copied.
+    """
+    for vol in volumes:
+        session_path = os.path.join(vol, session)
+        if os.path.exists(session_path):
+            return True, session_path
+    return False, ''
+
+
+class VolumeIndex:
+    """Index of the sessions and the disk usage of the volumes.
+
+    Each volume is listed once to know which sessions it contains, instead
+    of checking every session on every volume. The disk usage of the
+    volumes is cached for ttl seconds. The bytes of the sessions queued
+    for a volume are counted as used until they are released.
+
+    Parameters
+    ----------
+    volumes : list of str
+        The paths to the volumes.
+    ttl : float
+        The number of seconds the disk usage of a volume is cached.
+
+    Examples
+    --------
+    >>> index = VolumeIndex(volumes)
+    >>> volume = index.find(session)
+    >>> if volume is None:
+    ...     volume = index.get_volume_to_fill(threshold + n_bytes)
+    ...     index.reserve(volume, n_bytes)
+    """
+    def __init__(self, volumes, ttl=30.):
+        self.volumes = list(volumes)
+        self.ttl = ttl
+        self.reserved = {vol: 0 for vol in self.volumes}
+        self._disk_usages = dict()  # volume -> (time, disk usage)
+        self._sessions = dict()
+        self.refresh()
+
+    def __repr__(self):
+        return (f'VolumeIndex ({len(self.volumes)} volumes, '
+                f'{len(self._sessions)} sessions)')
+
+    def refresh(self):
+        """List the volumes again and forget the cached disk usage."""
+        sessions = dict()
+        # if a session is on several volumes, the first volume is used
+        for vol in reversed(self.volumes):
+            try:
+                with os.scandir(vol) as entries:
+                    sessions.update({entry.name: vol for entry in entries})
+            except FileNotFoundError:
+                warnings.warn(f'Volume {vol} not found')
+        self._sessions = sessions
+        self._disk_usages = dict()
+
+    def find(self, session):
+        """Get the volume a session is copied to.
+
+        Returns
+        -------
+        volume : str | None
+            The volume containing the session or None if not copied.
+        """
+        return self._sessions.get(session)
+
+    def add(self, session, volume):
+        """Record that a session is copied to a volume."""
+        self._sessions[session] = volume
+
+    def disk_usage(self, volume):
+        """Get the disk usage of a volume, cached for ttl seconds."""
+        now = time.monotonic()
+        if volume in self._disk_usages:
+            t_usage, stats = self._disk_usages[volume]
+            if now - t_usage < self.ttl:
+                return stats
+        stats = shutil.disk_usage(volume)
+        self._disk_usages[volume] = (now, stats)
+        return stats
+
+    def reserve(self, volume, n_bytes):
+        """Count n_bytes as used on a volume for a queued session."""
+        self.reserved[volume] = self.reserved.get(volume, 0) + n_bytes
+
+    def release(self, volume, n_bytes):
+        """Stop counting the bytes of a session that finished copying.
+
+        The disk usage of the volume is measured again, since the bytes
+        are now really used.
+        """
+        self.reserved[volume] = self.reserved.get(volume, 0) - n_bytes
+        self._disk_usages.pop(volume, None)
+
+    def get_volume_to_fill(self, threshold, free_volume_threshold=0,
+                           volumes=None):
+        """Get the most empty volume that has more than threshold bytes free.
+
+        The reserved bytes are counted as used. See get_volume_to_fill.
+
+        Parameters
+        ----------
+        threshold : int
+            The number of bytes that must remain free on a volume.
+        free_volume_threshold : int
+            A ValueError is raised if there are no more than
+            free_volume_threshold volumes with enough free space.
+        volumes : list of str | None
+            The volumes to choose from. If None, all the volumes.
+
+        Returns
+        -------
+        volume : str
+            The path to the volume to fill.
+        """
+        if volumes is None:
+            volumes = self.volumes
+        disk_usages = {vol: self.disk_usage(vol) for vol in volumes}
+        return _choose_volume(disk_usages, threshold, free_volume_threshold,
+                              self.reserved)
+
+
+def _get_dir_size(dirname):
+    """Get the total size of the files in a directory in bytes."""
+    size = 0
+    for entry in os.scandir(dirname):
+        if entry.is_dir(follow_symlinks=False):
+            size += _get_dir_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+def _copy_session(session, src_dir, dest_dir, db_args, table_id,
+                  sensor_file_table_id, n_workers, hash_cache_fname,
+                  single_pass):
+    """Copy a session in a worker process with its own connection."""
+    t1 = time.time()
+    result = dict(session=session, dest_dir=dest_dir, n_files=None,
+                  error=None)
+    hash_cache = None
+    try:
+        if hash_cache_fname is not None:
+            hash_cache = HashCache(hash_cache_fname)
+        with psycopg2.connect(**db_args) as conn:
+            db_table = Table(table_id, conn)
+            sensor_file_table = Table(sensor_file_table_id, conn)
+            # the unfinished copies of all the sessions were recovered by
+            # copy_sessions before the workers started
+            db_rows = copy_files(os.path.join(src_dir, session), dest_dir,
+                                 db_table, sensor_file_table,
+                                 n_workers=n_workers, hash_cache=hash_cache,
+                                 single_pass=single_pass, recover_all=False)
+        conn.close()
+        result['n_files'] = len(db_rows)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+    result['duration'] = time.time() - t1
+    return result
+
+
+def copy_sessions(sessions, src_dir, volumes, db_args, reserve_threshold,
+                  n_jobs=4, max_jobs_per_volume=1, free_volume_threshold=0,
+                  table_id='log_file', sensor_file_table_id='log_sensor_file',
+                  n_workers=4, hash_cache_fname=None, single_pass=False,
+                  dry_run=False):
+    """Copy several sessions at the same time in separate processes.
+
+    Sessions already copied to a volume are copied to the same volume. New
+    sessions go to the most empty volume. The size of the sessions being
+    copied is counted as used on their volume, so that sessions copied at
+    the same time do not all choose the same volume.
+
+    Before copying, the unfinished copies left by previous runs are
+    verified once for all the destinations. Each worker then only checks
+    the copies of its own session.
+
+    The workers are started with the spawn method, so that they do not
+    inherit the threads of the parent process, e.g., of an SSH tunnel.
+    Scripts calling copy_sessions must therefore be protected with
+    ``if __name__ == '__main__':``.
+
+    Parameters
+    ----------
+    sessions : list of str
+        The names of the session directories in src_dir.
+    src_dir : str
+        The source directory, e.g., the NAS.
+    volumes : list of str
+        The paths to the destination volumes.
+    db_args : dict
+        The arguments to psycopg2.connect. Each worker opens its own
+        connection.
+    reserve_threshold : int
+        The number of bytes that must remain free on a volume.
+    n_jobs : int
+        The maximum number of sessions copied at the same time.
+    max_jobs_per_volume : int
+        The maximum number of sessions copied to a volume at the same time.
+    free_volume_threshold : int
+        No new session is copied if there are no more than
+        free_volume_threshold volumes with enough free space.
+    table_id : str
+        The table containing information about the file transfers.
+    sensor_file_table_id : str
+        The table containing information about the sensor files.
+    n_workers : int
+        The number of files hashed in parallel by each worker.
+    hash_cache_fname : str | None
+        The path to the SQLite database of a HashCache shared by the
+        workers. If None, no hashes are cached.
+    single_pass : bool
+        If True, copy each session with a single rsync. See copy_files.
+    dry_run : bool
+        If True, only plan where the sessions would be copied.
+
+    Returns
+    -------
+    results : list of dict
+        The results of each session with the keys session, dest_dir,
+        n_files (the number of new files), duration (in seconds) and error
+        (None if the copy succeeded). The sessions that could not be
+        scheduled because no volume has enough free space are reported
+        with an error.
+    """
+    pending = list(sessions)
+    results = list()
+    running = dict()  # future -> (session, dest_dir, volume, reserved bytes)
+    jobs_per_volume = {vol: 0 for vol in volumes}
+    volume_index = VolumeIndex(volumes)
+    session_sizes = dict()  # the sessions are only walked once
+    error = None
+
+    if not dry_run:
+        # recover the copies of all the sessions once, since the workers
+        # only recover the copies of their own session
+        hash_cache = None
+        if hash_cache_fname is not None:
+            hash_cache = HashCache(hash_cache_fname)
+        try:
+            with psycopg2.connect(**db_args) as conn:
+                _update_copystatus(Table(table_id, conn), show_unfinished=True,
+                                   n_workers=n_workers, hash_cache=hash_cache)
+            conn.close()
+        finally:
+            if hash_cache is not None:
+                hash_cache.close()
+
+    # spawn instead of fork so that the workers do not inherit the threads
+    # of this process, and open their own connection
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             mp_context=mp_context) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # schedule the sessions whose volume has a free slot
+            for session in list(pending):
+                if len(running) >= n_jobs or error is not None:
+                    break
+
+                volume = volume_index.find(session)
+                n_bytes = 0
+                if volume is None:
+                    available = [vol for vol in volumes if
+                                 jobs_per_volume[vol] < max_jobs_per_volume]
+                    if len(available) == 0:
+                        break  # wait for a free slot
+
+                    if session not in session_sizes:
+                        session_sizes[session] = _get_dir_size(
+                            os.path.join(src_dir, session))
+                    n_bytes = session_sizes[session]
+                    threshold = reserve_threshold + n_bytes
+                    try:
+                        # the free volumes are counted over all the volumes,
+                        # including those busy copying other sessions
+                        volume_index.get_volume_to_fill(
+                            threshold, free_volume_threshold)
+                    except ValueError as e:
+                        if len(running) > 0:
+                            break  # the reserved bytes may be released
+                        # stop scheduling, no session can be copied
+                        error = e
+                        break
+                    try:
+                        volume = volume_index.get_volume_to_fill(
+                            threshold, volumes=available)
+                    except ValueError:
+                        continue  # wait for a volume with enough space
+                dest_dir = os.path.join(volume, session)
+
+                if jobs_per_volume.get(volume, 0) >= max_jobs_per_volume:
+                    continue  # try again when the volume is free
+
+                pending.remove(session)
+                # the queued sessions count as used space on their volume
+                volume_index.add(session, volume)
+                volume_index.reserve(volume, n_bytes)
+                if dry_run:
+                    print(f'{session} would be copied to {dest_dir}')
+                    results.append(dict(session=session, dest_dir=dest_dir,
+                                        n_files=None, duration=0.,
+                                        error=None))
+                    continue
+
+                print(f'copying session {session} to {dest_dir}')
+                future = executor.submit(
+                    _copy_session, session, src_dir, dest_dir, db_args,
+                    table_id, sensor_file_table_id, n_workers,
+                    hash_cache_fname, single_pass)
+                running[future] = (session, dest_dir, volume, n_bytes)
+                jobs_per_volume[volume] = jobs_per_volume.get(volume, 0) + 1
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                session, dest_dir, volume, n_bytes = running.pop(future)
+                jobs_per_volume[volume] -= 1
+                volume_index.release(volume, n_bytes)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # e.g., the worker process died
+                    result = dict(session=session, dest_dir=dest_dir,
+                                  n_files=None, duration=None,
+                                  error=f'{type(e).__name__}: {e}')
+                if result['error'] is not None:
+                    print(f'copying session {result["session"]} failed: '
+                          f'{result["error"]}')
+                results.append(result)
+
+    if error is not None:
+        warnings.warn(f'{len(pending)} sessions were not copied: {error}')
+        for session in pending:
+            results.append(dict(session=session, dest_dir=None, n_files=None,
+                                duration=None, error=f'ValueError: {error}'))
+    return results
+
+
+def _remove_file(fname, dry_run=False):
+    """Remove a file.
+
+    Returns
+    -------
+    error : OSError | None
+        The error if the file could not be removed, e.g., because it does
+        not exist, else None. Errors are returned instead of raised so that
+        the other files removed at the same time are still recorded.
+    """
+    if dry_run:
+        if not os.path.exists(fname):
+            return FileNotFoundError(f'No such file: {fname}')
+        return None
+    try:
+        os.remove(fname)
+    except OSError as e:
+        return e
+    return None
+
+
+def _stat_file(fname):
+    """Get the size and modification time of a file or None if missing."""
+    try:
+        stat = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def _plan_deletion(fnames, bytes_to_free, n_workers=8):
+    """Choose the files to delete to free bytes_to_free bytes.
+
+    Files are ranked from the oldest to the newest, and the largest
+    first among files of the same age.
+
+    Returns
+    -------
+    planned_fnames : dict
+        The size of the files to delete keyed by file name.
+    planned_bytes : int
+        The number of bytes that the planned files take.
+    """
+    fnames = list(fnames)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        stats = dict(zip(fnames, executor.map(_stat_file, fnames)))
+    # missing files free nothing, the deletion reports them
+    candidates = sorted((stat[1], -stat[0], fname)
+                        for fname, stat in stats.items() if stat is not None)
+
+    planned_fnames, planned_bytes = dict(), 0
+    for _, neg_size, fname in candidates:
+        if planned_bytes >= bytes_to_free:
+            break
+        planned_fnames[fname] = -neg_size
+        planned_bytes -= neg_size
+    return planned_fnames, planned_bytes
+
+
 def delete_files(db_table, target_dir, suitable_dest_dirs,
                  threshold=0.85, record_older_than=45, copied_older_than=30,
-                 dry_run=True):
+                 low_water_mark=None, n_workers=8, dry_run=True):
     """Delete files if x% of disk is filled.
 
         Delete files from NAS (source directory) when x% of NAS is filled.
@@ -333,10 +1417,23 @@ def delete_files(db_table, target_dir, suitable_dest_dirs,
         If a file is older than record_older_than days in src_dir and
         copied_older_than in any of suitable_dest_dirs, they will be
         deleted.
+    low_water_mark : float | None
+        A fraction between 0. and threshold. If not None, only the oldest
+        files are deleted, and the largest first among files of the same
+        age, until the source directory is less than low_water_mark
+        filled. If None, all the files that can be deleted are deleted.
+    n_workers : int
+        The number of files examined and deleted in parallel.
     dry_run : boolean
         If True, will run all the database operations but not actually
         delete the files.
 
+    Returns
+    -------
+    deleted_ids : list
+        The operation_id of the files deleted, or of the files that would
+        be deleted if dry_run is True.
+
     Notes
     -----
     Let's say the data was written to "NAS", then copied to "who"
@@ -371,6 +1468,10 @@ def delete_files(db_table, target_dir, suitable_dest_dirs,
 
     """
 
+    if low_water_mark is not None and not 0. <= low_water_mark <= threshold:
+        raise ValueError(f'low_water_mark must be between 0 and threshold '
+                         f'({threshold}). Got {low_water_mark}')
+
     if dry_run:
         print('This is a dry run - nothing will be deleted')
     else:
@@ -390,7 +1491,7 @@ def delete_files(db_table, target_dir, suitable_dest_dirs,
 
     if fraction_occupied < threshold:
         print('Threshold not reached: nothing to delete')
-        return
+        return list()
 
     ### Query for files in NAS that are older than 45 days and need to be deleted ###
     # These are write operation files, where src_dirname is null and 
@@ -401,79 +1502,141 @@ def delete_files(db_table, target_dir, suitable_dest_dirs,
     # The is_finished will always be Null because these files are copied
     # from CTR/ACQ/STM to NAS via ROBOCOPY and we do not check if hashes match
     # (i.e. we treat these files and NAS as source)
-    where = f"position('{target_dir}' in dest_dirname)>0 "
-    where += f"AND EXTRACT(EPOCH FROM (current_timestamp - time_verified)) > {record_older_than} "
+    where = "position(%s in dest_dirname)>0 "
+    where += "AND EXTRACT(EPOCH FROM (current_timestamp - time_verified)) > %s "
     # is_finished will be True if source is different than NAS - change query to generalize
     where += "AND is_deleted=False AND is_finished is null"
-    fnames_to_delete_df = db_table.query(where=where)
+    where_to_delete = where
+    params_to_delete = (target_dir, record_older_than)
 
     ### Query for subset of files from above that got copied to destination 30 days ago ###
     # dest_dirname is either of suitable_dest, src_dirname is not null (i.e. is NAS,
     # but could be an alternate source as well), is_deleted is False (because redundancy),
     # is_finished is True - i.e. copied successfully with hash check, and age is older
     # than 30 days
-    volume_qry_conditions = [f"position('{vol}' in dest_dirname) > 0" for vol in volumes]
+    volume_qry_conditions = ["position(%s in dest_dirname) > 0"] * len(volumes)
     where = '(' + ' OR '.join(volume_qry_conditions) + ') '
     # src_dirname should be {target_dir} - change query to generalize
     where += f"AND src_dirname IS NOT NULL " # exclude write operations
     where += "AND is_deleted=False AND is_finished=True " # just to be safe
-    where += f"AND EXTRACT(EPOCH FROM (current_timestamp - time_verified)) > {copied_older_than}"
-    fnames_transferred_df = db_table.query(where=where)
+    where += "AND EXTRACT(EPOCH FROM (current_timestamp - time_verified)) > %s"
+    params = tuple(volumes) + (copied_older_than,)
+
+    # Only the file names of transferred files are needed. They are streamed
+    # in chunks since the log_file table can have millions of rows.
+    # The session prefix is removed and only the filename is retained.
+    fnames_transferred = set()
+    for fnames_transferred_df in db_table.iter_query(include_columns='fname',
+                                                     where=where, params=params):
+        fnames_transferred.update(
+            fnames_transferred_df.fname.apply(lambda x: os.path.split(x)[-1]))
 
     ### Find the union between files that need to be deleted and files that are successfully transferred ###
-    # removing session prefix and retaining only filename in fname column
-    fnames_to_delete_df['fname'] = fnames_to_delete_df.fname.apply(lambda x: os.path.split(x)[-1])
-    fnames_transferred_df['fname'] = fnames_transferred_df.fname.apply(lambda x: os.path.split(x)[-1])
-
-    # resetting index on fnames_to_delte_df to make index:operation_id
-    # as its own separate column
-    fnames_to_delete_df.reset_index(inplace=True)
-
     # Removing all columns that are not needed for delete operation
     delete_cols_to_keep = ['operation_id', 'fname', 'dest_dirname']
-    fnames_to_delete_df = fnames_to_delete_df[delete_cols_to_keep]
-    transferred_cols_to_keep = ['fname'] # Only need 'fname' from transferred_df
-    fnames_transferred_df = fnames_transferred_df[transferred_cols_to_keep]
-
-    # finding union between sets via an inner join
-    files_to_delete_union_df = fnames_to_delete_df.merge(fnames_transferred_df,
-                                                         how='inner',
-                                                         left_on='fname',
-                                                         right_on='fname')
+    files_to_delete = list()
+    for fnames_to_delete_df in db_table.iter_query(
+            include_columns=delete_cols_to_keep, where=where_to_delete,
+            params=params_to_delete):
+        # removing session prefix and retaining only filename in fname column
+        fnames_to_delete_df['fname'] = fnames_to_delete_df.fname.apply(lambda x: os.path.split(x)[-1])
+        is_transferred = fnames_to_delete_df.fname.isin(fnames_transferred)
+        fnames_to_delete_df = fnames_to_delete_df[is_transferred]
+        files_to_delete.extend(zip(fnames_to_delete_df.index,
+                                   fnames_to_delete_df.fname,
+                                   fnames_to_delete_df.dest_dirname))
+
+    if low_water_mark is not None:
+        # only delete enough files to get below the low water mark
+        bytes_to_free = stats.used - int(low_water_mark * stats.total)
+        planned_fnames, planned_bytes = _plan_deletion(
+            {os.path.join(dest_dirname, fname)
+             for _, fname, dest_dirname in files_to_delete},
+            bytes_to_free, n_workers=n_workers)
+        files_to_delete = [
+            (operation_id, fname, dest_dirname)
+            for operation_id, fname, dest_dirname in files_to_delete
+            if os.path.join(dest_dirname, fname) in planned_fnames]
+        print(f'Low water mark is set at: {(low_water_mark*100):.2f}%')
+        print(f'Planned to free {planned_bytes / GIGABYTE:.2f} GB of the '
+              f'{bytes_to_free / GIGABYTE:.2f} GB needed, with '
+              f'{len(planned_fnames)} files')
+        if planned_bytes < bytes_to_free:
+            warnings.warn('Not enough files can be deleted to reach the '
+                          'low water mark')
+
+    if len(files_to_delete) == 0:
+        print('No files to delete')
+        return list()
 
     ### Deleting files ###
-    for ix, files_row in files_to_delete_union_df.iterrows():
-
-        operation_id = files_row.operation_id
-        fname = os.path.join(files_row.dest_dirname, files_row.fname)
-
-        if os.path.exists(fname):
-            ### Check by querying row by operation_id
-            where = f'operation_id={operation_id}'
-            assert_df = db_table.query(where=where)
+    # The candidate rows are locked until the transaction ends so that they
+    # cannot be changed between the checks, the deletion and the update.
+    table_id = db_table.table_id
+    operation_ids = [operation_id for operation_id, _, _ in files_to_delete]
+    with transaction(db_table.conn):
+        assert_df = query(
+            db_table.conn,
+            f'SELECT operation_id, fname, dest_dirname, is_deleted, '
+            f'is_finished FROM {table_id} WHERE operation_id = ANY(%s) '
+            f'ORDER BY operation_id FOR UPDATE;',
+            ['operation_id', 'fname', 'dest_dirname', 'is_deleted',
+             'is_finished'], params=(operation_ids,)).set_index('operation_id')
+
+        files_checked = list()
+        for operation_id, fname, dest_dirname in files_to_delete:
+            fname = os.path.join(dest_dirname, fname)
             if (
                 # confirm that we only ever get one row,
                 # should always be true since operation_id is a primary key
-                len(assert_df)==1
+                operation_id in assert_df.index
                 # confirm that fname from db matches fname that will be deleted
-                and os.path.split(fname)[-1] == os.path.split(assert_df.fname.iloc[0])[-1]
+                and os.path.split(fname)[-1] == os.path.split(assert_df.fname[operation_id])[-1]
                 # confirm that target dir is in dest_dirname of db record
-                and assert_df.dest_dirname.iloc[0].startswith(target_dir)
+                and assert_df.dest_dirname[operation_id].startswith(target_dir)
                 # confirm that is_deleted is False for the file, since file is yet to be deleted
-                and assert_df.is_deleted.iloc[0]==False
+                and assert_df.is_deleted[operation_id] == False
                 # confirm that is_finished is None, since we are deleting from NAS
                 # change this condition to generalize - this should be True for non NAS
-                and assert_df.is_finished.iloc[0]==None
+                and assert_df.is_finished[operation_id] is None
                 ):
+                files_checked.append((operation_id, fname))
+            else:
+                row = assert_df.loc[[operation_id]] if operation_id in \
+                    assert_df.index else None
+                print(f'Query or checks on operation_id {operation_id} failed before delete: {row}')
+
+        # unlinking a file on the NAS is mostly waiting on the network.
+        # Several rows can point to the same file, which is removed once.
+        fnames = list(dict.fromkeys(fname for _, fname in files_checked))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            errors = dict(zip(fnames, executor.map(
+                _remove_file, fnames, [dry_run] * len(fnames))))
+        is_removed = {fname: error is None for fname, error in errors.items()}
+
+        deleted_ids = list()
+        for operation_id, fname in files_checked:
+            if is_removed[fname]:
                 print(f'Deleting ... {fname}')
-                if not dry_run:
-                    os.remove(fname)
-                    db_table.insert_rows([(operation_id, True,)],
-                                        cols=['operation_id', 'is_deleted'],
-                                        on_conflict='update')
+                deleted_ids.append(operation_id)
+            # This else condition triggers in case files were moved to an alternate location/deleted
+            elif isinstance(errors[fname], FileNotFoundError):
+                print(f'File not found while deleting ... {fname}')
             else:
-                print(f'Query or checks on operation_id {operation_id} failed before delete: {assert_df}')
-        # This else condition triggers in case files were moved to an alternate location/deleted
-        else:
-            print(f'File not found while deleting ... {fname}')
+                print(f'Failed to delete {fname}: {errors[fname]}')
+
+        # only the files that were actually removed are marked as deleted
+        if not dry_run and len(deleted_ids) > 0:
+            execute(db_table.conn, db_table.cursor,
+                    f'UPDATE {table_id} SET is_deleted=True '
+                    f'WHERE operation_id = ANY(%s);', params=(deleted_ids,))
+
+    if low_water_mark is not None:
+        freed_bytes = sum(planned_fnames[fname] for fname in fnames
+                          if is_removed[fname])
+        verb = 'Would have freed' if dry_run else 'Freed'
+        print(f'{verb} {freed_bytes / GIGABYTE:.2f} GB of the '
+              f'{planned_bytes / GIGABYTE:.2f} GB planned')
+
+    return deleted_ids
 
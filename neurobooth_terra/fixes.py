@@ -3,28 +3,51 @@ import socket
 from sshtunnel import SSHTunnelForwarder
 
 
+def _on_neurodoor():
+    """Check if we are already on neurodoor."""
+    return socket.gethostname() in ('neurodoor.nmr.mgh.harvard.edu',
+                                    'neurodoor2.nmr.mgh.harvard.edu')
+
+
 class OptionalSSHTunnelForwarder(SSHTunnelForwarder):
     """SSH tunneling, skipped if already on neurodoor."""
 
     def __enter__(self):
-        if (socket.gethostname() == 'neurodoor.nmr.mgh.harvard.edu') or (socket.gethostname() == 'neurodoor2.nmr.mgh.harvard.edu'):
+        if _on_neurodoor():
             return self
         return SSHTunnelForwarder.__enter__(self)
 
+    def start(self):
+        if _on_neurodoor():
+            return
+        return super(OptionalSSHTunnelForwarder, self).start()
+
+    def stop(self, force=False):
+        if _on_neurodoor():
+            return
+        return super(OptionalSSHTunnelForwarder, self).stop(force=force)
+
+    @property
+    def is_connected(self):
+        """True if the tunnel is up or not needed."""
+        if _on_neurodoor():
+            return True
+        return self.is_active
+
     @property
     def local_bind_port(self):
-        if socket.gethostname() == 'neurodoor.nmr.mgh.harvard.edu' or (socket.gethostname() == 'neurodoor2.nmr.mgh.harvard.edu'):
+        if _on_neurodoor():
             return '5432'
         return super(OptionalSSHTunnelForwarder, self).local_bind_port
 
     @property
     def local_bind_host(self):
-        if socket.gethostname() == 'neurodoor.nmr.mgh.harvard.edu' or (socket.gethostname() == 'neurodoor2.nmr.mgh.harvard.edu'):
+        if _on_neurodoor():
             return 'localhost'
         return super(OptionalSSHTunnelForwarder, self).local_bind_host
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if socket.gethostname() == 'neurodoor.nmr.mgh.harvard.edu' or (socket.gethostname() == 'neurodoor2.nmr.mgh.harvard.edu'):
+        if _on_neurodoor():
             return False
         return SSHTunnelForwarder.__exit__(self, exc_type, exc_value,
                                            traceback)
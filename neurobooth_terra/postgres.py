@@ -1,6 +1,16 @@
 # Authors: Mainak Jas <mjas@mgh.harvard.edu>
 #        : Siddharth Patel <spatel136@mgh.harvard.edu>
 
+import io
+import re
+import json
+import time
+import hashlib
+import weakref
+import datetime
+import uuid
+from contextlib import contextmanager
+
 import pandas as pd
 
 import psycopg2
@@ -12,16 +22,307 @@ import psycopg2.extras as extras
 
 #### Monkeypatch psycopg2 functions ####
 
-def execute(conn, cursor, cmd, fetch=False):
-    cursor.execute(cmd)
-    conn.commit()
+# ids of connections that are inside a transaction block
+_transaction_conns = set()
+
+
+def _commit(conn):
+    """Commit unless the connection is inside a transaction block."""
+    if id(conn) not in _transaction_conns:
+        conn.commit()
+
+
+@contextmanager
+def transaction(conn):
+    """Run statements on a connection in a single transaction.
+
+    Inside the block, the commit after each statement is skipped. The
+    transaction is committed when the block exits, or rolled back if an
+    exception is raised. Nested blocks are part of the outermost
+    transaction. On rollback, the cached schema of the tables is
+    invalidated since it may include tables created or altered in the
+    block.
+
+    Parameters
+    ----------
+    conn : instance of psycopg2.Postgres
+        The connection object
+
+    Examples
+    --------
+    >>> with transaction(conn):
+    ...     for row in rows:
+    ...         table.insert_rows([row], cols)
+    """
+    if id(conn) in _transaction_conns:  # nested
+        yield conn
+        return
+
+    _transaction_conns.add(id(conn))
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        invalidate_schema_cache(conn)
+        raise
+    else:
+        conn.commit()
+    finally:
+        _transaction_conns.discard(id(conn))
+
+
+# names of the statements prepared on each connection
+_prepared_statements = weakref.WeakKeyDictionary()
+_PLACEHOLDER_PATTERN = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def _prepare(conn, cursor, cmd, params=None):
+    """Prepare a statement once per connection.
+
+    Returns
+    -------
+    execute_cmd : str
+        The EXECUTE command of the prepared statement.
+    execute_params : tuple
+        The parameters bound to the placeholders of execute_cmd.
+    """
+    # %s and %(name)s placeholders are numbered as $1, $2, ...
+    names, positions = list(), dict()
+
+    def _replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is None:
+            names.append(len(names))
+            return f'${len(names)}'
+        if match.group(1) not in positions:
+            names.append(match.group(1))
+            positions[match.group(1)] = len(names)
+        return f'${positions[match.group(1)]}'
+
+    statement = cmd
+    if params is not None:  # otherwise % are not placeholders
+        statement = _PLACEHOLDER_PATTERN.sub(_replace, statement)
+    statement = statement.rstrip().rstrip(';')
+    name = 'terra_' + hashlib.sha1(statement.encode()).hexdigest()[:16]
+
+    prepared = _prepared_statements.setdefault(conn, set())
+    if name not in prepared:
+        cursor.execute(f'PREPARE {name} AS {statement}')
+        prepared.add(name)
+
+    if len(names) == 0:
+        return f'EXECUTE {name}', None
+    if isinstance(params, dict):
+        execute_params = tuple(params[this_name] for this_name in names)
+    else:
+        execute_params = tuple(params)
+    placeholders = ', '.join(['%s'] * len(execute_params))
+    return f'EXECUTE {name} ({placeholders})', execute_params
+
+
+def execute(conn, cursor, cmd, fetch=False, params=None, prepare=False):
+    if prepare:
+        cmd, params = _prepare(conn, cursor, cmd, params)
+    cursor.execute(cmd, params)
+    _commit(conn)
     if fetch:
         return cursor.fetchall()
 
 
+# The operators of structured filters
+_FILTER_OPERATORS = {'=': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>',
+                     '>=': '>=', 'like': 'LIKE', 'in': '= ANY',
+                     'not in': '<> ALL'}
+
+
+def build_where(where, params=None):
+    """Build the condition of a WHERE clause with bound parameters.
+
+    Parameters
+    ----------
+    where : str | dict | None
+        The condition. If str, it is used as is with the %s or %(name)s
+        placeholders bound to params. If dict, a structured filter that
+        maps column names to:
+
+        - a value: the column is equal to the value, or NULL if None
+        - a list, tuple or set: the column is one of the values
+        - a dict of operators to values, e.g., ``{'>=': 5, '<': 10}``.
+          The operators are =, !=, <, <=, >, >=, like, in and not in.
+
+        The conditions on the columns are combined with AND.
+    params : tuple | dict | None
+        The parameters bound to the placeholders of where if it is a str.
+
+    Returns
+    -------
+    condition : str | None
+        The condition with placeholders.
+    params : list | tuple | dict | None
+        The parameters bound to the placeholders of condition.
+
+    Examples
+    --------
+    >>> build_where({'subject_id': ['100001', '100002'],
+    ...              'date': {'>=': '2024-01-01'}, 'is_deleted': False})
+    ('"subject_id" = ANY(%s) AND "date" >= %s AND "is_deleted" = %s',
+     [['100001', '100002'], '2024-01-01', False])
+    """
+    if where is None or isinstance(where, str):
+        return where, params
+    if not isinstance(where, dict):
+        raise ValueError(f'where must be a str, dict or None. Got {type(where)}')
+    if params is not None:
+        raise ValueError('params can only be used when where is a str')
+
+    conditions, params = list(), list()
+    for col, val in where.items():
+        if isinstance(val, dict):
+            ops = val.items()
+        elif isinstance(val, (list, tuple, set)):
+            ops = [('in', val)]
+        else:
+            ops = [('=', val)]
+        for op, this_val in ops:
+            op = op.lower()
+            if op not in _FILTER_OPERATORS:
+                raise ValueError(f'operator must be one of '
+                                 f'{list(_FILTER_OPERATORS)}. Got {op}')
+            if this_val is None and op in ('=', '!='):
+                is_not = ' NOT' if op == '!=' else ''
+                conditions.append(f'"{col}" IS{is_not} NULL')
+                continue
+            if op in ('in', 'not in'):
+                conditions.append(f'"{col}" {_FILTER_OPERATORS[op]}(%s)')
+                this_val = list(this_val)
+            else:
+                conditions.append(f'"{col}" {_FILTER_OPERATORS[op]} %s')
+            params.append(this_val)
+    if len(conditions) == 0:
+        return None, None
+    return ' AND '.join(conditions), params
+
+
 def _execute_batch(conn, cursor, cmd, tuples, page_size=100):
     extras.execute_batch(cursor, cmd, tuples, page_size)
-    conn.commit()
+    _commit(conn)
+
+
+def execute_values(conn, cursor, cmd, tuples, template=None, page_size=1000,
+                   fetch=False):
+    """Execute a command with a VALUES list built from many rows.
+
+    Parameters
+    ----------
+    conn : instance of psycopg2.Postgres
+        The connection object
+    cursor : instance of psycopg2.cursor
+        The cursor object
+    cmd : str
+        The command with a single ``%s`` placeholder for the VALUES list,
+        e.g., ``UPDATE t SET a=v.a FROM (VALUES %s) AS v(id, a) WHERE t.id=v.id``.
+    tuples : list of tuple
+        The rows of the VALUES list.
+    template : str | None
+        The template of a row, e.g., ``(%s, %s::timestamp)``.
+    page_size : int
+        The maximum number of rows in one statement.
+    fetch : bool
+        If True, return the rows returned by the command.
+    """
+    out = extras.execute_values(cursor, cmd, tuples, template=template,
+                                page_size=page_size, fetch=fetch)
+    _commit(conn)
+    if fetch:
+        return out
+
+
+def _format_copy_element(val):
+    """Format an array element for a Postgres array literal."""
+    if val is None:
+        return 'NULL'
+    if isinstance(val, (list, tuple)):
+        return '{' + ','.join(_format_copy_element(v) for v in val) + '}'
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        return str(val)
+    val = _format_copy_value(val)
+    val = val.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{val}"'
+
+
+def _format_copy_value(val):
+    """Format a Python value as text understood by Postgres."""
+    if isinstance(val, str):
+        return val
+    if isinstance(val, extras.Json):
+        return json.dumps(val.adapted)
+    if isinstance(val, dict):
+        return json.dumps(val)
+    if isinstance(val, bool):
+        return 't' if val else 'f'
+    if isinstance(val, (list, tuple)):
+        return _format_copy_element(val)
+    if isinstance(val, (datetime.datetime, datetime.date, datetime.time)):
+        return val.isoformat()
+    return str(val)
+
+
+def _format_copy_row(val):
+    """Serialize a row into a line of COPY ... FROM STDIN text format."""
+    line = list()
+    for this_val in val:
+        if this_val is None or (isinstance(this_val, float) and
+                                this_val != this_val):  # NaN
+            line.append('\\N')
+            continue
+        this_val = _format_copy_value(this_val)
+        this_val = (this_val.replace('\\', '\\\\')
+                            .replace('\t', '\\t')
+                            .replace('\n', '\\n')
+                            .replace('\r', '\\r'))
+        line.append(this_val)
+    return '\t'.join(line) + '\n'
+
+
+class _CopyReader:
+    """File-like object that serializes rows lazily for COPY."""
+
+    def __init__(self, vals):
+        self._lines = (_format_copy_row(val) for val in vals)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks, n_chars = [self._buffer], len(self._buffer)
+        for line in self._lines:
+            chunks.append(line)
+            n_chars += len(line)
+            if 0 <= size <= n_chars:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def _copy_from(conn, cursor, table_id, cols, vals, merge_cmd, fetch=False):
+    """Stream rows into a staging table and merge them into table_id.
+
+    The placeholder ``{staging}`` in merge_cmd is replaced with the name of
+    the staging table. merge_cmd should select from it into the target table.
+    """
+    staging = f'_staging_{table_id}'
+    cursor.execute(f'DROP TABLE IF EXISTS "{staging}"')
+    cursor.execute(f'CREATE TEMP TABLE "{staging}" AS SELECT {cols} '
+                   f'FROM {table_id} WITH NO DATA')
+    cursor.copy_expert(f'COPY "{staging}" ({cols}) FROM STDIN',
+                       _CopyReader(vals))
+    cursor.execute(merge_cmd.replace('{staging}', f'"{staging}"'))
+    result = cursor.fetchall() if fetch else None
+    cursor.execute(f'DROP TABLE "{staging}"')
+    _commit(conn)
+    return result
 
 
 def _get_primary_keys(conn, cursor, table_id):
@@ -38,6 +339,109 @@ def _get_primary_keys(conn, cursor, table_id):
     return primary_keys
 
 
+def _get_column_types(conn, cursor, table_id):
+    """Get the full SQL type of each column, e.g., text[] or varchar(255)."""
+    query = (
+    "SELECT a.attname, format_type(a.atttypid, a.atttypmod) "
+    "FROM   pg_attribute a "
+    f"WHERE  a.attrelid = '{table_id}'::regclass "
+    "AND    a.attnum > 0 AND NOT a.attisdropped;"
+    )
+    return dict(execute(conn, cursor, query, fetch=True))
+
+
+# Process-wide cache of the column names, data types and primary keys
+# of tables, keyed by the connection dsn. Entries older than
+# SCHEMA_CACHE_TTL seconds are reloaded. If None, they never expire.
+SCHEMA_CACHE_TTL = None
+_schema_cache = dict()
+
+
+def _load_schema(conn, cursor, table_id=None):
+    """Query the schema of all the tables (or table_id) at once."""
+    cmd = (
+        "SELECT c.table_name, c.column_name, c.data_type, "
+        "c.character_maximum_length, pk.attname IS NOT NULL, "
+        "format_type(ca.atttypid, ca.atttypmod) "
+        "FROM INFORMATION_SCHEMA.COLUMNS c "
+        "JOIN pg_namespace cn ON cn.nspname = c.table_schema "
+        "JOIN pg_class cc ON cc.relname = c.table_name "
+                        "AND cc.relnamespace = cn.oid "
+        "JOIN pg_attribute ca ON ca.attrelid = cc.oid "
+                            "AND ca.attname = c.column_name "
+        "LEFT JOIN (SELECT n.nspname, cl.relname, a.attname "
+                   "FROM pg_index i "
+                   "JOIN pg_class cl ON cl.oid = i.indrelid "
+                   "JOIN pg_namespace n ON n.oid = cl.relnamespace "
+                   "JOIN pg_attribute a ON a.attrelid = i.indrelid "
+                                      "AND a.attnum = ANY(i.indkey) "
+                   "WHERE i.indisprimary) pk "
+        "ON pk.nspname = c.table_schema AND pk.relname = c.table_name "
+        "AND pk.attname = c.column_name "
+        "WHERE c.table_schema NOT IN ('pg_catalog', 'information_schema') "
+    )
+    if table_id is not None:
+        cmd += f"AND c.table_name = '{table_id}' "
+    cmd += "ORDER BY c.table_name, c.ordinal_position;"
+    columns = execute(conn, cursor, cmd, fetch=True)
+
+    schema = dict()
+    for (table_name, column_name, dtype, maxlen, is_primary,
+         column_type) in columns:
+        if table_name not in schema:
+            schema[table_name] = {'column_names': list(), 'data_types': list(),
+                                  'primary_key': list(),
+                                  'column_types': dict()}
+        if dtype == 'character varying':
+            dtype = f'VARCHAR ({maxlen})'
+        schema[table_name]['column_names'].append(column_name)
+        schema[table_name]['data_types'].append(dtype.upper())
+        # the full type, e.g., text[] instead of ARRAY
+        schema[table_name]['column_types'][column_name] = column_type
+        if is_primary:
+            schema[table_name]['primary_key'].append(column_name)
+    return schema
+
+
+def _get_schema(conn, cursor, table_id):
+    """Get the schema of a table from the cache.
+
+    The schema of all the tables is loaded with the first call
+    on a database. Tables missing from the cache are loaded individually.
+    Returns None if the table does not exist.
+    """
+    cache = _schema_cache.get(conn.dsn)
+    if cache is None or (SCHEMA_CACHE_TTL is not None and
+                         time.time() - cache['time'] > SCHEMA_CACHE_TTL):
+        cache = {'time': time.time(), 'tables': _load_schema(conn, cursor)}
+        _schema_cache[conn.dsn] = cache
+    if table_id not in cache['tables']:
+        cache['tables'].update(_load_schema(conn, cursor, table_id))
+    schema = cache['tables'].get(table_id)
+    if schema is not None:  # copy so that Table can modify it
+        schema = {key: val.copy() for key, val in schema.items()}
+    return schema
+
+
+def invalidate_schema_cache(conn=None, table_id=None):
+    """Invalidate the cached schema of tables.
+
+    Parameters
+    ----------
+    conn : instance of psycopg2.Postgres | None
+        The connection object. If None, the cache of all databases
+        is invalidated.
+    table_id : str | None
+        The table ID. If None, the schema of all the tables is invalidated.
+    """
+    if conn is None:
+        _schema_cache.clear()
+    elif table_id is None:
+        _schema_cache.pop(conn.dsn, None)
+    elif conn.dsn in _schema_cache:
+        _schema_cache[conn.dsn]['tables'].pop(table_id, None)
+
+
 #### Neurobooth related comands #####
 
 def df_to_psql(conn, cursor, df, table_id):
@@ -71,7 +475,7 @@ def df_to_psql(conn, cursor, df, table_id):
     _execute_batch(conn, cursor, insert_cmd, tuples)
 
 
-def query(conn, sql_query, column_names):
+def query(conn, sql_query, column_names, params=None, prepare=False):
     """Transform a SELECT query into a pandas dataframe
 
     Parameters
@@ -82,6 +486,13 @@ def query(conn, sql_query, column_names):
         The SQL query to perform
     column_names : str | list of str
         The columns to create
+    params : tuple | dict | None
+        The parameters bound to the placeholders (%s or %(name)s)
+        in sql_query.
+    prepare : bool
+        If True, the query is prepared on the server the first time it is
+        run on the connection, and its plan is reused the next times. Use
+        it for queries repeated in loops with different params.
 
     Returns
     -------
@@ -91,12 +502,55 @@ def query(conn, sql_query, column_names):
     if isinstance(column_names, str):
         column_names = [column_names]
     cursor = conn.cursor()
-    data = execute(conn, cursor, sql_query, fetch=True)
+    data = execute(conn, cursor, sql_query, fetch=True, params=params,
+                   prepare=prepare)
     df = pd.DataFrame(data, columns=column_names)
     cursor.close()
     return df
 
 
+def iter_query(conn, sql_query, column_names, chunksize=10000, params=None):
+    """Iterate over the results of a SELECT query in chunks.
+
+    The rows are fetched with a server-side cursor so that only
+    chunksize rows are held in memory at a time.
+
+    Parameters
+    ----------
+    conn : instance of psycopg2.Postgres
+        The connection object
+    sql_query : str
+        The SQL query to perform
+    column_names : str | list of str
+        The columns to create
+    chunksize : int
+        The number of rows in each chunk.
+    params : tuple | dict | None
+        The parameters bound to the placeholders (%s or %(name)s)
+        in sql_query.
+
+    Yields
+    ------
+    df : instance of Dataframe
+        The pandas dataframe with at most chunksize rows.
+    """
+    if isinstance(column_names, str):
+        column_names = [column_names]
+    # WITH HOLD so that the cursor survives commits made while iterating
+    cursor = conn.cursor(name=f'terra_{uuid.uuid4().hex}', withhold=True)
+    cursor.itersize = chunksize
+    try:
+        cursor.execute(sql_query, params)
+        while True:
+            data = cursor.fetchmany(chunksize)
+            if len(data) == 0:
+                break
+            yield pd.DataFrame(data, columns=column_names)
+    finally:
+        cursor.close()
+        _commit(conn)
+
+
 def drop_table(table_id, conn):
     """Drop table.
 
@@ -111,6 +565,7 @@ def drop_table(table_id, conn):
     cmd = f'DROP TABLE IF EXISTS "{table_id}" CASCADE;'
     execute(conn, cursor, cmd)
     cursor.close()
+    invalidate_schema_cache(conn, table_id)
 
 
 def drop_view(view_id, conn):
@@ -127,6 +582,7 @@ def drop_view(view_id, conn):
     cmd = f'DROP VIEW IF EXISTS "{view_id}" CASCADE;'
     execute(conn, cursor, cmd)
     cursor.close()
+    invalidate_schema_cache(conn, view_id)
 
 
 def copy_table(src_table_id, target_table_id, conn):
@@ -146,6 +602,7 @@ def copy_table(src_table_id, target_table_id, conn):
            f'AS SELECT * FROM {src_table_id}')
     execute(conn, cursor, cmd)
     cursor.close()
+    invalidate_schema_cache(conn, target_table_id)
 
 
 def create_table(table_id, conn, column_names, dtypes,
@@ -195,21 +652,23 @@ def create_table(table_id, conn, column_names, dtypes,
         """
     create_cmd = create_cmd[:-1] + ');'  # remove last comma
     cursor = conn.cursor()
-    try:
-        execute(conn, cursor, create_cmd)
-    except Exception as e:
-        cursor.close()
-        raise Exception(e)
-
-    if index is not None:
-        index_name = list(index.keys())[0]
-        index_cols = ', '.join(list(index.values())[0])
-        drop_cmd = f'DROP INDEX IF EXISTS {index_name}'
-        execute(conn, cursor, drop_cmd)
-        index_cmd = (f'CREATE UNIQUE INDEX {index_name} ON '
-                     f'{table_id} ({index_cols});')
-        execute(conn, cursor, index_cmd)
-
+    with transaction(conn):
+        try:
+            execute(conn, cursor, create_cmd)
+        except Exception as e:
+            cursor.close()
+            raise Exception(e)
+
+        if index is not None:
+            index_name = list(index.keys())[0]
+            index_cols = ', '.join(list(index.values())[0])
+            drop_cmd = f'DROP INDEX IF EXISTS {index_name}'
+            execute(conn, cursor, drop_cmd)
+            index_cmd = (f'CREATE UNIQUE INDEX {index_name} ON '
+                         f'{table_id} ({index_cols});')
+            execute(conn, cursor, index_cmd)
+
+    invalidate_schema_cache(conn, table_id)
     return Table(table_id, conn=conn, cursor=cursor, primary_key=primary_key)
 
 
@@ -243,23 +702,19 @@ class Table:
         self.cursor = cursor
         self.table_id = table_id
 
-        alias = {'character varying': 'VARCHAR'}
-        cmd = ("SELECT column_name, data_type, character_maximum_length"
-               " FROM INFORMATION_SCHEMA.COLUMNS WHERE "
-               f"table_name = '{table_id}';")
-        columns = execute(conn, cursor, cmd, fetch=True)
-
-        self.column_names = list()
-        self.data_types = list()
-        for cn in columns:
-            column_name, dtype, maxlen = cn
-            if dtype == 'character varying':
-                dtype = f'VARCHAR ({maxlen})'
-            self.column_names.append(column_name)
-            self.data_types.append(dtype.upper())
+        schema = _get_schema(conn, cursor, table_id)
+        if schema is None:
+            self.column_names = list()
+            self.data_types = list()
+        else:
+            self.column_names = schema['column_names']
+            self.data_types = schema['data_types']
 
         if primary_key is None:
-            primary_key = _get_primary_keys(conn, cursor, table_id)
+            if schema is None:  # raises error if table does not exist
+                primary_key = _get_primary_keys(conn, cursor, table_id)
+            else:
+                primary_key = schema['primary_key']
         if isinstance(primary_key, str):
             primary_key = [primary_key]
         self.primary_key = primary_key
@@ -300,18 +755,17 @@ class Table:
             sequence_name = f'{self.table_id}_{col}'
             seq_cmd1 = f'DROP SEQUENCE IF EXISTS {sequence_name}'
             seq_cmd2 = f'CREATE SEQUENCE  IF NOT EXISTS {sequence_name}'
-            execute(self.conn, self.cursor, seq_cmd1)
-            execute(self.conn, self.cursor, seq_cmd2)
-
             prefix = default['prefix']
             cmd += f"SET DEFAULT '{prefix}' || nextval('{sequence_name}')"
-            execute(self.conn, self.cursor, cmd)
-
             constraint_name = f'{sequence_name}_chk'
             check_cmd = (f"ALTER TABLE {self.table_id} "
                          f"ADD CONSTRAINT {constraint_name} "
                          f"CHECK ({col} ~ '^{prefix}[0-9]+$')")
-            execute(self.conn, self.cursor, check_cmd)
+            with transaction(self.conn):
+                execute(self.conn, self.cursor, seq_cmd1)
+                execute(self.conn, self.cursor, seq_cmd2)
+                execute(self.conn, self.cursor, cmd)
+                execute(self.conn, self.cursor, check_cmd)
 
     def add_column(self, col, dtype):
         """Add a new column to the table.
@@ -326,6 +780,7 @@ class Table:
         cmd = f'ALTER TABLE {self.table_id} '
         cmd += f'ADD COLUMN {col} {dtype};'
         execute(self.conn, self.cursor, cmd)
+        invalidate_schema_cache(self.conn, self.table_id)
         self.column_names.append(col)
 
     def drop_column(self, col):
@@ -339,12 +794,14 @@ class Table:
         cmd = f'ALTER TABLE {self.table_id} '
         cmd += f'DROP COLUMN {col} '
         execute(self.conn, self.cursor, cmd)
+        invalidate_schema_cache(self.conn, self.table_id)
 
         idx = self.column_names.index(col)
         del self.column_names[idx], self.data_types[idx]
 
     def insert_rows(self, vals, cols, on_conflict='error',
-                    conflict_cols='auto', update_cols='all', where=None):
+                    conflict_cols='auto', update_cols='all', where=None,
+                    method='batch'):
         """Manual insertion into tables
 
         Parameters
@@ -366,6 +823,11 @@ class Table:
         where : str | None
             Condition to filter rows by. If None,
             keep all rows where primary key is not NULL.
+        method : 'batch' | 'copy'
+            If 'batch', rows are sent with INSERT statements in pages of
+            100 rows. If 'copy', rows are streamed with COPY into a
+            temporary staging table and then merged into the table in a
+            single statement. 'copy' is much faster for large number of rows.
 
         Returns
         -------
@@ -380,6 +842,10 @@ class Table:
 
             create unique index subject_identifier on
             subject (first_name_birth, last_name_birth, date_of_birth);
+
+        With method='copy' and on_conflict='update', the rows in vals
+        must not conflict with each other since they are merged with a
+        single INSERT statement.
         """
         if not isinstance(vals, list):
             raise ValueError(f'vals must be a list of tuple. Got {type(vals)}')
@@ -396,6 +862,9 @@ class Table:
         if on_conflict not in ('nothing', 'update', 'error'):
             raise ValueError(f'on_conflict must be one of (nothing, update, error)',
                              f'Got {on_conflict}')
+        if method not in ('batch', 'copy'):
+            raise ValueError(f'method must be one of (batch, copy). '
+                             f'Got {method}')
 
         if conflict_cols == 'auto':
             conflict_cols = self.primary_key
@@ -414,7 +883,12 @@ class Table:
         str_format = ','.join(len(cols) * ['%s'])
         col_names = cols.copy()
         cols = ','.join([f'"{col}"' for col in cols])
-        insert_cmd = f'INSERT INTO {self.table_id}({cols}) VALUES({str_format}) '
+        if method == 'copy':
+            insert_cmd = (f'INSERT INTO {self.table_id}({cols}) '
+                          f'SELECT {cols} FROM {{staging}} ')
+        else:
+            insert_cmd = (f'INSERT INTO {self.table_id}({cols}) '
+                          f'VALUES({str_format}) ')
         if on_conflict == 'nothing':
             insert_cmd += f'ON CONFLICT DO NOTHING '
         elif on_conflict == 'update':
@@ -425,6 +899,18 @@ class Table:
                 update_cmd.append(f'"{col_name}" = excluded."{col_name}"')
             insert_cmd += ', '.join(update_cmd) + ' '
             insert_cmd += f'WHERE {where} '
+
+        if method == 'copy':
+            # only fetch the primary key back for single rows
+            fetch = len(vals) == 1
+            if fetch:
+                insert_cmd += f'RETURNING {self.primary_key[0]}'
+            pk_vals = _copy_from(self.conn, self.cursor, self.table_id,
+                                 cols, vals, insert_cmd, fetch=fetch)
+            if fetch and len(pk_vals) == 1:
+                return pk_vals[0][0]
+            return
+
         insert_cmd += f'RETURNING {self.primary_key[0]}'
 
         _execute_batch(self.conn, self.cursor, insert_cmd, vals)
@@ -436,9 +922,12 @@ class Table:
 
         Parameters
         ----------
-        pk_val : str
+        pk_val : str | tuple
             The value of the primary key to match
-            the row to replace.
+            the row to replace. In case of compound primary key,
+            the tuple of the values of the columns of the primary key.
+            If not a tuple, only the first column of the primary key is
+            matched.
         vals : tuple
             The values in the row to replace.
         cols : list of str
@@ -456,32 +945,111 @@ class Table:
             raise ValueError(f'length of vals ({len(vals)}) != '
                              f'length of cols ({len(cols)})')
 
-        for col, val in zip(cols, vals):
+        for col in cols:
             if col not in self.column_names:
                 raise ValueError(f'column {col} is not present in table')
-            cmd += f"\"{col}\" = '{val}', "
-        cmd = cmd[:-2]  # remove last comma
-        pk = self.primary_key[0]
-        cmd += f" WHERE {pk} = '{pk_val}';"
-        execute(self.conn, self.cursor, cmd)
-
-    def query(self, include_columns=None, where=None):
-        """Run a query.
+        cmd += ', '.join([f'"{col}" = %s' for col in cols])
+
+        if not isinstance(pk_val, tuple):
+            # match the first column of the primary key, as before
+            where = {self.primary_key[0]: pk_val}
+        elif len(pk_val) != len(self.primary_key):
+            raise ValueError(f'primary key values must have '
+                             f'{len(self.primary_key)} values. Got {pk_val}')
+        else:
+            where = dict(zip(self.primary_key, pk_val))
+        where, params = build_where(where)
+        cmd += f" WHERE {where};"
+        vals = tuple([extras.Json(val) if isinstance(val, dict) else val
+                      for val in vals])
+        execute(self.conn, self.cursor, cmd, params=vals + tuple(params))
+
+    def update_rows(self, pk_vals, vals, cols, page_size=1000):
+        """Update values in many rows at once.
+
+        The rows are updated with ``UPDATE ... FROM (VALUES ...)`` in pages
+        of page_size rows, and the values are passed as parameters.
 
         Parameters
         ----------
-        include_columns : str | list of str | None
-            If None, query all columns
-        where : str | None
-            Condition to filter rows by. If None,
-            keep all rows. E.g.,
-            table.query(where='"wearable_bool" = True')
-
-        Returns
-        -------
-        df : instance of pd.Dataframe
-            A pandas dataframe object.
+        pk_vals : list
+            The values of the primary key to match the rows to update. In
+            case of compound primary key, each entry is a tuple with the
+            values of the columns of the primary key.
+        vals : list of tuple
+            The values to update. Each tuple is one row.
+        cols : list of str
+            The columns to update.
+        page_size : int
+            The maximum number of rows updated in one statement.
+
+        Examples
+        --------
+        >>> table.update_rows(['sensor_1', 'sensor_2'],
+        ...                   [(['a.csv'],), (['b.csv'],)],
+        ...                   cols=['sensor_file_path'])
         """
+        if not isinstance(vals, list):
+            raise ValueError(f'vals must be a list of tuple. Got {type(vals)}')
+        if len(pk_vals) != len(vals):
+            raise ValueError(f'length of pk_vals ({len(pk_vals)}) != '
+                             f'length of vals ({len(vals)})')
+        for col in cols:
+            if col not in self.column_names:
+                raise ValueError(f'column {col} is not present in table')
+
+        primary_key, cols = list(self.primary_key), list(cols)
+        n_pk = len(primary_key)
+        rows = list()
+        for pk_val, val in zip(pk_vals, vals):
+            if not isinstance(val, tuple):
+                raise ValueError(f'entries in vals must be tuples. Got {type(val)}')
+            if len(val) != len(cols):
+                raise ValueError(f'tuple length must match number of columns ({len(cols)})')
+            if isinstance(pk_val, list):
+                pk_val = tuple(pk_val)
+            elif not isinstance(pk_val, tuple):
+                pk_val = (pk_val,)
+            if len(pk_val) != n_pk:
+                raise ValueError(f'primary key values must have {n_pk} '
+                                 f'values. Got {pk_val}')
+            val = tuple([extras.Json(this_val) if isinstance(this_val, dict)
+                         else this_val for this_val in val])
+            rows.append(pk_val + val)
+        if len(rows) == 0:
+            return
+
+        # the values are cast to the type of their column, so that strings
+        # can be written to non-text columns and arrays keep their type
+        column_types = _get_schema(self.conn, self.cursor,
+                                   self.table_id)['column_types']
+        all_cols = primary_key + cols
+        template = '(' + ', '.join([f'%s::{column_types[col]}'
+                                    for col in all_cols]) + ')'
+        # the columns of VALUES are renamed in case a primary key is updated
+        pk_aliases = [f'pk_{idx}' for idx in range(n_pk)]
+        val_aliases = [f'val_{idx}' for idx in range(len(cols))]
+
+        set_cmd = ', '.join([f'"{col}" = v.{alias}'
+                             for col, alias in zip(cols, val_aliases)])
+        where = ' AND '.join([f't."{pk}" = v.{alias}'
+                              for pk, alias in zip(primary_key, pk_aliases)])
+        cmd = (f'UPDATE {self.table_id} AS t SET {set_cmd} '
+               f'FROM (VALUES %s) AS v({", ".join(pk_aliases + val_aliases)}) '
+               f'WHERE {where};')
+        execute_values(self.conn, self.cursor, cmd, rows, template=template,
+                       page_size=page_size)
+
+    def _build_where(self, where, params=None):
+        """Build the WHERE condition, checking the columns of filters."""
+        if isinstance(where, dict):
+            for col in where:
+                if col not in self.column_names:
+                    raise ValueError(f'column {col} is not present in table')
+        return build_where(where, params)
+
+    def _select_cmd(self, include_columns=None, where=None, params=None):
+        """Build the SELECT command for query and iter_query."""
         if include_columns is None:
             include_columns = self.column_names
         if isinstance(include_columns, str):
@@ -490,32 +1058,105 @@ class Table:
         # use quotes to be case sensitive
         cols = ', '.join([f'\"{col}\"' for col in include_columns])
 
+        where, params = self._build_where(where, params)
         cmd = f"SELECT {cols} FROM {self.table_id} "
         if where is not None:
             cmd += f"WHERE {where}"
         cmd += ';'
+        return cmd, include_columns, params
 
-        data = execute(self.conn, self.cursor, cmd, fetch=True)
-        df = pd.DataFrame(data, columns=include_columns)
+    def _set_index(self, df):
+        """Set the primary key as index of the dataframe."""
         if len(self.primary_key):
             pk = self.primary_key[0]
             if pk in df.columns:
                 df = df.set_index(pk)
         return df
 
-    def delete_row(self, where=None):
+    def query(self, include_columns=None, where=None, params=None,
+              prepare=False):
+        """Run a query.
+
+        Parameters
+        ----------
+        include_columns : str | list of str | None
+            If None, query all columns
+        where : str | dict | None
+            Condition to filter rows by. If None,
+            keep all rows. E.g.,
+            table.query(where='"wearable_bool" = True'),
+            table.query(where='subject_id = %s', params=('100001',)) or
+            table.query(where={'subject_id': ['100001', '100002'],
+                               'Age': {'>=': 18}}).
+            See build_where for the structured filters.
+        params : tuple | dict | None
+            The parameters bound to the placeholders (%s or %(name)s)
+            in where if it is a str.
+        prepare : bool
+            If True, the query is prepared on the server and its plan is
+            reused by the next queries that differ only by their params,
+            e.g., when querying in a loop.
+
+        Returns
+        -------
+        df : instance of pd.Dataframe
+            A pandas dataframe object.
+        """
+        cmd, include_columns, params = self._select_cmd(include_columns,
+                                                        where, params)
+        data = execute(self.conn, self.cursor, cmd, fetch=True,
+                       params=params, prepare=prepare)
+        df = pd.DataFrame(data, columns=include_columns)
+        return self._set_index(df)
+
+    def iter_query(self, include_columns=None, where=None, chunksize=10000,
+                   params=None):
+        """Run a query and iterate over the rows in chunks.
+
+        Unlike query, the rows are streamed from a server-side cursor
+        so that large tables can be processed in bounded memory.
+
+        Parameters
+        ----------
+        include_columns : str | list of str | None
+            If None, query all columns
+        where : str | dict | None
+            Condition to filter rows by. If None,
+            keep all rows. See query.
+        chunksize : int
+            The number of rows in each chunk.
+        params : tuple | dict | None
+            The parameters bound to the placeholders (%s or %(name)s)
+            in where if it is a str.
+
+        Yields
+        ------
+        df : instance of pd.Dataframe
+            A pandas dataframe object with at most chunksize rows.
+        """
+        cmd, include_columns, params = self._select_cmd(include_columns,
+                                                        where, params)
+        for df in iter_query(self.conn, cmd, include_columns,
+                             chunksize=chunksize, params=params):
+            yield self._set_index(df)
+
+    def delete_row(self, where=None, params=None):
         """Delete rows from table.
 
         Parameters
         ----------
-        where : str
-            The condition to filter rows by and delete them.
+        where : str | dict | None
+            The condition to filter rows by and delete them. See query.
+        params : tuple | dict | None
+            The parameters bound to the placeholders (%s or %(name)s)
+            in where if it is a str.
         """
+        where, params = self._build_where(where, params)
         delete_cmd = f'DELETE FROM {self.table_id} '
         if where is not None:
-            delete_cmd += f'WHERE {where};'
+            delete_cmd += f'WHERE {where}'
         delete_cmd += ';'
-        execute(self.conn, self.cursor, delete_cmd)
+        execute(self.conn, self.cursor, delete_cmd, params=params)
 
     def drop(self):
         drop_table(self.conn, self.cursor, self.table_id)
@@ -6,13 +6,22 @@ from datetime import datetime, date
 from warnings import warn
 import time
 import json
+import hashlib
+import pickle
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import os.path as op
 
 import numpy as np
 import pandas as pd
-from pandas.api.types import infer_dtype
+from pandas.api.types import (infer_dtype, is_bool_dtype, is_numeric_dtype,
+                              is_datetime64_any_dtype)
+
+from .postgres import (Table, create_table, drop_table, list_tables, query,
+                       execute, execute_values, transaction,
+                       _get_column_types)
 
 
 class RedcapError(Exception):
@@ -56,7 +65,61 @@ def iter_interval(wait=60, exit_after=np.inf):
             break
 
 
-def fetch_survey(project, survey_name, survey_id, index=None, cast_dtype=True):
+# the strings that pd.read_csv treats as missing values by default
+_NA_VALUES = frozenset([
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+    '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+    'nan', 'null'])
+_TRUE_VALUES = frozenset(['True', 'TRUE', 'true'])
+_FALSE_VALUES = frozenset(['False', 'FALSE', 'false'])
+
+
+def _cast_column(series, python_dtype=None):
+    """Cast a column of strings to the dtype pd.read_csv would infer.
+
+    If python_dtype is 'float64' or 'Int64' and all the values are numbers
+    (integers for 'Int64'), the column is cast to python_dtype instead.
+    """
+    is_na = (series.isna() | series.isin(_NA_VALUES)).to_numpy()
+    values = series[~is_na]
+    if len(values) == 0:
+        return pd.Series(np.nan, index=series.index, name=series.name)
+
+    try:
+        numbers = pd.to_numeric(values)
+    except (ValueError, TypeError):
+        numbers = None
+
+    if numbers is not None:
+        if python_dtype == 'Int64' and (numbers % 1 == 0).all():
+            out = pd.Series(pd.NA, index=series.index, name=series.name,
+                            dtype='Int64')
+            out[~is_na] = numbers.astype('int64')
+            return out
+        if numbers.dtype.kind in 'iu' and not is_na.any() and \
+                python_dtype != 'float64':
+            return numbers
+        out = pd.Series(np.nan, index=series.index, name=series.name)
+        out[~is_na] = numbers.astype('float64')
+        return out
+
+    is_true, is_false = values.isin(_TRUE_VALUES), values.isin(_FALSE_VALUES)
+    if (is_true | is_false).all():
+        if not is_na.any():
+            return is_true
+        out = pd.Series(np.nan, index=series.index, name=series.name,
+                        dtype=object)
+        out[~is_na] = is_true.astype(object)
+        return out
+
+    values = series.to_numpy(dtype=object, copy=True)
+    values[is_na] = np.nan
+    # let pandas infer the dtype of strings like pd.read_csv
+    return pd.Series(values, index=series.index, name=series.name)
+
+
+def fetch_survey(project, survey_name, survey_id, index=None, cast_dtype=True,
+                 dtypes=None):
     """Get schema of table from redcap
 
     Parameters
@@ -71,8 +134,13 @@ def fetch_survey(project, survey_name, survey_id, index=None, cast_dtype=True):
     index : str
         The column to set as index.
     cast_dtype : bool
-        If True, cast to datatype. This is done by writing the dataframe to
-        a temporary csv file and reading it back.
+        If True, cast to datatype. The data types are the same that
+        pd.read_csv would infer for the report.
+    dtypes : dict | None
+        The python_dtype of the columns as returned by map_dtypes. Columns
+        with python_dtype 'float64' or 'Int64' are cast to it directly if
+        their values allow it. The data types of other columns are inferred.
+        Only used if cast_dtype is True.
 
     Returns
     -------
@@ -87,10 +155,10 @@ def fetch_survey(project, survey_name, survey_id, index=None, cast_dtype=True):
     # format = 'df' didn't work
     df = pd.DataFrame(data)
     if cast_dtype:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            csv_fname = op.join(temp_dir, survey_name + '.csv')
-            df.to_csv(csv_fname, index=False)
-            df = pd.read_csv(csv_fname)
+        if dtypes is None:
+            dtypes = dict()
+        df = pd.DataFrame({col: _cast_column(df[col], dtypes.get(col))
+                           for col in df.columns}, index=df.index)
     print('[Done]')
 
     df = df.where(pd.notnull(df), None)
@@ -101,18 +169,89 @@ def fetch_survey(project, survey_name, survey_id, index=None, cast_dtype=True):
     return df
 
 
-def _is_series_equal(src_series, target_series):
-    """Check equality of two series by casting dtype when necessary."""
+class _TokenBucket:
+    """Rate limiter that allows bursts of up to capacity requests."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_surveys(project, survey_ids, n_jobs=4, rate=5., burst=None,
+                  index=None, cast_dtype=True, dtypes=None):
+    """Fetch several reports from redcap concurrently.
+
+    The reports are yielded as soon as they are fetched so that they can be
+    processed while the other reports are being fetched.
 
-    for col_index, target_item in target_series.iteritems():
-        src_item = src_series.loc[col_index]
-        if isinstance(target_item, date):  # ignore datetime column
-            continue
-        elif type(target_item) != type(src_item):
-            src_item = np.array([src_item]).astype(type(target_item))[0]
-        if target_item != src_item:
-            return False
-    return True
+    Parameters
+    ----------
+    project : instance of Project
+        The project created using pycap.
+    survey_ids : dict
+        The survey_id of each survey_name to export.
+    n_jobs : int
+        The maximum number of reports fetched at the same time.
+    rate : float | None
+        The maximum number of requests to redcap per second. If None,
+        the requests are not rate limited.
+    burst : int | None
+        The number of requests that can be made at once before being rate
+        limited. Defaults to n_jobs.
+    index : str
+        The column to set as index.
+    cast_dtype : bool
+        If True, cast to datatype.
+    dtypes : dict of dict | None
+        The python_dtype of the columns for each survey_name. See
+        fetch_survey.
+
+    Yields
+    ------
+    survey_name : str
+        The name of the survey.
+    df : instance of DataFrame
+        The pandas dataframe.
+    """
+    if dtypes is None:
+        dtypes = dict()
+    if burst is None:
+        burst = n_jobs
+    bucket = None if rate is None else _TokenBucket(rate, burst)
+
+    def _fetch(survey_name, survey_id):
+        if bucket is not None:
+            bucket.acquire()
+        return fetch_survey(project, survey_name, survey_id, index=index,
+                            cast_dtype=cast_dtype,
+                            dtypes=dtypes.get(survey_name))
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(_fetch, survey_name, survey_id): survey_name
+                   for survey_name, survey_id in survey_ids.items()}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # do not fetch the remaining reports on error or early exit
+            for future in futures:
+                future.cancel()
 
 
 def combine_indicator_columns(df, src_cols, target_col):
@@ -128,11 +267,18 @@ def combine_indicator_columns(df, src_cols, target_col):
     target_col : str
         The name of the target column to create
     """
-    arr = [list() for _ in range(df.shape[0])]
+    masks, vals = list(), list()
     for col_name, val in src_cols.items():
-        for idx, this_element in enumerate(df[col_name]):
-            if this_element == 1.:
-                arr[idx].append(int(val))
+        mask = (df[col_name] == 1.).to_numpy(dtype=bool, na_value=False)
+        masks.append(mask)
+        vals.append(int(val) if mask.any() else val)
+
+    if len(masks) == 0:
+        arr = [list() for _ in range(df.shape[0])]
+    else:
+        masks = np.column_stack(masks)  # (n_rows, n_src_cols)
+        vals = np.array(vals, dtype=object)
+        arr = [vals[mask].tolist() for mask in masks]
     df[target_col] = arr
     df.drop(src_cols.keys(), axis=1, inplace=True)
     return df
@@ -229,6 +375,27 @@ def get_response_array(s):
     return s
 
 
+_DTYPE_MAPPING = {'calc': 'double precision', 'checkbox': 'smallint[]',
+                  'dropdown': 'smallint', 'notes': 'text',
+                  'radio': 'smallint', 'yesno': 'boolean',
+                  'file': 'varchar(255)', 'slider':'smallint'}
+_TEXT_DTYPE_MAPPING = {'date_mdy': 'date', 'email': 'varchar(255)',
+                       'datetime_seconds_ymd': 'timestamp',
+                       'datetime_seconds_mdy': 'timestamp',
+                       'datetime_mdy': 'timestamp',
+                       'mrn_6d': 'integer', 'number': 'bigint',
+                       'phone': 'varchar(15)'}
+_PYTHON_DTYPE_MAPPING = {'smallint[]': 'list',
+                         'boolean': 'bool',
+                         'text': 'str', 'varchar(255)': 'str',
+                         'timestamp': 'str', 'date': 'str',
+                         'datetime': 'str',
+                         'double precision': 'float64',
+                         'smallint': 'Int64', 'bigint': 'Int64',
+                         'integer': 'Int64', 'varchar(15)': 'str',
+                         'file': 'str'}
+
+
 def map_dtypes(s):
     """Create new columns mapping Redcap data types to Postgres and Python.
 
@@ -238,44 +405,227 @@ def map_dtypes(s):
         The pandas series object containing new entries database_dtype
         and python_dtype
     """
-    dtype_mapping = {'calc': 'double precision', 'checkbox': 'smallint[]',
-                     'dropdown': 'smallint', 'notes': 'text',
-                     'radio': 'smallint', 'yesno': 'boolean',
-                     'file': 'varchar(255)', 'slider':'smallint'}
-    text_dtype_mapping = {'date_mdy': 'date', 'email': 'varchar(255)',
-                          'datetime_seconds_ymd': 'timestamp',
-                          'datetime_seconds_mdy': 'timestamp',
-                          'datetime_mdy': 'timestamp',
-                          'mrn_6d': 'integer', 'number': 'bigint',
-                          'phone': 'varchar(15)'}
-    python_dtype_mapping = {'smallint[]': 'list',
-                            'boolean': 'bool',
-                            'text': 'str', 'varchar(255)': 'str',
-                            'timestamp': 'str', 'date': 'str',
-                            'datetime': 'str',
-                            'double precision': 'float64',
-                            'smallint': 'Int64', 'bigint': 'Int64',
-                            'integer': 'Int64', 'varchar(15)': 'str',
-                            'file': 'str'}
-
     redcap_dtype = s['field_type']
     text_validation = s['text_validation_type_or_show_slider_number']
 
     if pd.isna(redcap_dtype) or redcap_dtype in ['descriptive']:
         return s
 
-    if redcap_dtype in dtype_mapping:
-        s['database_dtype'] = dtype_mapping[redcap_dtype]
+    if redcap_dtype in _DTYPE_MAPPING:
+        s['database_dtype'] = _DTYPE_MAPPING[redcap_dtype]
     elif redcap_dtype == 'text':
-        s['database_dtype'] = text_dtype_mapping.get(text_validation, 'text')
+        s['database_dtype'] = _TEXT_DTYPE_MAPPING.get(text_validation, 'text')
     else:
         raise RedcapError(f'UNKNOWN datatype found: {redcap_dtype}')
 
-    s['python_dtype'] = python_dtype_mapping[s['database_dtype']]
+    s['python_dtype'] = _PYTHON_DTYPE_MAPPING[s['database_dtype']]
 
     return s
 
 
+def _strip_newlines(series):
+    """Strip leading and trailing newlines of the strings in a column."""
+    if series.dtype == np.float64:  # only missing values
+        return series
+    stripped = series.str.strip('\n')
+    # keep values that are not strings
+    return stripped.where(stripped.notna(), series)
+
+
+def _map_dtypes(metadata):
+    """Vectorized version of metadata.apply(map_dtypes, axis=1)."""
+    field_type = metadata['field_type']
+    text_validation = metadata['text_validation_type_or_show_slider_number']
+    is_skipped = (field_type.isna() | (field_type == 'descriptive')).to_numpy()
+    if is_skipped.all():
+        return metadata
+
+    database_dtype = field_type.map(_DTYPE_MAPPING).astype(object)
+    is_text = (field_type == 'text').to_numpy()
+    database_dtype[is_text] = text_validation[is_text].map(
+        lambda x: _TEXT_DTYPE_MAPPING.get(x, 'text'))
+    is_unknown = ~is_skipped & database_dtype.isna().to_numpy()
+    if is_unknown.any():
+        redcap_dtype = field_type[is_unknown].iloc[0]
+        raise RedcapError(f'UNKNOWN datatype found: {redcap_dtype}')
+
+    metadata['database_dtype'] = database_dtype
+    metadata['python_dtype'] = database_dtype.map(_PYTHON_DTYPE_MAPPING)
+    return metadata
+
+
+def _set_values(metadata, col, positions, values):
+    """Set the values of a column at positions, creating it if needed."""
+    if col in metadata.columns:
+        arr = metadata[col].to_numpy(dtype=object, copy=True)
+    else:
+        arr = np.full(len(metadata), np.nan, dtype=object)
+    for pos, value in zip(positions, values):
+        arr[pos] = value
+    metadata[col] = arr
+
+
+def _extract_field_annotations(metadata):
+    """Vectorized version of metadata.apply(extract_field_annotation, axis=1)."""
+    field_annot = metadata['field_annotation']
+    positions = np.flatnonzero(field_annot.notna().to_numpy())
+    if len(positions) == 0:
+        return metadata
+    field_annot = pd.Series(field_annot.to_numpy()[positions], index=positions,
+                            dtype=object)
+
+    # see extract_field_annotation for the format of the annotations
+    fields = field_annot.str.split('|').explode().str.strip()
+    fields = fields[(fields != '') & ~fields.str.startswith('@')]
+    parts = fields.str.split('-')
+    is_valid = parts.str.len() == 2
+
+    field_annot_clean = field_annot.str.split().str.join(' ')
+    for pos in fields.index[~is_valid.to_numpy()]:
+        warn(f'field_annotation reads: {field_annot_clean[pos]}')
+
+    # the last annotation of a row decides if there is an error
+    is_last_valid = is_valid.groupby(level=0).last()
+    _set_values(metadata, 'error', is_last_valid.index,
+                ['' if this_valid else
+                 f'field_annotation reads: {field_annot_clean[pos]}'
+                 for pos, this_valid in is_last_valid.items()])
+
+    parts = parts[is_valid]
+    annotations = pd.DataFrame({'name': parts.str[0], 'value': parts.str[1]},
+                               index=parts.index)
+    is_foi = (annotations['name'] == 'FOI').to_numpy()
+    # like setting s[name] in order, the last annotation with a name wins
+    others = annotations[~is_foi]
+    for name, this_others in others.groupby('name', sort=False):
+        _set_values(metadata, name, this_others.index, this_others['value'])
+
+    fois = annotations['value'][is_foi].groupby(level=0).agg(list)
+    _set_values(metadata, 'FOI', positions,
+                [fois.get(pos, list()) for pos in positions])
+    return metadata
+
+
+def _get_response_arrays(metadata):
+    """Vectorized version of metadata.apply(get_response_array, axis=1)."""
+    is_choice = metadata['field_type'].isin(['radio', 'checkbox', 'dropdown'])
+    positions = np.flatnonzero(is_choice.to_numpy())
+    if len(positions) == 0:
+        return metadata
+
+    choices = metadata['select_choices_or_calculations'].to_numpy()[positions]
+    choices = pd.Series(choices, index=positions, dtype=object)
+    choices = choices.str.split('|').explode().str.strip()
+    items = choices.str.split(', ', n=1)
+    is_invalid = (items.str.len() != 2).to_numpy()
+    if is_invalid.any():
+        pos = items.index[is_invalid][0]
+        raise ValueError(f'Could not parse the choice {choices[is_invalid].iloc[0]} '
+                         f'of field {metadata.index[pos]}')
+
+    response_arrays = {pos: dict() for pos in positions}
+    for pos, (key, value) in zip(items.index, items):
+        response_arrays[pos][key] = value
+    _set_values(metadata, 'response_array', positions,
+                [response_arrays[pos] for pos in positions])
+    return metadata
+
+
+_METADATA_CACHE_VERSION = 1
+
+
+def process_metadata(metadata, include_surveys=None, form_name=None,
+                     cache_dir=None):
+    """Parse the data dictionary and get the structure of the tables.
+
+    This applies map_dtypes, extract_field_annotation and
+    get_response_array to all the fields, renames the columns for the
+    rc_data_dictionary table and calls get_tables_structure.
+
+    Parameters
+    ----------
+    metadata : instance of pd.Dataframe
+        The data dictionary as exported from Redcap, indexed by field_name.
+    include_surveys : list of str | None
+        The surveys to get the structure of. If None, all the surveys.
+    form_name : str | None
+        If not None, all the fields belong to the form form_name instead of
+        the form_name column of metadata.
+    cache_dir : str | None
+        The directory where the results are cached, using a hash of the
+        content of the data dictionary. If None, the results are not cached.
+
+    Returns
+    -------
+    metadata : instance of pd.Dataframe
+        The processed data dictionary.
+    table_infos : dict
+        The structure of the tables. See get_tables_structure.
+    """
+    if include_surveys is not None:
+        include_surveys = sorted(include_surveys)
+
+    cache_fname = None
+    if cache_dir is not None:
+        key = hashlib.sha1(metadata.to_csv().encode('utf-8'))
+        key.update(repr((include_surveys, form_name,
+                         _METADATA_CACHE_VERSION)).encode('utf-8'))
+        cache_fname = op.join(cache_dir, f'metadata_{key.hexdigest()}.pkl')
+        if op.exists(cache_fname):
+            with open(cache_fname, 'rb') as fid:
+                return pickle.load(fid)
+
+    metadata = metadata.copy()
+    for column in ['section_header', 'field_label']:
+        metadata[column] = _strip_newlines(metadata[column])
+
+    metadata = _map_dtypes(metadata)
+    metadata = _extract_field_annotations(metadata)
+    metadata = _get_response_arrays(metadata)
+
+    rename = {'FOI': 'feature_of_interest', 'DB': 'in_database',
+              'T': 'database_table_name', 'redcap_event_name': 'event_name'}
+    if form_name is None:
+        rename['form_name'] = 'redcap_form_name'
+    metadata = metadata.rename(rename, axis=1)
+    if form_name is not None:
+        metadata['redcap_form_name'] = form_name
+
+    is_descriptive = metadata['field_type'] == 'descriptive'
+    metadata['redcap_form_description'] = metadata['field_label']
+    metadata.loc[~is_descriptive, 'redcap_form_description'] = None
+
+    metadata['question'] = metadata['field_label']
+    metadata.loc[is_descriptive, 'question'] = None
+
+    if 'database_table_name' not in metadata.columns:
+        metadata['database_table_name'] = np.nan
+    metadata['database_table_name'] = metadata['database_table_name'].fillna(
+        value=metadata['redcap_form_name'])
+
+    # copy first section header of matrix into rest and concatenate with
+    # question
+    metadata_groups = metadata.groupby(by='matrix_group_name')
+    metadata['section_header'] = metadata_groups['section_header'].transform(
+        lambda s: s.infer_objects().ffill())
+    is_group = ~pd.isna(metadata['section_header'])
+    metadata.loc[is_group, 'question'] = (metadata['section_header'][is_group] +
+                                          metadata['question'][is_group])
+
+    table_infos = get_tables_structure(metadata,
+                                       include_surveys=include_surveys)
+
+    if cache_fname is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that the cache is never
+        # left half written
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as fid:
+            pickle.dump((metadata, table_infos), fid)
+        os.replace(fid.name, cache_fname)
+
+    return metadata, table_infos
+
+
 def get_tables_structure(metadata, include_surveys=None):
     """Get the column names and datatypes for the tables.
 
@@ -400,30 +750,168 @@ def dataframe_to_tuple(df, df_columns, fixed_columns=None,
             raise ValueError(f'No column found starting with {indicator_column}\n{error_text}')
         df = combine_indicator_columns(df, mapping, indicator_column)
 
-    rows = list()
-    for index, df_row in df.iterrows():
-
-        row = list()
-        for column_name in df_columns:
-            row.append(df_row[column_name])
-            # XXX: hack, None/nan means missing values in comments.
-            if not isinstance(row[-1], list) and \
-                    (pd.isna(row[-1]) or row[-1] in ('None', 'nan')):
-                row[-1] = None
-
-        for column_name in fixed_columns:
-            row.append(fixed_columns[column_name])
+    # Take the values of the entire dataframe so that the cells have the
+    # same types as with df.iterrows()
+    values = df.to_numpy()
+    if values.dtype.kind in 'mM':
+        values = df.astype(object).to_numpy()
+
+    columns = list()
+    for column_name in df_columns:
+        col = values[:, df.columns.get_loc(column_name)]
+        # XXX: hack, None/nan means missing values in comments.
+        is_null = pd.isna(col)
+        if col.dtype == object:
+            not_null = np.where(is_null, '', col)
+            is_null |= (not_null == 'None') | (not_null == 'nan')
+        col = list(col)
+        for idx in np.flatnonzero(is_null):
+            col[idx] = None
+        columns.append(col)
+
+    for column_name in fixed_columns:
+        columns.append([fixed_columns[column_name]] * df.shape[0])
 
-        for indicator_column in indicator_columns:
-            row.append(df_row[indicator_column])
+    for indicator_column in indicator_columns:
+        columns.append(list(values[:, df.columns.get_loc(indicator_column)]))
 
-        rows.append(tuple(row))
+    if len(columns) > 0:
+        rows = list(zip(*columns))
+    else:
+        rows = [tuple() for _ in range(df.shape[0])]
 
     cols = df_columns + list(fixed_columns.keys()) + indicator_columns
 
     return rows, cols
 
 
+def _fingerprint(obj):
+    """Hash the repr of an object."""
+    return hashlib.sha1(repr(obj).encode('utf-8')).hexdigest()
+
+
+def _get_fingerprint_table(conn, fingerprint_table_id):
+    """Get the table of fingerprints, creating it if needed."""
+    if fingerprint_table_id not in list_tables(conn):
+        return create_table(fingerprint_table_id, conn,
+                            ['table_id', 'row_key', 'fingerprint'],
+                            ['varchar(255)', 'text', 'varchar(40)'],
+                            primary_key=['table_id', 'row_key'])
+    return Table(fingerprint_table_id, conn)
+
+
+def sync_table(conn, table_id, column_names, dtypes, rows, cols,
+               primary_key=('subject_id', 'redcap_event_name'),
+               fingerprint_table_id='rc_fingerprint'):
+    """Synchronize a table with rows by only writing the rows that changed.
+
+    The fingerprint of each row and of the schema of the table are stored
+    in a separate table. The table is dropped and recreated only if its
+    schema changed. Otherwise, the rows whose fingerprint changed are
+    upserted and the rows that are no longer present are deleted.
+
+    Parameters
+    ----------
+    conn : instance of psycopg2.Postgres
+        The connection object
+    table_id : str
+        The table ID
+    column_names : list of str
+        The columns of the table.
+    dtypes : list of str
+        The data types of the columns.
+    rows : list of tuple
+        The rows of the table, e.g., as returned by dataframe_to_tuple.
+    cols : list of str
+        The columns of the rows.
+    primary_key : tuple of str
+        The columns that identify a row.
+    fingerprint_table_id : str
+        The table where the fingerprints are stored.
+
+    Returns
+    -------
+    summary : dict
+        The keys are rebuilt (True if the table was recreated), n_upserted
+        and n_deleted (the number of rows written and deleted).
+    """
+    primary_key = list(primary_key)
+    fingerprint_table = _get_fingerprint_table(conn, fingerprint_table_id)
+    schema_fingerprint = _fingerprint((list(column_names), list(dtypes),
+                                       primary_key))
+    schema_key = '__schema__'
+
+    # the fingerprint of a row also depends on the columns of the rows
+    cols_fingerprint = repr(list(cols))
+    pk_idxs = [cols.index(col) for col in primary_key]
+    row_keys = [json.dumps([str(row[idx]) for idx in pk_idxs])
+                for row in rows]
+    fingerprints = {row_key: _fingerprint((cols_fingerprint, row))
+                    for row_key, row in zip(row_keys, rows)}
+
+    stored = query(conn,
+                   f'SELECT row_key, fingerprint FROM {fingerprint_table_id} '
+                   f'WHERE table_id = %s', ['row_key', 'fingerprint'],
+                   params=(table_id,))
+    stored = dict(zip(stored.row_key, stored.fingerprint))
+
+    rebuilt = (stored.pop(schema_key, None) != schema_fingerprint or
+               table_id not in list_tables(conn))
+    if rebuilt:
+        stored = dict()
+        changed_keys = set(fingerprints)
+    else:
+        changed_keys = set(key for key, fingerprint in fingerprints.items()
+                           if stored.get(key) != fingerprint)
+    deleted_keys = set(stored) - set(fingerprints)
+    changed_rows = [row for row, row_key in zip(rows, row_keys)
+                    if row_key in changed_keys]
+
+    with transaction(conn):
+        if rebuilt:
+            drop_table(table_id, conn)
+            table = create_table(table_id, conn, column_names, dtypes,
+                                 primary_key=primary_key)
+            execute(conn, fingerprint_table.cursor,
+                    f'DELETE FROM {fingerprint_table_id} WHERE table_id = %s',
+                    params=(table_id,))
+        else:
+            table = Table(table_id, conn)
+
+        if len(changed_rows) > 0:
+            table.insert_rows(changed_rows, cols, on_conflict='update')
+        if len(deleted_keys) > 0:
+            pk_cols = ', '.join(primary_key)
+            where = ' AND '.join(f'{table_id}.{col} = v.{col}'
+                                 for col in primary_key)
+            # the keys are stored as text, so they are cast to the type
+            # of the primary key columns
+            column_types = _get_column_types(conn, table.cursor, table_id)
+            template = '(' + ', '.join(f'%s::{column_types[col]}'
+                                       for col in primary_key) + ')'
+            execute_values(conn, table.cursor,
+                           f'DELETE FROM {table_id} USING (VALUES %s) '
+                           f'AS v({pk_cols}) WHERE {where}',
+                           [tuple(json.loads(key)) for key in deleted_keys],
+                           template=template)
+            execute_values(conn, fingerprint_table.cursor,
+                           f'DELETE FROM {fingerprint_table_id} USING '
+                           f'(VALUES %s) AS v(table_id, row_key) WHERE '
+                           f'{fingerprint_table_id}.table_id = v.table_id AND '
+                           f'{fingerprint_table_id}.row_key = v.row_key',
+                           [(table_id, key) for key in deleted_keys])
+
+        fingerprint_rows = [(table_id, key, fingerprints[key])
+                            for key in changed_keys]
+        fingerprint_rows.append((table_id, schema_key, schema_fingerprint))
+        fingerprint_table.insert_rows(fingerprint_rows,
+                                      ['table_id', 'row_key', 'fingerprint'],
+                                      on_conflict='update')
+
+    return dict(rebuilt=rebuilt, n_upserted=len(changed_rows),
+                n_deleted=len(deleted_keys))
+
+
 def rename_subject_ids(table_subject, redcap_df):
     """Rename subject_id in table_subject using data in redcap_df.
 
@@ -487,40 +975,116 @@ def rename_subject_ids(table_subject, redcap_df):
                                   update_cols=['subject_id', 'old_subject_id'])
 
 
-def compare_dataframes(src_df, target_df):
+def _is_column_equal(src_col, target_col):
+    """Compare two aligned columns, casting src_col to the dtype of target_col.
+
+    Cells that are missing in both columns are equal and cells where the
+    target is a date are ignored.
+    """
+    if is_datetime64_any_dtype(target_col):  # ignore datetime column
+        return np.ones(len(target_col), dtype=bool)
+
+    is_both_na = (src_col.isna() & target_col.isna()).to_numpy()
+    if is_numeric_dtype(target_col) and not is_bool_dtype(target_col):
+        src_values = pd.to_numeric(src_col, errors='coerce')
+        src_values = src_values.to_numpy(dtype=float, na_value=np.nan)
+        target_values = target_col.to_numpy(dtype=float, na_value=np.nan)
+        return (src_values == target_values) | is_both_na
+
+    target_dtype = infer_dtype(target_col)
+    if target_dtype in ('date', 'datetime'):
+        return np.ones(len(target_col), dtype=bool)
+    target_values = target_col.to_numpy(dtype=object)
+    if target_dtype.startswith('mixed'):  # only some cells are dates
+        is_date = np.array([isinstance(val, date) for val in target_values],
+                           dtype=bool)
+    else:
+        is_date = np.zeros(len(target_col), dtype=bool)
+
+    src_values = src_col.to_numpy(dtype=object)
+    if is_numeric_dtype(src_col) and target_dtype == 'string':
+        src_values = src_col.astype(str).to_numpy(dtype=object)
+    # missing cells are not equal unless both are missing
+    is_any_na = (src_col.isna() | target_col.isna()).to_numpy()
+    is_equal = np.zeros(len(target_col), dtype=bool)
+    is_equal[~is_any_na] = np.equal(src_values[~is_any_na],
+                                    target_values[~is_any_na],
+                                    dtype=object).astype(bool)
+    return is_equal | is_both_na | is_date
+
+
+def compare_dataframes(src_df, target_df, verbose=False):
     """Compare dataframes.
 
+    The dataframes are aligned on their index and each column common to
+    both dataframes is compared at once.
+
     Parameters
     ----------
     src_df : pandas dataframe
-        The source dataframe whose changes are printed.
+        The source dataframe whose changes are returned.
     target_df : pandas dataframe
         The target dataframe that is compared against.
+    verbose : bool
+        If True, print a summary of the differences.
+
+    Returns
+    -------
+    diff : dict
+        The differences with the following entries:
+
+        extra_columns : set of str
+            The columns of src_df that are not in target_df.
+        added : pandas Index
+            The rows of src_df that are not in target_df.
+        removed : pandas Index
+            The rows of target_df that are not in src_df.
+        changed : pandas Index
+            The rows in both dataframes with at least one changed cell.
+        changed_cells : pandas dataframe
+            One row per changed cell, indexed like src_df, with the columns
+            column, src_value and target_value.
     """
-    # print extra columns in src_df
     src_columns = set(src_df.columns)
     target_columns = set(target_df.columns)
-    common_columns = src_columns.intersection(target_columns)
-    print(f'extra columns: {src_columns - common_columns}')
-
-    # differences in rows ignoring extra columns
-    print('Changed rows')
-    src_df = src_df[common_columns]
-    target_df = target_df[common_columns]
-    for index, src_row in src_df.iterrows():
-        if index not in target_df.index:
-            print(src_row[common_columns])
-            print('')
-            continue
-        target_row = target_df.loc[index]
-
-        # if not src_row[target_columns].equals(target_row):
-        if not _is_series_equal(src_row, target_row):
-            print(src_row[common_columns])
-            print('')
-            print(target_row)
-            print('')
-            print('')
+    common_columns = [col for col in src_df.columns if col in target_columns]
+
+    common_index = src_df.index.intersection(target_df.index, sort=False)
+    src_aligned = src_df.loc[common_index, common_columns]
+    target_aligned = target_df.loc[common_index, common_columns]
+
+    changed_cells = list()
+    is_changed = np.zeros(len(common_index), dtype=bool)
+    for col in common_columns:
+        is_col_changed = ~_is_column_equal(src_aligned[col],
+                                           target_aligned[col])
+        if is_col_changed.any():
+            is_changed |= is_col_changed
+            changed_cells.append(pd.DataFrame(
+                {'column': col,
+                 'src_value': src_aligned[col].to_numpy()[is_col_changed],
+                 'target_value':
+                     target_aligned[col].to_numpy()[is_col_changed]},
+                index=common_index[is_col_changed]))
+    if len(changed_cells) > 0:
+        changed_cells = pd.concat(changed_cells)
+    else:
+        changed_cells = pd.DataFrame(
+            columns=['column', 'src_value', 'target_value'],
+            index=common_index[:0])
+
+    diff = dict(extra_columns=src_columns - target_columns,
+                added=src_df.index.difference(target_df.index, sort=False),
+                removed=target_df.index.difference(src_df.index, sort=False),
+                changed=common_index[is_changed],
+                changed_cells=changed_cells)
+
+    if verbose:
+        print(f'extra columns: {diff["extra_columns"]}')
+        print(f'{len(diff["added"])} added rows, {len(diff["removed"])} '
+              f'removed rows, {len(diff["changed"])} changed rows')
+        print(changed_cells)
+    return diff
 
 
 def infer_schema(survey_df, metadata_df):
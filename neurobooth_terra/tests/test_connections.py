@@ -0,0 +1,160 @@
+import psycopg2
+import pytest
+
+from neurobooth_terra import connections
+from neurobooth_terra.connections import ConnectionManager
+
+
+class _FakeTunnel:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.is_connected = False
+        self.n_starts = 0
+        self.stopped = False
+
+    def start(self):
+        self.is_connected = True
+        self.n_starts += 1
+
+    def restart(self):
+        self.start()
+
+    def stop(self, force=False):
+        self.is_connected = False
+        self.stopped = force
+
+
+class _FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.n_commits = 0
+        self.n_rollbacks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.n_commits += 1
+        else:
+            self.n_rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class _FakePool:
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.kwargs = kwargs
+        self.closed = False
+        self.conns = list()
+        self.put = list()
+
+    def getconn(self):
+        conn = _FakeConnection()
+        self.conns.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        self.put.append((conn, close))
+
+    def closeall(self):
+        self.closed = True
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """A ConnectionManager with a fake tunnel and pools."""
+    monkeypatch.setattr(connections, 'OptionalSSHTunnelForwarder',
+                        _FakeTunnel)
+    monkeypatch.setattr(connections, 'ThreadedConnectionPool', _FakePool)
+    manager = ConnectionManager(dict(ssh_address_or_host='host'),
+                                dict(rc=dict(database='rc'),
+                                     log=dict(database='log')))
+    yield manager
+    manager.close()
+
+
+def test_lazy_start(manager):
+    """Test that the tunnel and pools are opened on first use."""
+    assert manager._tunnel is None and manager._pools == dict()
+
+    with manager.connect('rc') as conn:
+        pass
+    tunnel = manager._tunnel
+    assert tunnel.n_starts == 1
+    assert list(manager._pools) == ['rc']
+    assert manager._pools['rc'].kwargs == dict(database='rc')
+    assert conn.n_commits == 1
+    assert manager._pools['rc'].put == [(conn, False)]
+
+    # the tunnel and pool are reused
+    with manager.connect('rc'):
+        pass
+    with manager.connect('log'):
+        pass
+    assert manager._tunnel is tunnel and tunnel.n_starts == 1
+    assert sorted(manager._pools) == ['log', 'rc']
+
+    with pytest.raises(ValueError, match='database must be one of'):
+        with manager.connect('foo'):
+            pass
+
+
+def test_broken_connection(manager):
+    """Test that broken connections are not returned to the pool."""
+    with pytest.raises(ValueError):
+        with manager.connect('rc') as conn:
+            raise ValueError('abort')
+    assert conn.n_rollbacks == 1
+    assert manager._pools['rc'].put[-1] == (conn, False)
+
+    with pytest.raises(psycopg2.OperationalError):
+        with manager.connect('rc') as conn:
+            raise psycopg2.OperationalError('connection lost')
+    assert manager._pools['rc'].put[-1] == (conn, True)
+
+
+def test_restart(manager):
+    """Test that a dropped tunnel is restarted and the pools recreated."""
+    with manager.connect('rc'):
+        pass
+    tunnel, pool = manager._tunnel, manager._pools['rc']
+
+    with manager.connect('rc') as conn:
+        # the tunnel drops while the connection is used
+        tunnel.is_connected = False
+        with manager.connect('log'):
+            pass
+        assert pool.closed
+    assert conn.closed  # not returned to the closed pool
+    assert conn not in [put_conn for put_conn, _ in pool.put]
+    assert tunnel.n_starts == 2
+    assert manager._tunnel is tunnel
+
+    with manager.connect('rc'):
+        pass
+    assert manager._pools['rc'] is not pool
+
+
+def test_close(manager):
+    """Test closing the tunnel and the pools."""
+    with manager.connect('rc'):
+        pass
+    tunnel, pool = manager._tunnel, manager._pools['rc']
+    manager.close()
+    assert tunnel.stopped and pool.closed
+    assert manager._tunnel is None and manager._pools == dict()
+    manager.close()  # closing twice is fine
+
+    # the tunnel is opened again on next use
+    with manager.connect('rc'):
+        pass
+    assert manager._tunnel is not tunnel
+
+    with ConnectionManager(None, dict(rc=dict(database='rc'))) as manager:
+        with manager.connect('rc'):
+            pass
+        assert manager._tunnel is None
+        pool = manager._pools['rc']
+    assert pool.closed
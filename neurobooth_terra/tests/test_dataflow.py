@@ -1,12 +1,27 @@
 import os
 import shutil
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory, NamedTemporaryFile, mkdtemp
 
 import pytest
 import psycopg2
+import pandas as pd
 
 from neurobooth_terra import create_table, drop_table, Table
-from neurobooth_terra.dataflow import write_files, copy_files, delete_files
+from neurobooth_terra import dataflow
+from neurobooth_terra.dataflow import (write_files, write_files_bulk,
+                                       copy_files, delete_files,
+                                       query_sensor_files,
+                                       verify_pairs, HashCache,
+                                       get_volume_to_fill, VolumeIndex,
+                                       copy_sessions)
+from neurobooth_terra.dataflow import (_parse_rsync_line, _plan_deletion,
+                                       _get_sensor_fnames,
+                                       _get_sensor_file_ids,
+                                       _get_copied_operation_ids,
+                                       _update_copystatus)
 import scripts.credential_reader as reader
 
 db_args = reader.read_db_secrets()
@@ -48,6 +63,144 @@ def mock_data():
     shutil.rmtree(dest_dirname)
 
 
+@pytest.fixture
+def log_tables():
+    """Create the log tables of a session with three sensor files."""
+    session = '100001_2024-01-01'
+    src_dirname, dest_dirname = mkdtemp(), mkdtemp()
+    os.mkdir(os.path.join(src_dirname, session))
+    fnames = [f'{session}/{session}_{name}' for name in
+              ['mbient.csv', "o'brien.txt", 'intel.bag']]
+    for fname in fnames:
+        with open(os.path.join(src_dirname, fname), 'wb') as fp:
+            fp.write(fname.encode())
+
+    conn = psycopg2.connect(port='5432', host='localhost', **db_args)
+    table_ids = ['log_file_test', 'log_sensor_file_test', 'log_task']
+    for table_id in table_ids:
+        drop_table(table_id, conn)
+    create_table('log_task', conn, ['log_task_id', 'task_id'],
+                 ['VARCHAR (255)', 'VARCHAR (255)'])
+    create_table('log_sensor_file_test', conn,
+                 ['log_sensor_file_id', 'log_task_id', 'sensor_file_path'],
+                 ['VARCHAR (255)', 'VARCHAR (255)', 'text[]'])
+    create_table('log_file_test', conn,
+                 ['operation_id', 'log_sensor_file_id', 'src_dirname',
+                  'dest_dirname', 'fname', 'time_verified',
+                  'rsync_operation', 'is_deleted', 'is_finished'],
+                 ['SERIAL', 'text', 'text', 'text', 'text', 'timestamp',
+                  'text', 'boolean', 'boolean'],
+                 primary_key='operation_id')
+    # the task of the last sensor file crashed before it completed
+    Table('log_task', conn).insert_rows(
+        [('task_1', 'timing_test'), ('task_2', None)],
+        cols=['log_task_id', 'task_id'])
+    sensor_file_table = Table('log_sensor_file_test', conn)
+    sensor_file_table.insert_rows(
+        [('sensor_1', 'task_1', [fnames[0]]),
+         ('sensor_2', 'task_1', [fnames[1]]),
+         ('sensor_3', 'task_2', [fnames[2]])],
+        cols=['log_sensor_file_id', 'log_task_id', 'sensor_file_path'])
+    db_table = Table('log_file_test', conn)
+
+    yield dict(conn=conn, db_table=db_table,
+               sensor_file_table=sensor_file_table, session=session,
+               src_dirname=src_dirname, dest_dirname=dest_dirname,
+               fnames=fnames)
+
+    for table_id in table_ids:
+        drop_table(table_id, conn)
+    conn.close()
+    shutil.rmtree(src_dirname)
+    shutil.rmtree(dest_dirname)
+
+
+def test_get_sensor_file_ids(log_tables):
+    """Test mapping file names to their sensor files."""
+    fnames = log_tables['fnames']
+    sensor_file_table = log_tables['sensor_file_table']
+    assert _get_sensor_file_ids(sensor_file_table, list()) == dict()
+
+    # the file of the crashed task and unknown files are not mapped
+    sensor_file_ids = _get_sensor_file_ids(
+        sensor_file_table, fnames + ['unknown.csv'])
+    assert sensor_file_ids == {fnames[0]: 'sensor_1', fnames[1]: 'sensor_2'}
+
+    # a file in several sensor files is mapped to one of them
+    sensor_file_table.insert_rows([('sensor_4', 'task_1', fnames[:2])],
+                                  cols=['log_sensor_file_id', 'log_task_id',
+                                        'sensor_file_path'])
+    sensor_file_ids = _get_sensor_file_ids(sensor_file_table, fnames[1:2])
+    assert sensor_file_ids[fnames[1]] in ('sensor_2', 'sensor_4')
+
+
+def test_get_copied_operation_ids(log_tables):
+    """Test mapping file names to the operation_ids of their copies."""
+    fnames = log_tables['fnames']
+    db_table = log_tables['db_table']
+    assert _get_copied_operation_ids(db_table, list()) == dict()
+
+    cols = ['log_sensor_file_id', 'fname', 'is_finished']
+    db_table.insert_rows([('sensor_1', fnames[0], True),
+                          ('sensor_2', fnames[1], True),
+                          ('sensor_2', fnames[1], True),
+                          ('sensor_3', fnames[2], None),
+                          ('sensor_3', fnames[2], False)], cols=cols)
+    operation_ids = _get_copied_operation_ids(db_table, fnames)
+    assert sorted(operation_ids) == sorted(fnames[:2])
+    assert len(operation_ids[fnames[0]]) == 1
+    assert len(operation_ids[fnames[1]]) == 2  # the name has a quote
+    df = db_table.query(where={'operation_id': operation_ids[fnames[1]],
+                               'fname': fnames[1]})
+    assert len(df) == 2
+
+
+def test_update_copystatus(log_tables):
+    """Test updating the status of unfinished copies."""
+    db_table = log_tables['db_table']
+    session, fnames = log_tables['session'], log_tables['fnames']
+    src_session = os.path.join(log_tables['src_dirname'], session, '')
+    dest_session = os.path.join(log_tables['dest_dirname'], session, '')
+    other_session = os.path.join(mkdtemp(), session, '')
+    os.mkdir(dest_session)
+
+    # the csv and bag files match, the txt file was partially copied
+    for fname in fnames:
+        shutil.copy2(os.path.join(log_tables['src_dirname'], fname),
+                     dest_session)
+    with open(os.path.join(log_tables['dest_dirname'], fnames[1]), 'w') as fp:
+        fp.write('partial')
+
+    old = datetime.datetime(2024, 1, 1)
+    rows = [(f'sensor_{idx}', src_session, dest_session, fname, old,
+             '>f+++++++++', False, False)
+            for idx, fname in enumerate(fnames)]
+    # a copy to another destination that is not finished
+    rows.append(('sensor_0', src_session, other_session, fnames[0], old,
+                 '>f+++++++++', False, False))
+    db_table.insert_rows(rows, cols=['log_sensor_file_id', 'src_dirname',
+                                     'dest_dirname', 'fname', 'time_verified',
+                                     'rsync_operation', 'is_deleted',
+                                     'is_finished'])
+
+    # the rows of other destinations are left alone
+    _update_copystatus(db_table, show_unfinished=True, dest_dir=dest_session)
+    df = db_table.query().sort_index()
+    assert len(df) == 3
+    assert df.fname.tolist() == [fnames[0], fnames[2], fnames[0]]
+    assert df.is_finished.tolist() == [True, True, False]
+    assert (df.time_verified.iloc[:2] > old).all()
+    assert (df.time_verified.iloc[2:] == old).all()
+    assert df.dest_dirname.tolist() == [dest_session] * 2 + [other_session]
+
+    # unfinished rows are kept unless show_unfinished is True
+    _update_copystatus(db_table)
+    assert len(db_table.query()) == 3
+    _update_copystatus(db_table, show_unfinished=True)
+    df = db_table.query()
+    assert len(df) == 2 and df.is_finished.all()
+
+
 def test_write(mock_data):
     """Test writing files."""
     src_dirname, _ = mock_data
@@ -78,6 +231,99 @@ def test_write(mock_data):
         write_files(sensor_file_table, db_table, dest_dir)
 
 
+def test_write_files_bulk():
+    """Test writing the files of all the sessions at once."""
+    nas_root = mkdtemp()
+    sensor_file_paths = dict()
+    for session in ['100001_2024-01-01', '100002_2024-01-02']:
+        os.mkdir(os.path.join(nas_root, session))
+        for idx in range(3):
+            fname = f'{session}/{session}_file{idx}.dat'
+            with open(os.path.join(nas_root, fname), 'wb') as fp:
+                fp.write(b'Hello world!')
+            sensor_file_paths[f'{session}_{idx}'] = [fname]
+    # a file that is not in NAS is not written
+    sensor_file_paths['missing'] = ['100001_2024-01-01/missing.dat']
+    # a file written without the session directory prefix
+    fname = '100002_2024-01-02_task.json'
+    with open(os.path.join(nas_root, '100002_2024-01-02', fname), 'w') as fp:
+        fp.write('{}')
+    sensor_file_paths['json'] = [fname]
+    sensor_file_df = pd.DataFrame(
+        dict(sensor_file_path=sensor_file_paths.values()),
+        index=sensor_file_paths.keys())
+
+    table_id = 'log_file_test_bulk'
+    with psycopg2.connect(port='5432', host='localhost', **db_args) as conn:
+        drop_table(table_id, conn)
+        create_table(table_id, conn,
+                     ['operation_id', 'log_sensor_file_id', 'src_dirname',
+                      'dest_dirname', 'fname', 'time_verified',
+                      'rsync_operation', 'is_deleted', 'is_finished'],
+                     ['SERIAL', 'text', 'text', 'text', 'text', 'timestamp',
+                      'text', 'boolean', 'boolean'],
+                     primary_key='operation_id')
+        db_table = Table(table_id, conn)
+
+        # the first session is already written
+        write_files(sensor_file_df, db_table,
+                    os.path.join(nas_root, '100001_2024-01-01'))
+        assert len(db_table.query()) == 3
+        column_values = write_files_bulk(sensor_file_df, db_table, nas_root)
+        assert len(column_values) == 4
+        df = db_table.query()
+        assert len(df) == 7
+        assert fname in df.fname.tolist()
+        assert df.fname.is_unique
+        # no new files
+        assert write_files_bulk(sensor_file_df, db_table, nas_root) == list()
+        drop_table(table_id, conn)
+    shutil.rmtree(nas_root)
+
+
+def test_get_sensor_fnames():
+    """Test grouping the sensor files by session."""
+    sensor_file_df = pd.DataFrame(
+        dict(sensor_file_path=[['100001_2024-01-01/100001_2024-01-01_a.csv',
+                                '100001_2024-01-01/100001_2024-01-01_b.csv'],
+                               ['100001_2024-01-01_task.json'],
+                               ['100002_2024-01-02/100002_2024-01-02_a.csv']]),
+        index=['sensor_1', 'sensor_2', 'sensor_3'])
+    sensor_fnames = _get_sensor_fnames(
+        sensor_file_df, ['100001_2024-01-01', '100003_2024-01-03'])
+    assert sorted(sensor_fnames) == ['100001_2024-01-01', '100003_2024-01-03']
+    assert sorted(sensor_fnames['100001_2024-01-01']) == [
+        ('sensor_1', '100001_2024-01-01/100001_2024-01-01_a.csv'),
+        ('sensor_1', '100001_2024-01-01/100001_2024-01-01_b.csv'),
+        ('sensor_2', '100001_2024-01-01_task.json')]
+    assert sensor_fnames['100003_2024-01-03'] == list()
+
+
+def test_query_sensor_files():
+    """Test querying the sensor files without duplicates."""
+    table_id = 'log_sensor_file_test_dedup'
+    with psycopg2.connect(port='5432', host='localhost', **db_args) as conn:
+        drop_table(table_id, conn)
+        create_table(table_id, conn,
+                     ['log_sensor_file_id', 'sensor_file_path'],
+                     ['VARCHAR (255)', 'text[]'],
+                     primary_key='log_sensor_file_id')
+        table = Table(table_id, conn)
+        # acc and gyr of the same device share their files
+        table.insert_rows([('mbient_gyr', ['s1/mbient.csv']),
+                           ('mbient_acc', ['s1/mbient.csv']),
+                           ('intel_rgb', ['s1/intel.bag', 's1/intel.avi']),
+                           ('intel_depth', ['s1/intel.bag', 's1/intel.avi']),
+                           ('other', ['s1/intel.bagxs1/intel.avi']),
+                           ('reversed', ['s1/intel.avi', 's1/intel.bag'])],
+                          cols=['log_sensor_file_id', 'sensor_file_path'])
+        df = query_sensor_files(table)
+        assert sorted(df.index) == ['intel_depth', 'mbient_acc', 'other',
+                                    'reversed']
+        assert list(df.columns) == ['sensor_file_path']
+        drop_table(table_id, conn)
+
+
 def test_copy(mock_data):
     """Test copy of files."""
     src_dirname, dest_dirname = mock_data
@@ -99,3 +345,381 @@ def test_delete(mock_data):
         df = db_table.query(where='is_deleted=True')
         assert df.src_dirname.isna().all()  # directly written not copied
         assert (df.dest_dirname == src_dirname).all()
+
+
+def test_verify_pairs():
+    """Test comparing source and destination files."""
+    src_dirname, dest_dirname = mkdtemp(), mkdtemp()
+    pairs = list()
+    for fname, src_text, dest_text in [('same.txt', 'abc', 'abc'),
+                                       ('edited.txt', 'abc', 'abd'),
+                                       ('missing.txt', 'abc', None)]:
+        pair = (os.path.join(src_dirname, fname),
+                os.path.join(dest_dirname, fname))
+        with open(pair[0], 'w') as fp:
+            fp.write(src_text)
+        if dest_text is not None:
+            with open(pair[1], 'w') as fp:
+                fp.write(dest_text)
+        pairs.append(pair)
+
+    # files that cannot be read do not match
+    pair = (os.path.join(src_dirname, 'unreadable'),
+            os.path.join(dest_dirname, 'unreadable'))
+    for dirname in pair:
+        os.mkdir(dirname)
+    pairs.append(pair)
+
+    match = verify_pairs(pairs, n_workers=2, chunk_size=2)
+    assert [match[pair] for pair in pairs] == [True, False, False, False]
+
+
+def test_hash_cache():
+    """Test reusing the hashes of unchanged files."""
+    src_dirname, dest_dirname = mkdtemp(), mkdtemp()
+    pair = (os.path.join(src_dirname, 'a.txt'),
+            os.path.join(dest_dirname, 'a.txt'))
+    for fname in pair:
+        with open(fname, 'w') as fp:
+            fp.write('abc')
+
+    with HashCache(os.path.join(mkdtemp(), 'hash.db'),
+                   max_entries=10) as hash_cache:
+        assert verify_pairs([pair], hash_cache=hash_cache)[pair]
+        assert len(hash_cache) == 2
+        stat = os.stat(pair[1])
+        assert hash_cache.get(pair[1], stat) is not None
+
+        # stale hash is not used after the file is edited
+        hash_cache.set(pair[1], stat, 'stale')
+        assert not verify_pairs([pair], hash_cache=hash_cache)[pair]
+        with open(pair[1], 'w') as fp:
+            fp.write('abcd')
+        assert hash_cache.get(pair[1], os.stat(pair[1])) is None
+        assert not verify_pairs([pair], hash_cache=hash_cache)[pair]
+
+        hash_cache.invalidate(dest_dirname)
+        assert len(hash_cache) == 1
+        hash_cache.max_entries = 0
+        hash_cache.evict()
+        assert len(hash_cache) == 0
+
+
+def test_get_volume_to_fill():
+    """Test choosing the volume to copy a session to."""
+    volumes = [mkdtemp(), mkdtemp()]  # same disk, so same usage
+    free = shutil.disk_usage(volumes[0]).free
+    # bytes reserved by sessions being copied count as used
+    assert get_volume_to_fill(volumes, 0, reserved={volumes[0]: 1}) == \
+        volumes[1]
+    assert get_volume_to_fill(volumes, 0, reserved={volumes[1]: 1}) == \
+        volumes[0]
+    with pytest.raises(ValueError, match='available volume'):
+        get_volume_to_fill(volumes, free, reserved={volumes[0]: free})
+    with pytest.raises(ValueError, match='available volume'):
+        get_volume_to_fill(volumes, 0, free_volume_threshold=2)
+
+
+def test_volume_index():
+    """Test the index of the sessions and disk usage of the volumes."""
+    volumes = [mkdtemp(), mkdtemp()]
+    os.mkdir(os.path.join(volumes[0], 'session_1'))
+    os.mkdir(os.path.join(volumes[1], 'session_1'))
+    os.mkdir(os.path.join(volumes[1], 'session_2'))
+
+    volume_index = VolumeIndex(volumes)
+    assert volume_index.find('session_1') == volumes[0]  # first volume
+    assert volume_index.find('session_2') == volumes[1]
+    assert volume_index.find('session_3') is None
+    volume_index.add('session_3', volumes[1])
+    assert volume_index.find('session_3') == volumes[1]
+
+    # queued sessions count as used space
+    volume_index.reserve(volumes[0], 1)
+    assert volume_index.get_volume_to_fill(0) == volumes[1]
+    volume_index.reserve(volumes[1], 2)
+    assert volume_index.get_volume_to_fill(0) == volumes[0]
+    volume_index.release(volumes[1], 2)
+    assert volume_index.get_volume_to_fill(0) == volumes[1]
+    assert volume_index.get_volume_to_fill(0, volumes=volumes[:1]) == \
+        volumes[0]
+
+    # the disk usage is cached
+    stats = volume_index.disk_usage(volumes[0])
+    assert volume_index.disk_usage(volumes[0]) is stats
+    volume_index.ttl = 0.
+    assert volume_index.disk_usage(volumes[0]) is not stats
+
+    volume_index.refresh()
+    assert volume_index.find('session_3') is None
+    for vol in volumes:
+        shutil.rmtree(vol)
+
+
+def test_parse_rsync_line():
+    """Test parsing the itemized changes of rsync."""
+    assert _parse_rsync_line('>f+++++++++ sess/a.hdf5 2024/01/01 10:00:00') \
+        == ('>f+++++++++', 'sess/a.hdf5')
+    assert _parse_rsync_line('>f.st...... sess/a b.txt 2024/01/01 10:00:00') \
+        == ('>f.st......', 'sess/a b.txt')
+    assert _parse_rsync_line('cd+++++++++ sess/ 2024/01/01 10:00:00') is None
+    assert _parse_rsync_line('') is None
+
+
+def test_plan_deletion():
+    """Test choosing the files to delete to free some space."""
+    dirname = mkdtemp()
+    now = time.time()
+    fnames = dict()
+    for name, size, age in [('old_small', 10, 300), ('old_big', 100, 300),
+                            ('mid', 50, 200), ('new', 500, 0)]:
+        fnames[name] = os.path.join(dirname, name)
+        with open(fnames[name], 'wb') as fp:
+            fp.write(b'x' * size)
+        os.utime(fnames[name], (now - age, now - age))
+    missing_fname = os.path.join(dirname, 'missing')
+
+    # oldest first, then largest first
+    planned_fnames, planned_bytes = _plan_deletion(
+        list(fnames.values()) + [missing_fname], 105)
+    assert planned_fnames == {fnames['old_big']: 100,
+                              fnames['old_small']: 10}
+    assert planned_bytes == 110
+    assert _plan_deletion(fnames.values(), 0) == (dict(), 0)
+    # not enough files to free the space
+    assert _plan_deletion(fnames.values(), 10 ** 6)[1] == 660
+    shutil.rmtree(dirname)
+
+
+@pytest.mark.skipif(shutil.which('rsync') is None, reason='requires rsync')
+def test_copy_files_single_pass(log_tables, monkeypatch):
+    """Test copying files with one rsync, also after an interruption."""
+    db_table = log_tables['db_table']
+    sensor_file_table = log_tables['sensor_file_table']
+    src_dir = os.path.join(log_tables['src_dirname'], log_tables['session'])
+    dest_dir = os.path.join(log_tables['dest_dirname'], log_tables['session'])
+
+    # interrupt the copy when writing the second file to log_file
+    insert_log_file_rows = dataflow._insert_log_file_rows
+    n_calls = list()
+
+    def _insert_and_interrupt(*args):
+        n_calls.append(1)
+        if len(n_calls) == 2:
+            raise KeyboardInterrupt
+        return insert_log_file_rows(*args)
+
+    monkeypatch.setattr(dataflow, '_insert_log_file_rows',
+                        _insert_and_interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        dataflow._copy_files_single_pass(src_dir, dest_dir, db_table,
+                                         sensor_file_table, batch_size=1)
+    monkeypatch.undo()
+    assert len(n_calls) == 3  # the remaining files are written on exit
+
+    # every file copied by rsync has a row, not verified yet
+    df = db_table.query()
+    copied_fnames = {f'{log_tables["session"]}/{fname}'
+                     for fname in os.listdir(dest_dir)}
+    # the file of the crashed task is not tracked
+    copied_fnames -= {log_tables['fnames'][2]}
+    assert len(df) > 0
+    assert set(df.fname) >= copied_fnames
+    assert not df.is_finished.any()
+
+    # the next run verifies the rows and copies the rest, writing the
+    # files in one batch
+    shutil.rmtree(dest_dir)
+    n_calls = list()
+
+    def _insert(*args):
+        n_calls.append(1)
+        return insert_log_file_rows(*args)
+
+    monkeypatch.setattr(dataflow, '_insert_log_file_rows', _insert)
+    copy_files(src_dir, dest_dir, db_table, sensor_file_table,
+               single_pass=True)
+    monkeypatch.undo()
+    assert len(n_calls) == 1
+    df = db_table.query()
+    assert sorted(df.fname) == sorted(log_tables['fnames'][:2])
+    assert df.is_finished.all()
+    assert df.time_verified.notna().all()
+    assert (df.dest_dirname == os.path.join(dest_dir, '')).all()
+
+    # nothing new to copy
+    assert copy_files(src_dir, dest_dir, db_table, sensor_file_table,
+                      single_pass=True) == list()
+    assert len(db_table.query()) == 2
+
+
+@pytest.mark.skipif(shutil.which('rsync') is None, reason='requires rsync')
+def test_copy_sessions(log_tables):
+    """Test copying sessions in worker processes."""
+    db_table = log_tables['db_table']
+    volumes = [mkdtemp(), mkdtemp()]
+    # a copy to another volume that crashed in a previous run
+    db_table.insert_rows([('sensor_1', '/nas/', '/other/', 'missing.csv',
+                           False, False)],
+                         cols=['log_sensor_file_id', 'src_dirname',
+                               'dest_dirname', 'fname', 'is_deleted',
+                               'is_finished'])
+
+    results = copy_sessions(
+        [log_tables['session']], log_tables['src_dirname'], volumes,
+        dict(port='5432', host='localhost', **db_args), reserve_threshold=0,
+        n_jobs=2, table_id='log_file_test',
+        sensor_file_table_id='log_sensor_file_test')
+    assert len(results) == 1
+    assert results[0]['error'] is None
+    assert results[0]['n_files'] == 2
+    dest_dir = results[0]['dest_dir']
+    assert os.path.dirname(dest_dir) in volumes
+
+    # the unfinished copy to the other volume is removed
+    df = db_table.query()
+    assert sorted(df.fname) == sorted(log_tables['fnames'][:2])
+    assert df.is_finished.all()
+    assert (df.dest_dirname == os.path.join(dest_dir, '')).all()
+    for vol in volumes:
+        shutil.rmtree(vol)
+
+
+class _ThreadPoolExecutor(ThreadPoolExecutor):
+    """Executor in threads accepting the arguments of ProcessPoolExecutor."""
+    def __init__(self, max_workers, mp_context=None):
+        super().__init__(max_workers=max_workers)
+
+
+def test_copy_sessions_errors(log_tables, monkeypatch):
+    """Test that copy_sessions reports the sessions that failed."""
+    src_dirname = log_tables['src_dirname']
+    for session in ['100002_2024-01-02', '100003_2024-01-03']:
+        os.mkdir(os.path.join(src_dirname, session))
+    sessions = sorted(os.listdir(src_dirname))
+    volumes = [mkdtemp(), mkdtemp()]
+
+    def _copy_session(session, src_dir, dest_dir, *args):
+        if session == sessions[1]:
+            raise RuntimeError('worker died')
+        return dict(session=session, dest_dir=dest_dir, n_files=0,
+                    duration=0., error=None)
+
+    monkeypatch.setattr(dataflow, 'ProcessPoolExecutor', _ThreadPoolExecutor)
+    monkeypatch.setattr(dataflow, '_copy_session', _copy_session)
+    db_args_copy = dict(port='5432', host='localhost', **db_args)
+    results = copy_sessions(sessions, src_dirname, volumes, db_args_copy,
+                            reserve_threshold=0, table_id='log_file_test',
+                            sensor_file_table_id='log_sensor_file_test')
+    results = {result['session']: result for result in results}
+    assert sorted(results) == sessions
+    assert results[sessions[0]]['error'] is None
+    assert results[sessions[1]]['error'] == 'RuntimeError: worker died'
+    assert results[sessions[2]]['error'] is None
+
+    # no volume has enough space
+    free = shutil.disk_usage(volumes[0]).free
+    with pytest.warns(UserWarning, match='were not copied'):
+        results = copy_sessions(sessions, src_dirname, volumes, db_args_copy,
+                                reserve_threshold=free,
+                                table_id='log_file_test',
+                                sensor_file_table_id='log_sensor_file_test')
+    assert len(results) == len(sessions)
+    assert all('available volume' in result['error'] for result in results)
+    for vol in volumes:
+        shutil.rmtree(vol)
+
+
+def test_copy_sessions_scheduling(log_tables, monkeypatch):
+    """Test copying more sessions than volumes."""
+    src_dirname = log_tables['src_dirname']
+    for idx in range(2, 7):
+        os.mkdir(os.path.join(src_dirname, f'10000{idx}_2024-01-0{idx}'))
+    sessions = sorted(os.listdir(src_dirname))
+    volumes = [mkdtemp(), mkdtemp(), mkdtemp()]
+
+    def _copy_session(session, src_dir, dest_dir, *args):
+        time.sleep(0.05)
+        return dict(session=session, dest_dir=dest_dir, n_files=0,
+                    duration=0.05, error=None)
+
+    walked = list()
+
+    def _get_dir_size(dirname):
+        walked.append(dirname)
+        return 0
+
+    monkeypatch.setattr(dataflow, 'ProcessPoolExecutor', _ThreadPoolExecutor)
+    monkeypatch.setattr(dataflow, '_copy_session', _copy_session)
+    monkeypatch.setattr(dataflow, '_get_dir_size', _get_dir_size)
+    db_args_copy = dict(port='5432', host='localhost', **db_args)
+    # the busy volumes still count as free volumes
+    results = copy_sessions(sessions, src_dirname, volumes, db_args_copy,
+                            reserve_threshold=0, n_jobs=4,
+                            max_jobs_per_volume=1, free_volume_threshold=1,
+                            table_id='log_file_test',
+                            sensor_file_table_id='log_sensor_file_test')
+    assert sorted(result['session'] for result in results) == sessions
+    assert all(result['error'] is None for result in results)
+    dest_dirs = [os.path.dirname(result['dest_dir']) for result in results]
+    assert set(dest_dirs) == set(volumes)
+    # the size of each session is computed once
+    assert sorted(walked) == [os.path.join(src_dirname, session)
+                              for session in sessions]
+    for vol in volumes:
+        shutil.rmtree(vol)
+
+
+def test_delete_files(log_tables, monkeypatch):
+    """Test deleting the files copied to a volume."""
+    db_table = log_tables['db_table']
+    nas, volume = log_tables['src_dirname'], log_tables['dest_dirname']
+    session = log_tables['session']
+    fnames = log_tables['fnames'] + [f'{session}/{session}_missing.csv']
+    nas_session = os.path.join(nas, session, '')
+    volume_session = os.path.join(volume, session, '')
+    old = datetime.datetime.now() - datetime.timedelta(days=100)
+
+    # the first file has two rows, e.g., for acc and gyr
+    write_rows = [(f'sensor_{idx}', None, nas_session, fname, old, None,
+                   False, None)
+                  for idx, fname in enumerate(fnames + fnames[:1])]
+    copy_rows = [(f'sensor_{idx}', nas_session, volume_session, fname, old,
+                  '>f+++++++++', False, True)
+                 for idx, fname in enumerate(fnames)]
+    db_table.insert_rows(write_rows + copy_rows,
+                         cols=['log_sensor_file_id', 'src_dirname',
+                               'dest_dirname', 'fname', 'time_verified',
+                               'rsync_operation', 'is_deleted',
+                               'is_finished'])
+    kwargs = dict(threshold=0., record_older_than=10, copied_older_than=10)
+
+    operation_ids = delete_files(db_table, nas, [volume], dry_run=True,
+                                 **kwargs)
+    assert len(operation_ids) == 4  # the missing file is not deleted
+    assert db_table.query(where={'is_deleted': True}).empty
+    assert len(os.listdir(nas_session)) == 3
+
+    # a file that cannot be deleted does not prevent recording the others
+    remove = os.remove
+
+    def _remove(fname):
+        if fname.endswith(fnames[1]):
+            raise PermissionError(f'Permission denied: {fname}')
+        remove(fname)
+
+    monkeypatch.setattr(os, 'remove', _remove)
+    operation_ids = delete_files(db_table, nas, [volume], dry_run=False,
+                                 **kwargs)
+    monkeypatch.undo()
+    assert len(operation_ids) == 3
+    df = db_table.query(where={'is_deleted': True})
+    assert sorted(df.fname) == sorted([fnames[0], fnames[0], fnames[2]])
+    assert (df.dest_dirname == nas_session).all()
+    assert os.listdir(nas_session) == [os.path.basename(fnames[1])]
+
+    # only the file that failed is deleted again
+    operation_ids = delete_files(db_table, nas, [volume], dry_run=False,
+                                 **kwargs)
+    assert len(operation_ids) == 1
+    assert os.listdir(nas_session) == list()
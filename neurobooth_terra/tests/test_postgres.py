@@ -1,12 +1,15 @@
 import datetime
 
 import psycopg2
+import pandas as pd
 
 import pytest
 from numpy.testing import assert_raises
 
-from neurobooth_terra import Table, create_table, drop_table, query, list_tables
-from neurobooth_terra.postgres import execute
+from neurobooth_terra import (Table, create_table, drop_table, query,
+                              iter_query, list_tables, transaction)
+from neurobooth_terra.postgres import (execute, invalidate_schema_cache,
+                                       build_where, _prepared_statements)
 import scripts.credential_reader as reader
 
 db_args = reader.read_db_secrets()
@@ -205,3 +208,316 @@ def test_upsert():
     df = table_subject.query()
     assert 'yyyy' not in df.index
     assert 'blah' in df.index
+
+
+def test_insert_rows_copy():
+    """Test bulk insertion with COPY."""
+
+    conn = psycopg2.connect(connect_str)
+
+    table_id = 'test'
+    drop_table(table_id, conn)
+
+    column_names = ['subject_id', 'first_name_birth', 'Age', 'attributes',
+                    'indicators', 'consent_date']
+    dtypes = ['VARCHAR (255)', 'VARCHAR (255)', 'INTEGER', 'JSONB',
+              'smallint[]', 'date']
+    table_subject = create_table(table_id, conn=conn,
+                                 column_names=column_names,
+                                 dtypes=dtypes)
+    rows = [('x5dc', 'mainak', 21, {'a': 1}, [1, 2],
+             datetime.date(2022, 1, 1)),
+            ('y5d3', 'tab\there\\ "quoted"\nline', None, {'b': 'c"d'}, [],
+             None),
+            ('abcd', None, 25, None, None, datetime.date(2022, 1, 3))]
+    table_subject.insert_rows(rows, cols=column_names, method='copy')
+    df = table_subject.query()
+    assert len(df) == 3
+    assert df.loc['y5d3']['first_name_birth'] == 'tab\there\\ "quoted"\nline'
+    assert df.loc['y5d3']['attributes'] == {'b': 'c"d'}
+    assert df.loc['x5dc']['indicators'] == [1, 2]
+    assert df.loc['y5d3']['indicators'] == []
+    assert df.loc['abcd']['attributes'] is None
+
+    # upsert through the staging table
+    table_subject.insert_rows([('x5dc', 'mainak', 32, {'a': 2}, [3], None),
+                               ('zzzz', 'deepak', 30, None, [1], None)],
+                              cols=column_names, on_conflict='update',
+                              update_cols=['Age'], method='copy')
+    df = table_subject.query()
+    assert df.loc['x5dc']['Age'] == 32
+    assert df.loc['x5dc']['attributes'] == {'a': 1}  # not updated
+    assert 'zzzz' in df.index
+
+    table_subject.insert_rows([('zzzz', 'deepak_new', 31, None, None, None)],
+                              cols=column_names, on_conflict='nothing',
+                              method='copy')
+    df = table_subject.query()
+    assert df.loc['zzzz']['first_name_birth'] == 'deepak'
+
+    pk_val = table_subject.insert_rows(
+        [('wxyz', 'adonay', 33, None, None, None)], cols=column_names,
+        method='copy')
+    assert pk_val == 'wxyz'
+
+    with pytest.raises(ValueError, match='method must be one of'):
+        table_subject.insert_rows(rows, cols=column_names, method='blah')
+    conn.close()
+
+
+def test_transaction():
+    """Test grouping statements in a transaction."""
+
+    conn = psycopg2.connect(connect_str)
+
+    table_id = 'test'
+    drop_table(table_id, conn)
+
+    column_names = ['subject_id', 'first_name_birth']
+    dtypes = ['VARCHAR (255)', 'VARCHAR (255)']
+    table_subject = create_table(table_id, conn=conn,
+                                 column_names=column_names,
+                                 dtypes=dtypes)
+
+    # rows are not visible to other connections until the block exits
+    conn_other = psycopg2.connect(connect_str)
+    table_other = Table(table_id, conn_other)
+    with transaction(conn):
+        table_subject.insert_rows([('x5dc', 'mainak')], cols=column_names)
+        with transaction(conn):  # nested block does not commit
+            table_subject.insert_rows([('y5d3', 'anoopum')],
+                                      cols=column_names)
+        assert len(table_other.query()) == 0
+    assert len(table_other.query()) == 2
+
+    # everything is rolled back on error
+    with pytest.raises(ValueError, match='abort'):
+        with transaction(conn):
+            table_subject.insert_rows([('abcd', 'mayank')],
+                                      cols=column_names)
+            raise ValueError('abort')
+    df = table_subject.query()
+    assert 'abcd' not in df.index
+
+    # commits resume after the block
+    table_subject.insert_rows([('abcd', 'mayank')], cols=column_names)
+    assert 'abcd' in table_other.query().index
+    conn_other.close()
+    conn.close()
+
+
+def test_schema_cache():
+    """Test that the schema of tables is cached."""
+    conn = psycopg2.connect(connect_str)
+
+    table_id = 'test'
+    drop_table(table_id, conn)
+    column_names = ['subject_id', 'first_name_birth']
+    dtypes = ['VARCHAR (255)', 'VARCHAR (255)']
+    create_table(table_id, conn, column_names, dtypes)
+
+    table = Table(table_id, conn)
+    assert table.column_names == column_names
+    assert table.primary_key == ['subject_id']
+
+    # changes outside Table are not seen until the cache is invalidated
+    execute(conn, conn.cursor(), f'ALTER TABLE {table_id} ADD COLUMN age INT')
+    assert Table(table_id, conn).column_names == column_names
+    invalidate_schema_cache(conn, table_id)
+    assert Table(table_id, conn).column_names == column_names + ['age']
+
+    # Table methods invalidate the cache
+    table = Table(table_id, conn)
+    table.drop_column('age')
+    assert Table(table_id, conn).column_names == column_names
+    table.add_column('last_name_birth', 'VARCHAR (255)')
+    assert 'last_name_birth' in Table(table_id, conn).column_names
+
+    # other connections share the cache
+    conn2 = psycopg2.connect(connect_str)
+    assert 'last_name_birth' in Table(table_id, conn2).column_names
+    conn2.close()
+
+    # tables created or altered in a rolled back transaction are not cached
+    drop_table('test2', conn)
+    with pytest.raises(ValueError, match='abort'):
+        with transaction(conn):
+            create_table('test2', conn, column_names, dtypes)
+            table.add_column('age', 'INT')
+            assert Table('test2', conn).column_names == column_names
+            assert 'age' in Table(table_id, conn).column_names
+            raise ValueError('abort')
+    assert 'test2' not in list_tables(conn)
+    with pytest.raises(Exception, match='does not exist'):
+        Table('test2', conn)
+    conn.rollback()
+    assert 'age' not in Table(table_id, conn).column_names
+
+    drop_table(table_id, conn)
+    create_table(table_id, conn, ['subject_id', 'Age'],
+                 ['VARCHAR (255)', 'INTEGER'])
+    table = Table(table_id, conn)
+    assert table.column_names == ['subject_id', 'Age']
+    assert table.data_types == ['VARCHAR (255)', 'INTEGER']
+    conn.close()
+
+
+def test_iter_query():
+    """Test streaming query results in chunks."""
+    conn = psycopg2.connect(connect_str)
+
+    table_id = 'test'
+    drop_table(table_id, conn)
+    column_names = ['subject_id', 'first_name_birth', 'Age']
+    dtypes = ['VARCHAR (255)', 'VARCHAR (255)', 'INTEGER']
+    table_subject = create_table(table_id, conn=conn,
+                                 column_names=column_names,
+                                 dtypes=dtypes)
+    rows = [(f'subj{idx}', f'name{idx}', idx) for idx in range(25)]
+    table_subject.insert_rows(rows, cols=column_names)
+
+    dfs = list(table_subject.iter_query(where='"Age" >= 5', chunksize=7))
+    assert [len(df) for df in dfs] == [7, 7, 6]
+    assert all(df.index.name == 'subject_id' for df in dfs)
+    df = pd.concat(dfs)
+    assert df.equals(table_subject.query(where='"Age" >= 5'))
+
+    # cursor survives commits made while iterating
+    for df in table_subject.iter_query(include_columns='subject_id',
+                                       chunksize=10):
+        table_subject.delete_row(
+            f"subject_id IN ({', '.join(repr(pk) for pk in df.index)})")
+    assert len(table_subject.query()) == 0
+
+    dfs = list(iter_query(conn, f'SELECT * FROM {table_id}',
+                          column_names, chunksize=10))
+    assert len(dfs) == 0
+    conn.close()
+
+
+def test_update_rows():
+    """Test updating many rows at once."""
+    conn = psycopg2.connect(connect_str)
+
+    table_id = 'test'
+    drop_table(table_id, conn)
+    column_names = ['subject_id', 'visit', 'sensor_file_path', 'details',
+                    'Age']
+    dtypes = ['VARCHAR (255)', 'INTEGER', 'text[]', 'json', 'INTEGER']
+    table_subject = create_table(table_id, conn=conn,
+                                 column_names=column_names,
+                                 dtypes=dtypes,
+                                 primary_key=['subject_id', 'visit'])
+    table_subject.insert_rows([('x5ad', 1, ['a.csv'], None, 20),
+                               ('x5ad', 2, None, None, 21),
+                               ('y5d3', 1, None, None, 30)],
+                              cols=column_names)
+
+    # compound primary key, array and json columns, several pages
+    table_subject.update_rows(
+        [('x5ad', 1), ('y5d3', 1)],
+        [(['b.csv', 'c.csv'], {'hand': 'left'}, '22'), ([], None, 31)],
+        cols=['sensor_file_path', 'details', 'Age'], page_size=1)
+    df = table_subject.query().reset_index().set_index(['subject_id', 'visit'])
+    assert df.loc[('x5ad', 1), 'sensor_file_path'] == ['b.csv', 'c.csv']
+    assert df.loc[('x5ad', 1), 'details'] == {'hand': 'left'}
+    assert df.loc[('x5ad', 1), 'Age'] == 22
+    assert df.loc[('y5d3', 1), 'sensor_file_path'] == []
+    assert df.loc[('y5d3', 1), 'Age'] == 31
+    assert df.loc[('x5ad', 2), 'Age'] == 21  # not updated
+
+    # the primary key can be updated
+    table_subject.update_rows([('x5ad', 2)], [(3,)], cols=['visit'])
+    assert len(table_subject.query(where="visit = 3")) == 1
+
+    # update_row matches the whole compound primary key with a tuple and
+    # only its first column with a single value
+    table_subject.update_row(('x5ad', 3), (25,), cols=['Age'])
+    df = table_subject.query(where={'subject_id': 'x5ad'})
+    assert sorted(df['Age']) == [22, 25]
+    table_subject.update_row('x5ad', (26,), cols=['Age'])
+    df = table_subject.query(where={'subject_id': 'x5ad'})
+    assert df['Age'].tolist() == [26, 26]
+    with pytest.raises(ValueError, match='must have 2 values'):
+        table_subject.update_row(('x5ad',), (1,), cols=['Age'])
+
+    # primary key values and columns can be lists or tuples
+    table = Table(table_id, conn, primary_key=('subject_id', 'visit'))
+    table.update_rows([['x5ad', 3]], [(23,)], cols=('Age',))
+    assert len(table.query(where={'Age': 23, 'visit': 3})) == 1
+
+    # the column types are cached
+    execute(conn, conn.cursor(), f'ALTER TABLE {table_id} DROP COLUMN "Age"')
+    execute(conn, conn.cursor(), f'ALTER TABLE {table_id} ADD COLUMN "Age" text')
+    with pytest.raises(Exception, match='integer'):
+        table_subject.update_rows([('y5d3', 1)], [('old',)], cols=['Age'])
+    conn.rollback()
+    invalidate_schema_cache(conn, table_id)
+    table_subject.update_rows([('y5d3', 1)], [('new',)], cols=['Age'])
+    df = table_subject.query(where={'subject_id': 'y5d3'})
+    assert df['Age'].tolist() == ['new']
+
+    with pytest.raises(ValueError, match='length of pk_vals'):
+        table_subject.update_rows([('x5ad', 1)], [], cols=['Age'])
+    with pytest.raises(ValueError, match='must have 2 values'):
+        table_subject.update_rows(['x5ad'], [(1,)], cols=['Age'])
+    with pytest.raises(ValueError, match='not present'):
+        table_subject.update_rows([('x5ad', 1)], [(1,)], cols=['height'])
+    conn.close()
+
+
+def test_query_params():
+    """Test structured filters, bound parameters and prepared queries."""
+    conn = psycopg2.connect(connect_str)
+
+    table_id = 'test'
+    drop_table(table_id, conn)
+    column_names = ['subject_id', 'first_name_birth', 'Age']
+    dtypes = ['VARCHAR (255)', 'VARCHAR (255)', 'INTEGER']
+    table_subject = create_table(table_id, conn=conn,
+                                 column_names=column_names,
+                                 dtypes=dtypes)
+    table_subject.insert_rows([('x5ad', "O'Neil", 20), ('y5d3', '100%', 30),
+                               ('z5d9', None, 40)], cols=column_names)
+
+    assert build_where({'subject_id': ['x5ad'], 'Age': {'>=': 5, '<': 10},
+                        'first_name_birth': None}) == \
+        ('"subject_id" = ANY(%s) AND "Age" >= %s AND "Age" < %s '
+         'AND "first_name_birth" IS NULL', [['x5ad'], 5, 10])
+    assert build_where('"Age" > 5') == ('"Age" > 5', None)
+    with pytest.raises(ValueError, match='operator must be'):
+        build_where({'Age': {'~': 5}})
+    with pytest.raises(ValueError, match='params can only'):
+        build_where({'Age': 5}, params=(5,))
+
+    # quotes and % in values need no escaping
+    df = table_subject.query(where={'first_name_birth': "O'Neil"})
+    assert list(df.index) == ['x5ad']
+    df = table_subject.query(where='first_name_birth = %s', params=('100%',))
+    assert list(df.index) == ['y5d3']
+    df = table_subject.query(where={'Age': {'>': 20, '<=': 40},
+                                    'first_name_birth': {'!=': None}})
+    assert list(df.index) == ['y5d3']
+    df = table_subject.query(where={'subject_id': {'not in': ['x5ad']}})
+    assert sorted(df.index) == ['y5d3', 'z5d9']
+    with pytest.raises(ValueError, match='not present'):
+        table_subject.query(where={'height': 5})
+
+    # the prepared query is reused with different params
+    for subject_id in ['x5ad', 'y5d3', 'z5d9']:
+        df = table_subject.query(where={'subject_id': subject_id},
+                                 prepare=True)
+        assert list(df.index) == [subject_id]
+    assert len(_prepared_statements[conn]) == 1
+    df = query(conn, f'SELECT "Age" FROM {table_id} WHERE "Age" > %(age)s '
+               f'AND "Age" < %(age)s + 15', 'Age', params={'age': 20},
+               prepare=True)
+    assert list(df.Age) == [30]
+
+    table_subject.update_row('x5ad', ("D'Souza", 21),
+                             cols=['first_name_birth', 'Age'])
+    df = table_subject.query(where={'subject_id': 'x5ad'})
+    assert df.first_name_birth.iloc[0] == "D'Souza"
+    table_subject.delete_row(where={'Age': {'>=': 30}})
+    assert list(table_subject.query().index) == ['x5ad']
+    conn.close()
@@ -1,15 +1,23 @@
 import threading
 import queue
 import time
+import os.path as op
+from tempfile import TemporaryDirectory
+from datetime import date
 
+import numpy as np
 from numpy.testing import assert_allclose
 import pandas as pd
 
 import psycopg2
-from neurobooth_terra import create_table
+from neurobooth_terra import create_table, Table
 from neurobooth_terra.postgres import drop_table
 from neurobooth_terra.redcap import (iter_interval, extract_field_annotation,
-                                     map_dtypes, rename_subject_ids)
+                                     map_dtypes, rename_subject_ids,
+                                     dataframe_to_tuple, fetch_survey,
+                                     fetch_surveys, sync_table,
+                                     get_response_array, process_metadata,
+                                     compare_dataframes)
 import scripts.credential_reader as reader
 
 db_args = reader.read_db_secrets()
@@ -71,6 +79,185 @@ def test_map_dtypes():
     assert all(metadata_df['database_dtype'] == ['double precision', 'date'])
 
 
+def test_process_metadata():
+    """Test vectorized parsing of the data dictionary."""
+    metadata = pd.DataFrame({
+        'field_label': ['Record\n', 'Age', 'Race', 'Description', 'Q1'],
+        'form_name': ['demographic'] * 3 + ['scale'] * 2,
+        'section_header': [np.nan] * 4 + ['Header: '],
+        'field_type': ['text', 'text', 'checkbox', 'descriptive', 'radio'],
+        'select_choices_or_calculations': [np.nan, np.nan,
+                                           '1, White | 2, Black', np.nan,
+                                           '0, No|1, Yes, sometimes'],
+        'matrix_group_name': [np.nan] * 4 + ['group'],
+        'field_annotation': ['DB-y', 'DB-y|FOI-motor|FOI-gait', '@HIDDEN',
+                             np.nan, 'DB-y FOI-gait'],
+        'text_validation_type_or_show_slider_number': [np.nan, 'number',
+                                                       np.nan, np.nan,
+                                                       np.nan]},
+        index=pd.Index(['record_id', 'age', 'race', 'desc', 'q1'],
+                       name='field_name'))
+
+    expected = metadata.copy()
+    expected['field_label'] = expected['field_label'].str.strip('\n')
+    expected = expected.apply(map_dtypes, axis=1)
+    expected = expected.apply(extract_field_annotation, axis=1)
+    expected = expected.apply(get_response_array, axis=1)
+
+    with TemporaryDirectory() as cache_dir:
+        processed, table_infos = process_metadata(metadata,
+                                                  cache_dir=cache_dir)
+        processed_cached, table_infos_cached = process_metadata(
+            metadata, cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(processed, processed_cached)
+    assert table_infos == table_infos_cached
+
+    for col in ['database_dtype', 'python_dtype', 'error', 'response_array']:
+        assert processed[col].fillna('').tolist() == \
+            expected[col].fillna('').tolist()
+    assert processed['feature_of_interest'].fillna('').tolist() == \
+        expected['FOI'].fillna('').tolist()
+    assert processed['in_database'].fillna('').tolist() == \
+        expected['DB'].fillna('').tolist()
+    assert processed.loc['q1', 'question'] == 'Header: Q1'
+    assert table_infos['demographic']['columns'][:2] == ['record_id', 'age']
+
+
+def test_dataframe_to_tuple():
+    """Test extracting rows from a survey."""
+    df = pd.DataFrame({'score': [1., np.nan, 3.],
+                       'comments': ['good', 'None', 'nan'],
+                       'race___1': [1., 0., np.nan],
+                       'race___2': [1., 1., 0.]},
+                      index=pd.Index(['1', '2', '3'], name='record_id'))
+    rows, cols = dataframe_to_tuple(df, ['score', 'comments'],
+                                    fixed_columns=dict(study_id='study1'),
+                                    indicator_columns=['race'])
+    assert cols == ['score', 'comments', 'study_id', 'race']
+    assert rows == [(1., 'good', 'study1', [1, 2]),
+                    (None, None, 'study1', [2]),
+                    (3., None, 'study1', [])]
+
+
+class _Project:
+    """Mock of a pycap Project that exports recorded reports."""
+    def __init__(self, reports, latency=0.):
+        self.reports = reports
+        self.latency = latency
+        self.n_active = self.max_active = 0
+        self.request_times = list()
+        self._lock = threading.Lock()
+
+    def export_reports(self, report_id):
+        with self._lock:
+            self.request_times.append(time.monotonic())
+            self.n_active += 1
+            self.max_active = max(self.max_active, self.n_active)
+        time.sleep(self.latency)
+        with self._lock:
+            self.n_active -= 1
+        return self.reports[report_id]
+
+
+def test_fetch_survey_dtypes():
+    """Test that dtypes are inferred as when reading the report from csv."""
+    report = [
+        {'record_id': '100001', 'redcap_event_name': 'v1_arm_1',
+         'age': '34', 'height': '1.72', 'score': '3', 'consent': 'True',
+         'verified': 'False', 'comments': 'walks, fast', 'empty': '',
+         'dob': '1990-01-01', 'mixed': '12', 'complete': '2'},
+        {'record_id': '100002', 'redcap_event_name': 'v1_arm_1',
+         'age': '58', 'height': '', 'score': '', 'consent': 'False',
+         'verified': '', 'comments': 'NA', 'empty': '',
+         'dob': '', 'mixed': 'abc', 'complete': '0'},
+        {'record_id': 'test', 'redcap_event_name': 'v2_arm_1',
+         'age': '61', 'height': '1.6e0', 'score': '1', 'consent': 'TRUE',
+         'verified': 'true', 'comments': 'said "ok"\nleft', 'empty': 'nan',
+         'dob': '1961-12-31', 'mixed': '1.5', 'complete': '1'},
+    ]
+    project = _Project({1: report})
+
+    df = fetch_survey(project, 'demographics', 1, index='record_id')
+
+    with TemporaryDirectory() as temp_dir:
+        csv_fname = op.join(temp_dir, 'demographics.csv')
+        pd.DataFrame(report).to_csv(csv_fname, index=False)
+        df_csv = pd.read_csv(csv_fname)
+    df_csv = df_csv.where(pd.notnull(df_csv), None)
+    df_csv = df_csv.set_index('record_id')
+    df_csv.index = df_csv.index.astype(str)
+    pd.testing.assert_frame_equal(df, df_csv)
+
+    # cast to python_dtype of data dictionary when possible
+    df = fetch_survey(project, 'demographics', 1,
+                      dtypes=dict(age='float64', score='Int64',
+                                  mixed='Int64'))
+    assert df['age'].dtype == 'float64'
+    assert df['score'].dtype == 'Int64'
+    assert df['score'].isna().tolist() == [False, True, False]
+    assert df['mixed'].tolist() == ['12', 'abc', '1.5']
+
+
+def test_fetch_surveys():
+    """Test fetching reports concurrently."""
+    reports = {report_id: [{'record_id': str(report_id), 'score': '1'}]
+               for report_id in range(8)}
+    survey_ids = {f'survey{report_id}': report_id for report_id in reports}
+
+    project = _Project(reports, latency=0.2)
+    t0 = time.monotonic()
+    dfs = dict(fetch_surveys(project, survey_ids, n_jobs=4, rate=None))
+    assert time.monotonic() - t0 < 0.2 * 8 / 2
+    assert project.max_active == 4
+    assert sorted(dfs) == sorted(survey_ids)
+    assert dfs['survey3']['record_id'].tolist() == [3]
+
+    # at most 2 requests at once, then 10 requests per second
+    project = _Project(reports)
+    list(fetch_surveys(project, survey_ids, n_jobs=8, rate=10., burst=2))
+    request_times = np.sort(project.request_times)
+    assert request_times[-1] - request_times[0] > 0.5
+
+
+def test_compare_dataframes():
+    """Test diff of dataframes."""
+    index = pd.Index(['1001', '1002', '1003'], name='subject_id')
+    src_df = pd.DataFrame({'score': [1., 2., np.nan], 'code': [1, 2, 3],
+                           'comments': ['a', 'b', None],
+                           'date': pd.to_datetime(['2020-01-01'] * 3),
+                           'extra': [0, 0, 0]}, index=index)
+    target_df = pd.DataFrame({'score': [1., 5., np.nan],
+                              'code': ['1', '2', '4'],
+                              'comments': ['a', 'b', None],
+                              'date': pd.to_datetime(['2021-01-01'] * 3)},
+                             index=index)
+    target_df = pd.concat([target_df.drop(index='1001'),
+                           target_df.loc[['1001']].rename(index={'1001': '1004'})])
+
+    diff = compare_dataframes(src_df, target_df)
+    assert diff['extra_columns'] == {'extra'}
+    assert diff['added'].tolist() == ['1001']
+    assert diff['removed'].tolist() == ['1004']
+    assert diff['changed'].tolist() == ['1002', '1003']
+    changed_cells = diff['changed_cells']
+    assert changed_cells['column'].tolist() == ['score', 'code']
+    assert changed_cells.index.tolist() == ['1002', '1003']
+    assert changed_cells['target_value'].tolist() == [5., '4']
+
+    # cells where the target is a date are ignored and missing values
+    # of extension dtypes are compared
+    src_df = pd.DataFrame({'visit': ['a', '2020-01-01', 'c'],
+                           'notes': pd.array(['x', pd.NA, 'z'],
+                                             dtype='string')}, index=index)
+    target_df = pd.DataFrame({'visit': ['a', date(2020, 1, 1), 'd'],
+                              'notes': pd.array(['x', pd.NA, 'y'],
+                                                dtype='string')},
+                             index=index)
+    diff = compare_dataframes(src_df, target_df)
+    assert diff['changed'].tolist() == ['1003']
+    assert diff['changed_cells']['column'].tolist() == ['visit', 'notes']
+
+
 def test_rename_subject_ids():
     """Test renaming of subject."""
     table_id = 'subject'
@@ -113,3 +300,56 @@ def test_rename_subject_ids():
         assert '901' in table_df_updated['subject_id'].values
         # only rename, don't add rows
         assert '1003' not in table_df_updated['subject_id'].values
+
+
+def test_sync_table():
+    """Test incremental synchronization of a table."""
+    table_id = 'rc_test_sync'
+    fingerprint_table_id = 'rc_test_fingerprint'
+    column_names = ['subject_id', 'redcap_event_name', 'score']
+    dtypes = ['VARCHAR (255)', 'VARCHAR (255)', 'double precision']
+    rows = [('1001', 'v1_arm_1', 1.), ('1001', 'v2_arm_1', 2.),
+            ('1002', 'v1_arm_1', None)]
+
+    with psycopg2.connect(connect_str) as conn:
+        drop_table(table_id, conn)
+        drop_table(fingerprint_table_id, conn)
+
+        kwargs = dict(fingerprint_table_id=fingerprint_table_id)
+        summary = sync_table(conn, table_id, column_names, dtypes, rows,
+                             column_names, **kwargs)
+        assert summary == dict(rebuilt=True, n_upserted=3, n_deleted=0)
+
+        summary = sync_table(conn, table_id, column_names, dtypes, rows,
+                             column_names, **kwargs)
+        assert summary == dict(rebuilt=False, n_upserted=0, n_deleted=0)
+
+        rows = [('1001', 'v1_arm_1', 1.), ('1001', 'v2_arm_1', 3.)]
+        summary = sync_table(conn, table_id, column_names, dtypes, rows,
+                             column_names, **kwargs)
+        assert summary == dict(rebuilt=False, n_upserted=1, n_deleted=1)
+        df = Table(table_id, conn).query().sort_index()
+        assert df['score'].tolist() == [1., 3.]
+
+        # change of schema recreates the table
+        dtypes[2] = 'integer'
+        summary = sync_table(conn, table_id, column_names, dtypes, rows,
+                             column_names, **kwargs)
+        assert summary == dict(rebuilt=True, n_upserted=2, n_deleted=0)
+        assert len(Table(table_id, conn).query()) == 2
+
+        # rows are deleted when the primary key is not text
+        column_names = ['record_id', 'visit_date', 'score']
+        dtypes = ['integer', 'date', 'double precision']
+        rows = [(1, date(2024, 1, 1), 1.), (2, date(2024, 1, 2), 2.)]
+        kwargs['primary_key'] = ('record_id', 'visit_date')
+        summary = sync_table(conn, table_id, column_names, dtypes, rows,
+                             column_names, **kwargs)
+        assert summary == dict(rebuilt=True, n_upserted=2, n_deleted=0)
+        summary = sync_table(conn, table_id, column_names, dtypes, rows[:1],
+                             column_names, **kwargs)
+        assert summary == dict(rebuilt=False, n_upserted=0, n_deleted=1)
+        assert Table(table_id, conn).query().index.tolist() == [1]
+
+        drop_table(table_id, conn)
+        drop_table(fingerprint_table_id, conn)
@@ -41,8 +41,7 @@ def add_session_prefix(fname):
 
 
 def add_prefix_to_all(files):
-    files = list(map(add_session_prefix, files))
-    return '{' + ','.join(files) + '}'  # Convert list into postgres array string
+    return list(map(add_session_prefix, files))
 
 
 with SSHTunnelForwarder(**ssh_args) as tunnel:
@@ -52,5 +51,7 @@ with SSHTunnelForwarder(**ssh_args) as tunnel:
 
         df['sensor_file_path'] = df['sensor_file_path'].apply(add_prefix_to_all)
 
-        for pk, sensor_file_path in zip(df.index, df['sensor_file_path']):
-            db_table.update_row(pk, (sensor_file_path,), ['sensor_file_path'])
+        db_table.update_rows(list(df.index),
+                             [(sensor_file_path,) for sensor_file_path
+                              in df['sensor_file_path']],
+                             ['sensor_file_path'])
@@ -35,13 +35,11 @@ with SSHTunnelForwarder(**ssh_args) as tunnel:
         df = pd.DataFrame()
         df = db_table.query(where=where)
         
-        for operation_id, src_dirname, dest_dirname in zip(df.index,
-                                                           df.src_dirname,
-                                                           df.dest_dirname
-                                                          ):
-            # print(operation_id, src_dirname+'/', dest_dirname+'/')
-            db_table.insert_rows([(operation_id, src_dirname+'/', dest_dirname+'/')],
-                                 ['operation_id', 'src_dirname', 'dest_dirname'], on_conflict='update')
+        db_table.update_rows(list(df.index),
+                             [(src_dirname+'/', dest_dirname+'/')
+                              for src_dirname, dest_dirname
+                              in zip(df.src_dirname, df.dest_dirname)],
+                             ['src_dirname', 'dest_dirname'])
 
 ### Adding session prefix
 # json and asc files dont have session prefix in log_sensor_file table
@@ -63,8 +61,6 @@ with SSHTunnelForwarder(**ssh_args) as tunnel:
         df = pd.DataFrame()
         df = db_table.query(where=where)
         
-        for operation_id, fname in zip(df.index,
-                                       df.fname.apply(lambda x: add_session_prefix(x))):
-            # print(operation_id, fname)
-            db_table.insert_rows([(operation_id, fname)],
-                                 ['operation_id', 'fname'], on_conflict='update')
+        db_table.update_rows(list(df.index),
+                             [(fname,) for fname in df.fname.apply(add_session_prefix)],
+                             ['fname'])
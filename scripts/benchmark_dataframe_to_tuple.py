@@ -0,0 +1,109 @@
+"""Compare dataframe_to_tuple with the previous row-by-row implementation."""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from neurobooth_terra.redcap import dataframe_to_tuple
+
+n_rows, n_cols = 5000, 400
+if len(sys.argv) > 1:
+    n_rows, n_cols = int(sys.argv[1]), int(sys.argv[2])
+n_checkbox = 10  # the number of indicator columns
+
+
+def combine_indicator_columns_old(df, src_cols, target_col):
+    arr = [list() for _ in range(df.shape[0])]
+    for col_name, val in src_cols.items():
+        for idx, this_element in enumerate(df[col_name]):
+            if this_element == 1.:
+                arr[idx].append(int(val))
+    df[target_col] = arr
+    df.drop(src_cols.keys(), axis=1, inplace=True)
+    return df
+
+
+def dataframe_to_tuple_old(df, df_columns, fixed_columns=None,
+                           indicator_columns=None):
+    if fixed_columns is None:
+        fixed_columns = dict()
+
+    if indicator_columns is None:
+        indicator_columns = list()
+
+    for indicator_column in indicator_columns:
+        mapping = {col: col.split('___')[1] for col in df.columns
+                   if col.startswith(indicator_column + '___')}
+        df = combine_indicator_columns_old(df, mapping, indicator_column)
+
+    rows = list()
+    for index, df_row in df.iterrows():
+
+        row = list()
+        for column_name in df_columns:
+            row.append(df_row[column_name])
+            if not isinstance(row[-1], list) and \
+                    (pd.isna(row[-1]) or row[-1] in ('None', 'nan')):
+                row[-1] = None
+
+        for column_name in fixed_columns:
+            row.append(fixed_columns[column_name])
+
+        for indicator_column in indicator_columns:
+            row.append(df_row[indicator_column])
+
+        rows.append(tuple(row))
+
+    cols = df_columns + list(fixed_columns.keys()) + indicator_columns
+
+    return rows, cols
+
+
+def make_survey(n_rows, n_cols):
+    """Make a survey with numeric, text and checkbox columns."""
+    rng = np.random.default_rng(0)
+    data = dict()
+    n_text = (n_cols - n_checkbox * 5) // 2
+    n_numeric = n_cols - n_checkbox * 5 - n_text
+    for idx in range(n_numeric):
+        col = rng.integers(0, 5, n_rows).astype(float)
+        col[rng.random(n_rows) < 0.2] = np.nan
+        data[f'score_{idx}'] = col
+    for idx in range(n_text):
+        col = rng.choice(['good', 'bad', 'None', 'nan', None], n_rows)
+        data[f'comment_{idx}'] = col
+    for idx in range(n_checkbox):
+        for option in range(1, 6):
+            data[f'checkbox_{idx}___{option}'] = \
+                rng.integers(0, 2, n_rows).astype(float)
+    df = pd.DataFrame(data)
+    df.index = [f'{idx}' for idx in range(n_rows)]
+    df.index.name = 'record_id'
+    return df
+
+
+df = make_survey(n_rows, n_cols)
+df_columns = [col for col in df.columns if '___' not in col]
+fixed_columns = dict(study_id='study1')
+indicator_columns = [f'checkbox_{idx}' for idx in range(n_checkbox)]
+
+times = dict()
+outputs = dict()
+for name, func in [('old', dataframe_to_tuple_old),
+                   ('new', dataframe_to_tuple)]:
+    t1 = time.time()
+    outputs[name] = func(df.copy(), df_columns, fixed_columns,
+                         indicator_columns)
+    times[name] = time.time() - t1
+    print(f'{name:>4} {n_rows} x {n_cols}: {times[name]:.2f} s')
+
+
+def _as_repr(rows):
+    return [tuple((type(val), repr(val)) for val in row) for row in rows]
+
+
+assert outputs['old'][1] == outputs['new'][1]
+assert _as_repr(outputs['old'][0]) == _as_repr(outputs['new'][0])
+print(f'speed-up: {times["old"] / times["new"]:.1f}x, identical output')
@@ -0,0 +1,42 @@
+"""Compare Table.insert_rows with method='batch' and method='copy'."""
+
+import sys
+import time
+
+import psycopg2
+
+from neurobooth_terra import create_table, drop_table
+import credential_reader as reader
+
+db_args, _, _ = reader.read_db_secrets()
+
+n_rows_list = [10_000, 100_000, 1_000_000]
+if len(sys.argv) > 1:
+    n_rows_list = [int(n_rows) for n_rows in sys.argv[1:]]
+
+table_id = 'benchmark_insert_rows'
+column_names = ['subject_id', 'redcap_event_name', 'score', 'comments',
+                'attributes', 'indicators']
+dtypes = ['VARCHAR (255)', 'VARCHAR (255)', 'double precision', 'text',
+          'JSONB', 'smallint[]']
+
+
+def make_rows(n_rows):
+    return [(f'{idx}', 'v1_arm_1', idx / 3., f'comment\t{idx}',
+             {'idx': idx}, [1, 3] if idx % 2 else [])
+            for idx in range(n_rows)]
+
+
+with psycopg2.connect(**db_args) as conn:
+    for n_rows in n_rows_list:
+        rows = make_rows(n_rows)
+        for method in ['batch', 'copy']:
+            drop_table(table_id, conn)
+            table = create_table(table_id, conn, column_names, dtypes,
+                                 primary_key=['subject_id',
+                                              'redcap_event_name'])
+            t1 = time.time()
+            table.insert_rows(rows, column_names, method=method)
+            t2 = time.time()
+            print(f'{method:>6} {n_rows:>10} rows: {t2 - t1:.2f} s')
+    drop_table(table_id, conn)
@@ -3,8 +3,13 @@ import os
 from redcap import Project
 import credential_reader as reader
 
+from neurobooth_terra.connections import ConnectionManager
+
 rc_db_args, log_db_args, ssh_args = reader.read_db_secrets()
 
+# one tunnel and connection pool per database for the whole process
+connections = ConnectionManager(ssh_args, dict(rc=rc_db_args, log=log_db_args))
+
 dataflow_configs = reader.read_dataflow_configs()
 
 URL = 'https://redcap.partners.org/redcap/api/'
@@ -26,6 +26,8 @@ class dataflowArgs(BaseModel):
     free_volume_threshold: int
     NAS: DirectoryPath
     delete_threshold: float = Field(ge=0, le=1)
+    n_jobs: PositiveInt = 4
+    max_jobs_per_volume: PositiveInt = 1
 
 
 def get_server_hostname() -> str:
@@ -121,6 +123,8 @@ def read_dataflow_configs(config_fpath: Optional[str] = None):
     'reserve_threshold_bytes' 
     'suitable_volumes' 
     'delete_threshold'
+    'n_jobs'
+    'max_jobs_per_volume'
     See config yaml for context on these keys
     '''
 
@@ -136,7 +140,9 @@ def read_dataflow_configs(config_fpath: Optional[str] = None):
                         'suitable_volumes': dataflow_args.suitable_volumes,
                         'free_volume_threshold': dataflow_args.free_volume_threshold,
                         'NAS': dataflow_args.NAS,
-                        'delete_threshold': dataflow_args.delete_threshold}
+                        'delete_threshold': dataflow_args.delete_threshold,
+                        'n_jobs': dataflow_args.n_jobs,
+                        'max_jobs_per_volume': dataflow_args.max_jobs_per_volume}
     
     # check that all volumes in suitable volumes are actually suitable
     for volume in dataflow_configs['suitable_volumes']:
@@ -13,6 +13,8 @@ num_secs_in_a_day = 24*3600 # total number of seconds in a day - conversion fact
 target_dir = dataflow_configs['NAS'] # The directory from where files will be deleted
 
 delete_threshold: float  = dataflow_configs['delete_threshold'] # float: fraction between 0 and 1 indicating % filled
+# float: fraction filled to get below when deleting. If not set, every eligible file is deleted
+low_water_mark = dataflow_configs.get('delete_low_water_mark')
 suitable_dest_dirs: list = dataflow_configs['suitable_volumes']
 if len(suitable_dest_dirs) < 1:
     raise ValueError(f'No destination directories provided')
@@ -24,6 +26,8 @@ table_id = 'log_file' # log_file if target_dir is 'neurobooth/data', log_file_co
 if dry_run:
     stats = shutil.disk_usage(target_dir)
     threshold = stats.used / stats.total - 0.1  # ensure that it deletes
+    if low_water_mark is not None:
+        low_water_mark = min(low_water_mark, threshold)
     record_older_than_days = 60 # days
     copied_older_than_days = 45 # days
     # time elapsed is needed in seconds for sql query
@@ -49,4 +53,5 @@ with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
                      threshold=threshold,
                      record_older_than=record_older_than,
                      copied_older_than=copied_older_than,
+                     low_water_mark=low_water_mark,
                      dry_run=dry_run)
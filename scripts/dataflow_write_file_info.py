@@ -3,36 +3,11 @@ import psycopg2
 
 from neurobooth_terra import Table, create_table, drop_table
 from neurobooth_terra.fixes import OptionalSSHTunnelForwarder
-from neurobooth_terra.dataflow import write_files
+from neurobooth_terra.dataflow import write_files_bulk, query_sensor_files
 
 from config import ssh_args, log_db_args, dataflow_configs
 
 
-# get deduplicated log_sensor_file table from database
-def _dedup_log_sensor_file(sensor_file_df):
-    '''returns the deduplicated log_sensor_file table
-    
-        context:
-        Sensors such as intel have duplicate sensor_file_paths but unique
-        sensor_file_ids for depth vs rgb - same holds true for mbients that
-        have one data file but two sensor_file_ids for accelerometer and
-        gyroscope. Thus we can have duplicate sensor files over two rows.
-        We want to write one line in the log_file table per device hence
-        this function.
-    '''
-    def __concat_list_elements(x):
-        c=''
-        for i in x:
-            c = c+str(i)
-        return c
-    # Convert an array of filenames into a single concatenated string. If order of filename array
-    # is not maintained, this logic for detecting duplicates will break. However neurobooth_os
-    # conserves the filename array between two sensors of same device (eg: acc/gyr) when writing
-    # to log_sensor_file table.
-    sensor_file_df['to_detect_duplicates'] =  sensor_file_df['sensor_file_path'].apply(__concat_list_elements)
-    return sensor_file_df.drop_duplicates(subset='to_detect_duplicates', keep='first')
-
-
 do_create_table = False
 write_table = True
 dest_dir = dataflow_configs['NAS']
@@ -67,16 +42,14 @@ with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
                          foreign_key={'log_sensor_file_id': 'log_sensor_file'})
 
         if write_table:
-            # get log_sensor_file table and remove duplicates
+            # get log_sensor_file table without duplicates
             sensor_file_table = Table('log_sensor_file', conn)
-            sensor_file_df = sensor_file_table.query()
-            dedup_log_sensor_file_df = _dedup_log_sensor_file(sensor_file_df)
+            dedup_log_sensor_file_df = query_sensor_files(sensor_file_table)
 
             db_table = Table(table_id, conn)
-            # write new files in NAS to db, session by session
-            for session in sessions:
-                dest_dir_session = os.path.join(dest_dir, session)
-                write_files(dedup_log_sensor_file_df, db_table, dest_dir_session)
+            # write new files in NAS to db, all sessions at once
+            write_files_bulk(dedup_log_sensor_file_df, db_table, dest_dir,
+                             sessions=sessions)
 
 # For testing, set table_id to 'log_file_copy', do_create_table to True and
 # write_table to False. Run and check that an empty log_file_copy table
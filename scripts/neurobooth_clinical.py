@@ -8,10 +8,7 @@ import numpy as np
 import neurobooth_terra
 from neurobooth_terra import list_tables, Table
 
-import psycopg2
-from sshtunnel import SSHTunnelForwarder
-from config import ssh_args
-from config import rc_db_args as db_args
+from config import connections
 
 def get_closest_clinical_info(df_participant, start_time, date_format, date_column_name):
     if len(df_participant):
@@ -904,27 +901,23 @@ def map_dtype(dtype):
     return dtype_mapping.get(dtype_str, "TEXT")  # default to TEXT if unknown
 
 def create_new_table(table_name, df, list_dtypes):
-    with SSHTunnelForwarder(**ssh_args) as tunnel:
-        with psycopg2.connect(**db_args) as conn:
-            
-            list_nb_tables = neurobooth_terra.list_tables(conn)
-            if table_name in list_nb_tables:
-                neurobooth_terra.drop_table(table_name, conn)
+    with connections.connect('rc') as conn:
+        list_nb_tables = neurobooth_terra.list_tables(conn)
+        if table_name in list_nb_tables:
+            neurobooth_terra.drop_table(table_name, conn)
 
-            neurobooth_terra.create_table(table_name, conn, df.columns, list_dtypes, primary_key=['patient_id', 'session_date'])
-            Table(table_name, conn).insert_rows(df.to_records(index=False).tolist(), df.columns)
+        neurobooth_terra.create_table(table_name, conn, df.columns, list_dtypes, primary_key=['patient_id', 'session_date'])
+        Table(table_name, conn).insert_rows(df.to_records(index=False).tolist(), df.columns)
 
 def get_table_from_database(table_name):
-    with SSHTunnelForwarder(**ssh_args) as tunnel:
-        with psycopg2.connect(**db_args) as conn:
-            df = Table(table_name, conn).query()
+    with connections.connect('rc') as conn:
+        df = Table(table_name, conn).query()
 
     return df
 
 def get_table_from_query(query, list_column_names):
-    with SSHTunnelForwarder(**ssh_args) as tunnel:
-        with psycopg2.connect(**db_args) as conn:
-            df = neurobooth_terra.query(conn, query, list_column_names)
+    with connections.connect('rc') as conn:
+        df = neurobooth_terra.query(conn, query, list_column_names)
 
     return df
 
@@ -21,6 +21,7 @@ from neurobooth_terra.redcap import (map_dtypes,
                                      dataframe_to_tuple,
                                      fetch_survey,
                                      subselect_table_structure,
+                                     process_metadata,
                                     )
 from neurobooth_terra import Table, create_table, drop_table
 
@@ -57,42 +58,11 @@ metadata.to_csv('fa_data_dictionary.csv')
 print('[Done]')
 
 
-for column in ['section_header', 'field_label']:
-    metadata[column] = metadata[column].apply(
-        lambda x: x.strip('\n') if isinstance(x, str) else x
-    )
-
-metadata = metadata.apply(map_dtypes, axis=1)
-metadata = metadata.apply(extract_field_annotation, axis=1)
-metadata = metadata.apply(get_response_array, axis=1)
-metadata.rename({'form_name': 'redcap_form_name',
-                 'FOI': 'feature_of_interest', 'DB': 'in_database',
-                 'T': 'database_table_name',
-                 'redcap_event_name': 'event_name'}, axis=1, inplace=True)
-
-is_descriptive = metadata['field_type'] == 'descriptive'
-metadata['redcap_form_description'] = metadata['field_label']
-metadata.loc[~is_descriptive, 'redcap_form_description'] = None
-
-metadata['question'] = metadata['field_label']
-metadata.loc[is_descriptive, 'question'] = None
-
-if 'database_table_name' not in metadata.columns:
-    metadata['database_table_name'] = np.nan
-metadata['database_table_name'] = metadata['database_table_name'].fillna(
-    value=metadata['redcap_form_name'])
-
-# copy first section header of matrix into rest
-# and concatenate with question
-metadata_groups = metadata.groupby(by='matrix_group_name')
-metadata['section_header'] = metadata_groups['section_header'].transform(
-    lambda s: s.infer_objects().ffill())
-is_group = ~pd.isna(metadata['section_header'])
-metadata.loc[is_group, 'question'] = (metadata['section_header'][is_group] +
-                                  metadata['question'][is_group])
-
+# parsing the data dictionary is cached until it changes in Redcap
+metadata, table_infos = process_metadata(metadata,
+                                         include_surveys=survey_ids.keys(),
+                                         cache_dir='.metadata_cache')
 metadata.to_csv('fa_data_dictionary_modified.csv')
-table_infos = get_tables_structure(metadata, include_surveys=survey_ids.keys())
 
 
 # adding last_updated column to data_dictionary
@@ -129,7 +99,9 @@ with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
                                  table_info['dtypes']+(['smallint[]']*len(table_info['indicator_columns'])),
                                  primary_key=primary_keys)
             df = fetch_survey(fa_project, survey_name=table_id,
-                              survey_id=survey_ids[table_id])
+                              survey_id=survey_ids[table_id],
+                              dtypes=dict(zip(table_info['columns'],
+                                          table_info['python_dtypes'])))
             df = df.rename(columns={'record_id': 'subject_id'})
 
             report_cols = set([col.split('___')[0] for col in df.columns])
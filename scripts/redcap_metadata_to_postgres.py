@@ -16,11 +16,13 @@ import datetime
 
 from redcap import RedcapError
 
-from neurobooth_terra.redcap import (fetch_survey, dataframe_to_tuple,
+from neurobooth_terra.redcap import (fetch_survey, fetch_surveys,
+                                     dataframe_to_tuple,
                                      extract_field_annotation, map_dtypes,
                                      get_tables_structure,
                                      subselect_table_structure,
-                                     get_response_array)
+                                     get_response_array, sync_table,
+                                     process_metadata)
 from neurobooth_terra import create_table, drop_table
 from neurobooth_terra.fixes import OptionalSSHTunnelForwarder
 
@@ -148,45 +150,12 @@ print('[Done]')
 # ------
 
 
-for column in ['section_header', 'field_label']:
-    metadata[column] = metadata[column].apply(
-        lambda x: x.strip('\n') if isinstance(x, str) else x
-    )
-
-# feature of interest
-metadata = metadata.apply(map_dtypes, axis=1)
-metadata = metadata.apply(extract_field_annotation, axis=1)
-metadata = metadata.apply(get_response_array, axis=1)
-metadata.rename({'form_name': 'redcap_form_name',
-                 'FOI': 'feature_of_interest', 'DB': 'in_database',
-                 'T': 'database_table_name',
-                 'redcap_event_name': 'event_name'}, axis=1, inplace=True)
-
-is_descriptive = metadata['field_type'] == 'descriptive'
-metadata['redcap_form_description'] = metadata['field_label']
-metadata.loc[~is_descriptive, 'redcap_form_description'] = None
-
-metadata['question'] = metadata['field_label']
-metadata.loc[is_descriptive, 'question'] = None
-
-if 'database_table_name' not in metadata.columns:
-    metadata['database_table_name'] = np.nan
-metadata['database_table_name'] = metadata['database_table_name'].fillna(
-    value=metadata['redcap_form_name'])
-
-# copy first section header of matrix into rest and concatenate with
-# question
-metadata_groups = metadata.groupby(by='matrix_group_name')
-metadata['section_header'] = metadata_groups['section_header'].transform(
-    lambda s: s.infer_objects().ffill())
-is_group = ~pd.isna(metadata['section_header'])
-metadata.loc[is_group, 'question'] = (metadata['section_header'][is_group] +
-                                  metadata['question'][is_group])
-
+# parsing the data dictionary is cached until it changes in Redcap
+metadata, table_infos = process_metadata(metadata,
+                                         include_surveys=survey_ids.keys(),
+                                         cache_dir='.metadata_cache')
 metadata.to_csv('data_dictionary_modified.csv')
 
-table_infos = get_tables_structure(metadata, include_surveys=survey_ids.keys())
-
 # adding last_updated column to data_dictionary
 metadata['last_updated'] = datetime.datetime.now()
 metadata = metadata.reset_index()
@@ -200,9 +169,6 @@ rows_metadata, cols_metadata = dataframe_to_tuple(
 with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
     with psycopg2.connect(**rc_db_args) as conn:
 
-        # Drop views first, as they may depend on the below tables
-        drop_views(conn, verbose=True)
-
         # Unlike other tables, data_dictionary is not dropped.
         # Instead the rows are only ever updated.
         # This means all the old variables are still retained in
@@ -212,20 +178,17 @@ with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
         table_metadata.insert_rows(rows_metadata, cols_metadata,
                                    on_conflict='update')
 
-        # for table_id, table_info in table_infos.items():
-        for table_id, _ in survey_ids.items():
-            
-            table_info = table_infos[table_id]
-            print(f'Overwriting table {table_id}')
-            drop_table('rc_' + table_id, conn)
-
-            primary_keys = ['subject_id', 'redcap_event_name']
+        is_rebuilt = False
+        # reports are fetched concurrently and loaded as they arrive
+        python_dtypes = {table_id: dict(zip(table_infos[table_id]['columns'],
+                                            table_infos[table_id]['python_dtypes']))
+                         for table_id in survey_ids}
+        for table_id, df in fetch_surveys(project, survey_ids,
+                                          dtypes=python_dtypes):
 
-            table = create_table('rc_' + table_id, conn, table_info['columns']+table_info['indicator_columns'],
-                                 table_info['dtypes']+(['smallint[]']*len(table_info['indicator_columns'])),
-                                 primary_key=primary_keys)
-            df = fetch_survey(project, survey_name=table_id,
-                              survey_id=survey_ids[table_id])
+            table_info = table_infos[table_id]
+            column_names = table_info['columns'] + table_info['indicator_columns']
+            dtypes = table_info['dtypes'] + ['smallint[]'] * len(table_info['indicator_columns'])
             df = df.rename(columns={'record_id': 'subject_id'})
 
             # XXX: not consistent.
@@ -254,6 +217,15 @@ with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
                 df, df_columns=table_info['columns'],
                 indicator_columns=table_info['indicator_columns'])
 
-            table.insert_rows(rows, columns)
-
-        create_views(conn, verbose=True)
+            # only the rows that changed since the last run are written
+            print(f'Synchronizing table {table_id}')
+            summary = sync_table(conn, 'rc_' + table_id, column_names, dtypes,
+                                 rows, columns,
+                                 primary_key=['subject_id', 'redcap_event_name'])
+            print(f'{summary}')
+            is_rebuilt = is_rebuilt or summary['rebuilt']
+
+        # views depend on the tables, so recreate them if a table was recreated
+        if is_rebuilt:
+            drop_views(conn, verbose=True)
+            create_views(conn, verbose=True)
@@ -5,7 +5,7 @@ import psycopg2
 from neurobooth_terra.fixes import OptionalSSHTunnelForwarder
 from config import ssh_args, db_args
 
-from neurobooth_terra import Table
+from neurobooth_terra import Table, transaction
 
 
 def sanitize_date(s):
@@ -25,13 +25,17 @@ with OptionalSSHTunnelForwarder(**ssh_args) as tunnel:
         task_groups = task_df.groupby(by=['subject_id', 'date_times'])
 
         log_session_id = int(session_df.log_session_id.max() + 1)
+        session_rows, task_ids, task_rows = list(), list(), list()
         for group, df in task_groups:
+            session_rows.append(
+                (log_session_id, group[0], group[1], 'neurobooth_os'))
+            task_ids.extend(df.index)
+            task_rows.extend([(log_session_id,)] * len(df))
+            log_session_id += 1
+
+        with transaction(conn):
             table_session.insert_rows(
                     cols=['log_session_id', 'subject_id', 'date', 'application_id'],
-                    vals=[(log_session_id, group[0], group[1], 'neurobooth_os')])
-            for ix in df.index:
-                table_task.insert_rows(
-                                cols=['log_task_id', 'log_session_id'],
-                                vals=[(ix, log_session_id,)],
-                                on_conflict='update')
-            log_session_id += 1
+                    vals=session_rows)
+            table_task.update_rows(task_ids, task_rows,
+                                   cols=['log_session_id'])